@@ -81,6 +81,9 @@ if __name__ == "__main__":
     parser.add_argument('--data_block_compressed_type', type=str, default='',
                         choices=['', 'ZLIB', 'GZIP'],
                         help='the compressed type for data block')
+    parser.add_argument('--data_block_offset_index', action='store_true',
+                        help='write offset index beside the uncompressed '\
+                             'TF_RECORD data block to seek it quickly')
     args = parser.parse_args()
     worker_options = dj_pb.DataJoinWorkerOptions(
             use_mock_etcd=args.use_mock_etcd,
@@ -107,7 +110,8 @@ if __name__ == "__main__":
                 ),
             data_block_builder_options=dj_pb.WriterOptions(
                     output_writer=args.data_block_builder,
-                    compressed_type=args.data_block_compressed_type
+                    compressed_type=args.data_block_compressed_type,
+                    offset_index=args.data_block_offset_index
                 )
         )
     worker_srv = DataJoinWorkerService(args.listen_port, args.peer_addr,
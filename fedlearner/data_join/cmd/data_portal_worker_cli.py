@@ -58,6 +58,9 @@ if __name__ == '__main__':
     parser.add_argument('--builder_compressed_type', type=str, default='',
                         choices=['', 'ZLIB', 'GZIP'],
                         help='the builder for ouput file')
+    parser.add_argument('--builder_offset_index', action='store_true',
+                        help='write offset index beside the uncompressed '\
+                             'TF_RECORD output to seek it quickly')
     parser.add_argument("--batch_size", type=int, default=1024,
                         help="the batch size for raw data reader")
     args = parser.parse_args()
@@ -75,7 +78,8 @@ if __name__ == '__main__':
         ),
         writer_options=dj_pb.WriterOptions(
             output_writer=args.output_builder,
-            compressed_type=args.builder_compressed_type
+            compressed_type=args.builder_compressed_type,
+            offset_index=args.builder_offset_index
         ),
         batch_processor_options=dj_pb.BatchProcessorOptions(
             batch_size=args.batch_size,
@@ -62,6 +62,9 @@ if __name__ == "__main__":
     parser.add_argument('--builder_compressed_type', type=str, default='',
                         choices=['', 'ZLIB', 'GZIP'],
                         help='the compressed type for TF_RECORD builder')
+    parser.add_argument('--builder_offset_index', action='store_true',
+                        help='write offset index beside the uncompressed '\
+                             'TF_RECORD output to seek it quickly')
     parser.add_argument('--total_partitioner_num', type=int, required=True,
                         help='the number of partitioner worker for input data')
     parser.add_argument('--partitioner_rank_id', type=int, required=True,
@@ -119,6 +122,7 @@ if __name__ == "__main__":
             writer_options=dj_pb.WriterOptions(
                 output_writer=args.output_builder,
                 compressed_type=args.builder_compressed_type,
+                offset_index=args.builder_offset_index,
             ),
             partitioner_rank_id=args.partitioner_rank_id,
             batch_processor_options=dj_pb.BatchProcessorOptions(
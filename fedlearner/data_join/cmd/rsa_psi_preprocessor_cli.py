@@ -95,6 +95,9 @@ if __name__ == "__main__":
     parser.add_argument('--builder_compressed_type', type=str, default='',
                         choices=['', 'ZLIB', 'GZIP'],
                         help='the compressed type for TF_RECORD builder')
+    parser.add_argument('--builder_offset_index', action='store_true',
+                        help='write offset index beside the uncompressed '\
+                             'TF_RECORD output to seek it quickly')
     parser.add_argument('--preprocessor_offload_processor_number',
                         type=int, default=-1,
                         help='the offload processor for preprocessor')
@@ -158,6 +161,7 @@ if __name__ == "__main__":
             writer_options=dj_pb.WriterOptions(
                 output_writer=args.output_builder,
                 compressed_type=args.builder_compressed_type,
+                offset_index=args.builder_offset_index,
             )
         )
     if args.psi_role.upper() == 'LEADER':
@@ -42,6 +42,7 @@ InvalidExampleId = ''.encode()
 TmpFileSuffix = '.tmp'
 DoneFileSuffix = '.done'
 RawDataFileSuffix = '.rd'
+OffsetIndexSuffix = '.idx'
 InvalidEventTime = -9223372036854775808
 InvalidRawId = ''.encode()
 
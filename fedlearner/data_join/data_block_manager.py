@@ -135,6 +135,7 @@ class DataBlockBuilder(object):
                     )
                 )
             gfile.Rename(self._tmp_fpath, data_block_path, True)
+            self._writer.write_offset_index(data_block_path)
             self._build_data_block_meta()
             if emit_logger:
                 self._emit_logger(metrics_tags)
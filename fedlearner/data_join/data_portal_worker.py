@@ -65,6 +65,7 @@ class RawDataSortPartitioner(RawDataPartitioner):
                                      common.partition_repr(self._partition_id),
                                      meta.encode_meta_to_fname())
                 gfile.Rename(self.get_tmp_fpath(), fpath, True)
+                writer.write_offset_index(fpath)
                 self._buffer = []
                 self._begin_index = None
                 self._end_index = None
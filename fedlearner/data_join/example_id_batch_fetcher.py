@@ -34,6 +34,10 @@ class ExampleIdBatch(ItemBatch):
         self._example_ids.append(item.example_id)
         self._event_times.append(item.event_time)
 
+    def append_batch(self, record_batch):
+        self._example_ids.extend(record_batch.example_ids)
+        self._event_times.extend(record_batch.event_times)
+
     @property
     def begin_index(self):
         return self._begin_index
@@ -97,17 +101,21 @@ class ExampleIdBatchFetcher(ItemBatchSeqProcessor):
         while not self._raw_data_visitor.finished() and \
                 not self._fly_item_full():
             next_batch = self._make_item_batch(next_index)
-            for (index, item) in self._raw_data_visitor:
+            while len(next_batch) <= self._batch_size:
+                try:
+                    index, record_batch = self._raw_data_visitor.next_batch(
+                            self._batch_size + 1 - len(next_batch)
+                        )
+                except StopIteration:
+                    break
                 if index != next_index:
                     logging.fatal("index of raw data visitor for partition "\
                                   "%d is not consecutive, %d != %d",
                                   self._partition_id, index, next_index)
                     traceback.print_stack()
                     os._exit(-1) # pylint: disable=protected-access
-                next_batch.append(item)
-                next_index += 1
-                if len(next_batch) > self._batch_size:
-                    break
+                next_batch.append_batch(record_batch)
+                next_index += len(record_batch)
             yield next_batch, self._raw_data_visitor.finished()
         yield self._make_item_batch(next_index), \
                 self._raw_data_visitor.finished()
@@ -30,6 +30,7 @@ from fedlearner.data_join.example_id_visitor import (
     ExampleIdManager, encode_example_id_dumped_fname
 )
 from fedlearner.data_join import visitor, common
+from fedlearner.data_join.record_offset_index import RecordOffsetIndexBuilder
 
 class ExampleIdDumperManager(object):
     class ExampleIdDumper(object):
@@ -42,6 +43,7 @@ class ExampleIdDumperManager(object):
             self._dump_threshold = dump_threshold
             self._tmp_fpath = self._get_tmp_fpath()
             self._tf_record_writer = tf.io.TFRecordWriter(self._tmp_fpath)
+            self._offset_index = RecordOffsetIndexBuilder()
             self._dumped_example_id_batch_count = 0
 
         def dump_example_id_batch(self, example_id_batch):
@@ -54,6 +56,10 @@ class ExampleIdDumperManager(object):
             self._tf_record_writer.write(
                     example_id_batch.sered_lite_example_ids
                 )
+            self._offset_index.append_record(
+                    len(example_id_batch.sered_lite_example_ids),
+                    example_id_batch.example_id_num
+                )
             self._end_index += example_id_batch.example_id_num
             self._dumped_example_id_batch_count += 1
 
@@ -69,6 +75,7 @@ class ExampleIdDumperManager(object):
             if self.dumped_example_id_count() > 0:
                 fpath = self._get_dumped_fpath()
                 gfile.Rename(self._tmp_fpath, fpath, True)
+                self._offset_index.dump(fpath)
                 index_meta = visitor.IndexMeta(
                         self._process_index, self._start_index, fpath
                     )
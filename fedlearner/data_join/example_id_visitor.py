@@ -262,25 +262,35 @@ class ExampleIdVisitor(visitor.Visitor):
         def name(cls):
             return 'EXAMPLE_ID_TF_RECORD'
 
-        def _inner_iter(self, fpath):
+        def _inner_iter(self, fpath, offset=0):
+            if offset > 0:
+                for item in self._iter_example_id_items(
+                        self._offset_record_iter(fpath, offset)):
+                    yield item
+                return
             with make_tf_record_iter(fpath) as record_iter:
-                for record in record_iter:
-                    lite_example_ids = dj_pb.LiteExampleIds()
-                    lite_example_ids.ParseFromString(record)
-                    example_id_num = len(lite_example_ids.example_id)
-                    event_time_num = len(lite_example_ids.event_time)
-                    assert example_id_num == event_time_num, \
-                        "the size of example id and event time must the "\
-                        "same. {} != {}".format(example_id_num,
-                                                event_time_num)
-                    index = 0
-                    while index < len(lite_example_ids.example_id):
-                        yield ExampleIdVisitor.ExampleIdItem(
-                                lite_example_ids.example_id[index],
-                                lite_example_ids.event_time[index],
-                                index + lite_example_ids.begin_index
-                            )
-                        index += 1
+                for item in self._iter_example_id_items(record_iter):
+                    yield item
+
+        @staticmethod
+        def _iter_example_id_items(record_iter):
+            for record in record_iter:
+                lite_example_ids = dj_pb.LiteExampleIds()
+                lite_example_ids.ParseFromString(record)
+                example_id_num = len(lite_example_ids.example_id)
+                event_time_num = len(lite_example_ids.event_time)
+                assert example_id_num == event_time_num, \
+                    "the size of example id and event time must the "\
+                    "same. {} != {}".format(example_id_num,
+                                            event_time_num)
+                index = 0
+                while index < len(lite_example_ids.example_id):
+                    yield ExampleIdVisitor.ExampleIdItem(
+                            lite_example_ids.example_id[index],
+                            lite_example_ids.event_time[index],
+                            index + lite_example_ids.begin_index
+                        )
+                    index += 1
 
     def __init__(self, etcd, data_source, partition_id):
         super(ExampleIdVisitor, self).__init__(
@@ -29,6 +29,10 @@ class ItemBatch(object):
                 "append is not implemented in base ItemBatch"
             )
 
+    def append_batch(self, record_batch):
+        for item in record_batch:
+            self.append(item)
+
     @property
     def begin_index(self):
         raise NotImplementedError(
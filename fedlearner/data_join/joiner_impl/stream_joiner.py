@@ -17,15 +17,25 @@
 import logging
 import time
 
+import numpy as np
+
 from fedlearner.common import metrics
 
 import fedlearner.data_join.common as common
 from fedlearner.data_join.joiner_impl.example_joiner import ExampleJoiner
 
 class _CmpCtnt(object):
-    def __init__(self, item):
-        self._event_time = item.event_time
-        self._example_id = item.example_id
+    def __init__(self, event_time, example_id):
+        self._event_time = event_time
+        self._example_id = example_id
+
+    @property
+    def event_time(self):
+        return self._event_time
+
+    @property
+    def example_id(self):
+        return self._example_id
 
     def __lt__(self, other):
         assert isinstance(other, _CmpCtnt)
@@ -39,33 +49,56 @@ class _CmpCtnt(object):
                 self._example_id == other._example_id
 
 class _JoinWindow(object):
+    """Items of a join window in the order of appending. Only the indices,
+    event times and 64-bit hashes of example ids are kept, as numpy
+    arrays, so the window is probed by example ids, ranked by
+    (event_time, example_id) and evicted in bulk. Example ids and items
+    are fetched from the record batches they were appended with when
+    they are asked for, a batch is released once all of its items are
+    evicted. Appended items are buffered and merged into the arrays when
+    they are needed."""
     def __init__(self, pt_rate, qt_rate):
         assert 0.0 <= pt_rate <= 1.0, \
             "pt_rate {} should in [0.0, 1.0]".format(pt_rate)
         assert 0.0 <= qt_rate <= 1.0, \
             "qt_rate {} should in [0.0, 1.0]".format(qt_rate)
-        self._buffer = []
-        self._cmp_ctnt = []
-        self._cmp_ctnt_sorted = True
         self._pt_rate = pt_rate
         self._qt_rate = qt_rate
         self._committed_pt = None
-
-    def __iter__(self):
-        return iter(self._buffer)
-
-    def append(self, index, item):
-        if len(self._cmp_ctnt) > 0 and \
-                self._cmp_ctnt[-1] > _CmpCtnt(item):
-            self._cmp_ctnt_sorted = False
-        self._cmp_ctnt.append(_CmpCtnt(item))
-        self._buffer.append((index, item))
+        self._next_batch_id = 0
+        self.reset(True)
+
+    def append_batch(self, begin_index, batch, offsets=None):
+        """Append items of batch at offsets, all of them if offsets is None.
+        The index of an item is begin_index plus its offset"""
+        example_ids, event_times = batch.example_ids, batch.event_times
+        if offsets is None:
+            offsets = np.arange(len(batch), dtype=np.int64)
+        else:
+            offsets = np.asarray(offsets, dtype=np.int64)
+            example_ids = [example_ids[offset] for offset in offsets]
+            event_times = [event_times[offset] for offset in offsets]
+        if len(offsets) == 0:
+            return
+        batch_id = self._next_batch_id
+        self._next_batch_id += 1
+        self._batches[batch_id] = batch
+        self._pending.append((
+                offsets + begin_index,
+                np.array(event_times, dtype=np.int64),
+                np.fromiter((hash(example_id) for example_id in example_ids),
+                            dtype=np.int64, count=len(offsets)),
+                np.full(len(offsets), batch_id, dtype=np.int64),
+                offsets
+            ))
+        self._size += len(offsets)
+        self._invalidate()
 
     def size(self):
-        return len(self._buffer)
+        return self._size
 
     def forward_pt(self):
-        if len(self._buffer) == 0:
+        if self._size == 0:
             return False
         new_pt = self._cal_pt(self._pt_rate)
         if self._committed_pt is None or new_pt > self._committed_pt:
@@ -79,29 +112,141 @@ class _JoinWindow(object):
     def qt(self):
         return self._cal_pt(self._qt_rate)
 
-    def reset(self, new_buffer, state_stale):
-        self._cmp_ctnt = [_CmpCtnt(item[1]) for item in new_buffer]
-        self._buffer = new_buffer
+    def reset(self, state_stale):
+        self._arrays = tuple(np.empty(0, dtype=np.int64) for _ in range(5))
+        self._batches = {}
+        self._pending = []
+        self._size = 0
         if state_stale:
             self._committed_pt = None
-        self._cmp_ctnt_sorted = \
-                all((self._cmp_ctnt[i] < self._cmp_ctnt[i+1] or
-                     self._cmp_ctnt[i] == self._cmp_ctnt[i+1])
-                    for i in range(len(self._cmp_ctnt)-1))
-
-    def __getitem__(self, index):
-        return self._buffer[index]
+        self._invalidate()
+
+    def evict(self, mask):
+        self._merge_pending()
+        reserved = ~mask
+        self._arrays = tuple(array[reserved] for array in self._arrays)
+        self._size = len(self._arrays[0])
+        # release the batches of which no item is left
+        for batch_id in set(self._batches) - \
+                set(np.unique(self._batch_ids).tolist()):
+            del self._batches[batch_id]
+        self._invalidate()
+
+    @property
+    def indices(self):
+        self._merge_pending()
+        return self._arrays[0]
+
+    @property
+    def hashes(self):
+        self._merge_pending()
+        return self._arrays[2]
+
+    def example_ids(self, positions):
+        self._merge_pending()
+        batches = self._batches
+        return [batches[batch_id].example_ids[offset]
+                for batch_id, offset in
+                zip(self._batch_ids[positions].tolist(),
+                    self._offsets[positions].tolist())]
+
+    def entries(self, positions):
+        self._merge_pending()
+        batches = self._batches
+        return [(index, batches[batch_id].get_item(offset))
+                for index, batch_id, offset in
+                zip(self._indices[positions].tolist(),
+                    self._batch_ids[positions].tolist(),
+                    self._offsets[positions].tolist())]
+
+    def index_example_ids(self, begin, end):
+        positions = np.arange(begin, end)
+        return list(zip(self.indices[positions].tolist(),
+                        self.example_ids(positions)))
+
+    def find(self, hashes, example_ids):
+        """Return the positions of the latest appended items with the given
+        example ids, -1 for the absent"""
+        positions = np.full(len(hashes), -1, dtype=np.int64)
+        if self._size == 0 or len(hashes) == 0:
+            return positions
+        self._merge_pending()
+        if self._hash_order is None:
+            self._hash_order = np.argsort(self._hashes, kind='stable')
+        sorted_hashes = self._hashes[self._hash_order]
+        lefts = np.searchsorted(sorted_hashes, hashes, side='left')
+        rights = np.searchsorted(sorted_hashes, hashes, side='right')
+        hits = np.flatnonzero(lefts < rights)
+        # the hash order is stable, the last of the same hash is the latest
+        cands = self._hash_order[rights[hits] - 1]
+        matched = np.array(
+                [example_id == example_ids[i] for i, example_id in
+                 zip(hits.tolist(), self.example_ids(cands))], dtype=bool)
+        positions[hits[matched]] = cands[matched]
+        for i in hits[~matched]:
+            # hash collision, look into the others with the same hash
+            for pos in self._hash_order[lefts[i]:rights[i]-1][::-1]:
+                if self.example_ids([pos])[0] == example_ids[i]:
+                    positions[i] = pos
+                    break
+        return positions
+
+    def before(self, cmp_ctnt):
+        """Return the mask of items ranked before cmp_ctnt"""
+        self._merge_pending()
+        mask = self._event_times < cmp_ctnt.event_time
+        ties = np.flatnonzero(self._event_times == cmp_ctnt.event_time)
+        if len(ties) > 0:
+            mask[ties] = [example_id < cmp_ctnt.example_id
+                          for example_id in self.example_ids(ties)]
+        return mask
+
+    @property
+    def _indices(self):
+        return self._arrays[0]
+
+    @property
+    def _event_times(self):
+        return self._arrays[1]
+
+    @property
+    def _hashes(self):
+        return self._arrays[2]
+
+    @property
+    def _batch_ids(self):
+        return self._arrays[3]
+
+    @property
+    def _offsets(self):
+        return self._arrays[4]
 
     def _cal_pt(self, rate):
-        if not self._buffer:
+        if self._size == 0:
             return None
-        if not self._cmp_ctnt_sorted:
-            self._cmp_ctnt.sort()
-            self._cmp_ctnt_sorted = True
-        pos = int(len(self._buffer) * rate)
-        if pos == len(self._buffer):
-            pos = len(self._buffer) - 1
-        return self._cmp_ctnt[pos]
+        if rate not in self._pt_cache:
+            self._merge_pending()
+            pos = int(self._size * rate)
+            if pos == self._size:
+                pos = self._size - 1
+            event_time = np.partition(self._event_times, pos)[pos]
+            rank = pos - np.count_nonzero(self._event_times < event_time)
+            ties = sorted(self.example_ids(
+                np.flatnonzero(self._event_times == event_time)))
+            self._pt_cache[rate] = _CmpCtnt(int(event_time), ties[rank])
+        return self._pt_cache[rate]
+
+    def _merge_pending(self):
+        if len(self._pending) == 0:
+            return
+        self._arrays = tuple(
+                np.concatenate([array] + [chunk[i] for chunk in self._pending])
+                for i, array in enumerate(self._arrays))
+        self._pending = []
+
+    def _invalidate(self):
+        self._hash_order = None
+        self._pt_cache = {}
 
 class StreamExampleJoiner(ExampleJoiner):
     def __init__(self, example_joiner_options, raw_data_options,
@@ -116,8 +261,8 @@ class StreamExampleJoiner(ExampleJoiner):
         self._leader_join_window = _JoinWindow(0.05, 0.99)
         self._follower_join_window = _JoinWindow(0.05, 0.90)
         self._joined_cache = {}
-        self._leader_unjoined_example_ids = []
-        self._follower_example_cache = {}
+        self._joined_hashes = np.empty(0, dtype=np.int64)
+        self._leader_unjoined_pos = np.empty(0, dtype=np.int64)
         self._fill_leader_enough = False
         self._reset_joiner_state(True)
 
@@ -183,28 +328,43 @@ class StreamExampleJoiner(ExampleJoiner):
 
     def _update_join_cache(self):
         start_tm = time.time()
-        new_unjoined_example_ids = []
-        for example_id in self._leader_unjoined_example_ids:
-            if example_id in self._follower_example_cache:
-                self._joined_cache[example_id] = \
-                        self._follower_example_cache[example_id]
-            else:
-                new_unjoined_example_ids.append(example_id)
-        self._leader_unjoined_example_ids = new_unjoined_example_ids
+        self._join_leader_unjoined()
         metrics.emit_timer(name='stream_joiner_update_join_cache',
                            value=int(time.time()-start_tm),
                            tags=self._metrics_tags)
 
+    def _join_leader_unjoined(self):
+        # probe the follower window by the unjoined leader example ids in
+        # bulk, the matched are moved to joined cache
+        if len(self._leader_unjoined_pos) == 0:
+            return
+        unjoined_eids = self._leader_join_window.example_ids(
+                self._leader_unjoined_pos
+            )
+        unjoined_hashes = \
+                self._leader_join_window.hashes[self._leader_unjoined_pos]
+        follower_pos = self._follower_join_window.find(unjoined_hashes,
+                                                       unjoined_eids)
+        matched = np.flatnonzero(follower_pos >= 0)
+        self._joined_cache.update(zip(
+                [unjoined_eids[i] for i in matched],
+                self._follower_join_window.entries(follower_pos[matched])
+            ))
+        self._joined_hashes = np.concatenate(
+                [self._joined_hashes, unjoined_hashes[matched]]
+            )
+        self._leader_unjoined_pos = np.delete(self._leader_unjoined_pos,
+                                              matched)
+
     def _dump_joined_items(self):
         start_tm = time.time()
-        for (li, le) in self._leader_join_window:
-            eid = le.example_id
-            if eid not in self._follower_example_cache and \
-                    eid not in self._joined_cache:
-                continue
-            if eid not in self._joined_cache:
-                self._joined_cache[eid] = \
-                        self._follower_example_cache[eid]
+        self._join_leader_unjoined()
+        joined = np.ones(self._leader_join_window.size(), dtype=bool)
+        joined[self._leader_unjoined_pos] = False
+        joined_pos = np.flatnonzero(joined)
+        for li, eid in zip(
+                self._leader_join_window.indices[joined_pos].tolist(),
+                self._leader_join_window.example_ids(joined_pos)):
             builder = self._get_data_block_builder(True)
             assert builder is not None, "data block builder must be "\
                                         "not None if before dummping"
@@ -217,31 +377,29 @@ class StreamExampleJoiner(ExampleJoiner):
                            tags=self._metrics_tags)
 
     def _reset_joiner_state(self, state_stale):
-        self._leader_join_window.reset([], state_stale)
+        self._leader_join_window.reset(state_stale)
         self._fill_leader_enough = False
         self._joined_cache = {}
-        self._leader_unjoined_example_ids = []
+        self._joined_hashes = np.empty(0, dtype=np.int64)
+        self._leader_unjoined_pos = np.empty(0, dtype=np.int64)
         if state_stale:
-            self._follower_join_window.reset([], True)
-            self._follower_example_cache = {}
+            self._follower_join_window.reset(True)
 
     def _fill_leader_join_window(self, sync_example_id_finished):
         if not self._fill_leader_enough:
             start_tm = time.time()
             start_pos = self._leader_join_window.size()
             if not self._fill_join_windows(self._leader_visitor,
-                                           self._leader_join_window,
-                                           None):
+                                           self._leader_join_window):
                 self._fill_leader_enough = sync_example_id_finished
             else:
                 self._fill_leader_enough = True
             if self._fill_leader_enough:
-                self._leader_unjoined_example_ids = \
-                    [item.example_id for _, item in self._leader_join_window]
+                self._leader_unjoined_pos = \
+                    np.arange(self._leader_join_window.size())
             end_pos = self._leader_join_window.size()
-            eids = [(self._leader_join_window[idx][0],
-                     self._leader_join_window[idx][1].example_id)
-                    for idx in range(start_pos, end_pos)]
+            eids = self._leader_join_window.index_example_ids(start_pos,
+                                                              end_pos)
             self._joiner_stats.fill_leader_example_ids(eids)
             metrics.emit_timer(name='stream_joiner_fill_leader_join_window',
                                value=int(time.time()-start_tm),
@@ -252,19 +410,17 @@ class StreamExampleJoiner(ExampleJoiner):
         start_tm = time.time()
         start_pos = self._follower_join_window.size()
         follower_enough = self._fill_join_windows(self._follower_visitor,
-                                                  self._follower_join_window,
-                                                  self._follower_example_cache)
+                                                  self._follower_join_window)
         end_pos = self._follower_join_window.size()
-        eids = [(self._follower_join_window[idx][0],
-                 self._follower_join_window[idx][1].example_id)
-                for idx in range(start_pos, end_pos)]
+        eids = self._follower_join_window.index_example_ids(start_pos,
+                                                            end_pos)
         self._joiner_stats.fill_follower_example_ids(eids)
         metrics.emit_timer(name='stream_joiner_fill_leader_join_window',
                            value=int(time.time()-start_tm),
                            tags=self._metrics_tags)
         return follower_enough or raw_data_finished
 
-    def _fill_join_windows(self, visitor, join_window, join_cache):
+    def _fill_join_windows(self, visitor, join_window):
         while not visitor.finished() and \
                 join_window.size() < self._max_window_size:
             required_item_count = self._min_window_size
@@ -274,69 +430,89 @@ class StreamExampleJoiner(ExampleJoiner):
                 required_item_count = self._max_window_size
             self._consume_item_until_count(
                     visitor, join_window,
-                    required_item_count, join_cache
+                    required_item_count
                 )
             if join_window.forward_pt():
                 return True
         return join_window.size() >= self._max_window_size
 
-    def _evict_if_useless(self, item):
-        return item.example_id in self._joined_cache or \
-                self._leader_join_window.committed_pt() is None or \
-                _CmpCtnt(item) < self._leader_join_window.committed_pt()
-
-    def _evict_if_force(self, item):
-        return self._leader_join_window.qt() is None or \
-                _CmpCtnt(item) < self._leader_join_window.qt()
-
-    def _evict_impl(self, candidates, filter_fn):
-        reserved_items = []
-        for (index, item) in candidates:
-            example_id = item.example_id
-            if filter_fn(item):
-                self._follower_example_cache.pop(example_id, None)
-            else:
-                reserved_items.append((index, item))
-        return reserved_items
+    def _evict_if_useless(self):
+        # follower items joined or ranked before committed pt of leader
+        window = self._follower_join_window
+        committed_pt = self._leader_join_window.committed_pt()
+        if committed_pt is None:
+            return np.ones(window.size(), dtype=bool)
+        mask = window.before(committed_pt)
+        if len(self._joined_hashes) > 0:
+            cands = np.flatnonzero(~mask & np.isin(window.hashes,
+                                                   self._joined_hashes))
+            mask[cands] = [eid in self._joined_cache
+                           for eid in window.example_ids(cands)]
+        return mask
+
+    def _evict_if_force(self):
+        window = self._follower_join_window
+        leader_qt = self._leader_join_window.qt()
+        if leader_qt is None:
+            return np.ones(window.size(), dtype=bool)
+        return window.before(leader_qt)
 
     def _evit_stale_follower_cache(self):
         start_tm = time.time()
-        reserved_items = self._evict_impl(self._follower_join_window,
-                                          self._evict_if_useless)
-        if len(reserved_items) < self._max_window_size:
-            self._follower_join_window.reset(reserved_items, False)
+        window = self._follower_join_window
+        evict_mask = self._evict_if_useless()
+        if window.size() - np.count_nonzero(evict_mask) < \
+                self._max_window_size:
+            window.evict(evict_mask)
             return
-        reserved_items = self._evict_impl(reserved_items,
-                                          self._evict_if_force)
-        self._follower_join_window.reset(reserved_items, False)
+        window.evict(evict_mask | self._evict_if_force())
         metrics.emit_timer(name='stream_joiner_evit_stale_follower_cache',
                            value=int(time.time()-start_tm),
                            tags=self._metrics_tags)
 
     def _consume_item_until_count(self, visitor, windows,
-                                  required_item_count, cache=None):
-        for (index, item) in visitor:
-            if item.example_id == common.InvalidExampleId:
+                                  required_item_count):
+        # consume one item at least as iterating the visitor item by item
+        start_size = windows.size()
+        while windows.size() == start_size or \
+                windows.size() < required_item_count:
+            try:
+                begin_index, batch = visitor.next_batch(
+                        max(required_item_count - windows.size(), 1)
+                    )
+            except StopIteration:
+                assert visitor.finished(), "visitor shoud be finished of "\
+                                           "required_item is not satisfied"
+                return
+            offsets = None
+            if common.InvalidExampleId in batch.example_ids or \
+                    common.InvalidEventTime in batch.event_times:
+                offsets = self._valid_offsets(visitor, begin_index, batch)
+            windows.append_batch(begin_index, batch, offsets)
+
+    @staticmethod
+    def _valid_offsets(visitor, begin_index, batch):
+        offsets = []
+        for offset, (example_id, event_time) in \
+                enumerate(zip(batch.example_ids, batch.event_times)):
+            if example_id == common.InvalidExampleId:
                 logging.warning("ignore item indexed as %d from %s since "\
-                                "invalid example id", index, visitor.name())
-            elif item.event_time == common.InvalidEventTime:
+                                "invalid example id", begin_index + offset,
+                                visitor.name())
+            elif event_time == common.InvalidEventTime:
                 logging.warning("ignore item indexed as %d from %s since "\
-                                "invalid event time", index, visitor.name())
+                                "invalid event time", begin_index + offset,
+                                visitor.name())
             else:
-                windows.append(index, item)
-                if cache is not None:
-                    cache[item.example_id] = (index, item)
-                if windows.size() >= required_item_count:
-                    return
-        assert visitor.finished(), "visitor shoud be finished of "\
-                                   "required_item is not satisfied"
+                offsets.append(offset)
+        return offsets
 
     def _finish_data_block(self):
         meta = super(StreamExampleJoiner, self)._finish_data_block()
         self._follower_restart_index = self._follower_visitor.get_index()
         if self._follower_join_window.size() > 0:
             self._follower_restart_index = \
-                    self._follower_join_window[0][0]
+                    int(self._follower_join_window.indices[0])
         for index, _ in self._joined_cache.values():
             if index < self._follower_restart_index:
                 self._follower_restart_index = index
@@ -27,6 +27,11 @@ class OutputWriter(object):
     def close(self):
         raise NotImplementedError("close not implement for basic OutputBuilder")
 
+    def write_offset_index(self, fpath):
+        # write the sidecar offset index for the closed output which has
+        # been renamed to fpath, only for writers that support seeking
+        pass
+
     @property
     def fpath(self):
         return self._fpath
@@ -17,6 +17,7 @@
 import tensorflow.compat.v1 as tf
 
 from fedlearner.data_join.output_writer_impl.output_writer import OutputWriter
+from fedlearner.data_join.record_offset_index import RecordOffsetIndexBuilder
 
 class TfRecordBuilder(OutputWriter):
     def __init__(self, options, fpath):
@@ -25,9 +26,19 @@ class TfRecordBuilder(OutputWriter):
                 compression_type=options.compressed_type
             )
         self._writer = tf.io.TFRecordWriter(fpath, writer_options)
+        self._offset_index = None
+        if options.offset_index and not options.compressed_type:
+            self._offset_index = RecordOffsetIndexBuilder()
 
     def write_item(self, item):
-        self._writer.write(item.tf_record)
+        record = item.tf_record
+        self._writer.write(record)
+        if self._offset_index is not None:
+            self._offset_index.append_record(len(record))
+
+    def write_offset_index(self, fpath):
+        if self._offset_index is not None:
+            self._offset_index.dump(fpath)
 
     def close(self):
         self._writer.close()
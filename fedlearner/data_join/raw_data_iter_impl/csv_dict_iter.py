@@ -29,45 +29,57 @@ import fedlearner.data_join.common as common
 from fedlearner.data_join.raw_data_iter_impl.raw_data_iter import RawDataIter
 
 class CsvItem(RawDataIter.Item):
-    def __init__(self, raw):
+    def __init__(self, raw, headers=None):
+        # raw is a dict of a csv row, or the list of its fields if headers
+        # is given, which is zipped into a dict once it is asked for
         self._raw = raw
+        self._headers = headers
         self._tf_record = None
 
+    def _get_raw(self):
+        if self._headers is not None:
+            self._raw = OrderedDict(zip(self._headers, self._raw))
+            self._headers = None
+        return self._raw
+
     @property
     def example_id(self):
-        if 'example_id' not in self._raw:
+        raw = self._get_raw()
+        if 'example_id' not in raw:
             logging.error("Failed parse example id since no join "\
-                          "id in csv dict raw %s", self._raw)
+                          "id in csv dict raw %s", raw)
             return common.InvalidExampleId
-        return str(self._raw['example_id']).encode()
+        return str(raw['example_id']).encode()
 
     @property
     def event_time(self):
-        if 'event_time' in self._raw:
+        raw = self._get_raw()
+        if 'event_time' in raw:
             try:
-                return int(self._raw['event_time'])
+                return int(raw['event_time'])
             except Exception as e: # pylint: disable=broad-except
                 logging.error("Failed to parse event time as int type from "\
-                              "%s, reason: %s", self._raw['event_time'], e)
+                              "%s, reason: %s", raw['event_time'], e)
         return common.InvalidEventTime
 
     @property
     def raw_id(self):
-        if 'raw_id' not in self._raw:
+        raw = self._get_raw()
+        if 'raw_id' not in raw:
             logging.error("Failed parse raw id since no join "\
-                          "id in csv dict raw %s", self._raw)
+                          "id in csv dict raw %s", raw)
             return common.InvalidRawId
-        return str(self._raw['raw_id']).encode()
+        return str(raw['raw_id']).encode()
 
     @property
     def record(self):
-        return self._raw
+        return self._get_raw()
 
     @property
     def tf_record(self):
         if self._tf_record is None:
             try:
-                example = common.convert_dict_to_tf_example(self._raw)
+                example = common.convert_dict_to_tf_example(self._get_raw())
                 self._tf_record = example.SerializeToString()
             except Exception as e: # pylint: disable=broad-except
                 logging.error("Failed convert csv dict to tf example, "\
@@ -77,15 +89,75 @@ class CsvItem(RawDataIter.Item):
 
     @property
     def csv_record(self):
-        return self._raw
+        return self._get_raw()
 
     def set_example_id(self, example_id):
         new_raw = OrderedDict({'example_id': example_id})
-        new_raw.update(self._raw)
+        new_raw.update(self._get_raw())
         self._raw = new_raw
         if self._tf_record is not None:
             self._tf_record = None
 
+class CsvRecordBatch(RawDataIter.RecordBatch):
+    """Rows of a csv file split into lists of fields, sharing one header.
+    The key fields are read by column and the dict of a row is only built
+    when its CsvItem is asked for the whole record."""
+    def __init__(self, headers, rows, example_ids=None,
+                 event_times=None, raw_ids=None):
+        super(CsvRecordBatch, self).__init__(rows)
+        self._headers = headers
+        self._example_ids = example_ids
+        self._event_times = event_times
+        self._raw_ids = raw_ids
+
+    def get_item(self, offset):
+        return CsvItem(self._items[offset], self._headers)
+
+    def slice(self, begin, end):
+        def _slice(column):
+            return None if column is None else column[begin:end]
+        return CsvRecordBatch(self._headers, self._items[begin:end],
+                              _slice(self._example_ids),
+                              _slice(self._event_times),
+                              _slice(self._raw_ids))
+
+    def _column(self, name):
+        if name not in self._headers:
+            return None
+        col = self._headers.index(name)
+        return [row[col] for row in self._items]
+
+    @property
+    def example_ids(self):
+        if self._example_ids is None:
+            column = self._column('example_id')
+            if column is None:
+                return super(CsvRecordBatch, self).example_ids
+            self._example_ids = [value.encode() for value in column]
+        return self._example_ids
+
+    @property
+    def event_times(self):
+        if self._event_times is None:
+            column = self._column('event_time')
+            if column is None:
+                return super(CsvRecordBatch, self).event_times
+            try:
+                self._event_times = [int(value) for value in column]
+            except ValueError:
+                # some are invalid, leave them to be reported by item
+                return super(CsvRecordBatch, self).event_times
+        return self._event_times
+
+    @property
+    def raw_ids(self):
+        if self._raw_ids is None:
+            column = self._column('raw_id')
+            if column is None:
+                return super(CsvRecordBatch, self).raw_ids
+            self._raw_ids = [value.encode() for value in column]
+        return self._raw_ids
+
 class CsvDictIter(RawDataIter):
     def __init__(self, options):
         super(CsvDictIter, self).__init__(options)
@@ -96,33 +168,33 @@ class CsvDictIter(RawDataIter):
         return 'CSV_DICT'
 
     def _inner_iter(self, fpath):
-        with gfile.Open(fpath, 'r') as fh:
-            rest_buffer = []
-            aware_headers = True
+        with gfile.Open(fpath, 'rb') as fh:
+            rest_buffer = b''
+            headers = None
             read_finished = False
             while not read_finished:
-                dict_reader, rest_buffer, read_finished = \
-                        self._make_csv_dict_reader(fh, rest_buffer,
-                                                   aware_headers)
-                aware_headers = False
-                if self._headers is None:
-                    self._headers = dict_reader.fieldnames
-                elif self._headers != dict_reader.fieldnames:
-                    logging.fatal("the schema of %s is %s, mismatch "\
-                                  "with previous %s", fpath,
-                                  self._headers, dict_reader.fieldnames)
-                    traceback.print_stack()
-                    os._exit(-1) # pylint: disable=protected-access
-                for raw in dict_reader:
-                    yield CsvItem(raw)
-
-    def _make_csv_dict_reader(self, fh, rest_buffer, aware_headers):
+                str_buffer, rest_buffer, read_finished = \
+                        self._read_lines(fh, rest_buffer)
+                if headers is None:
+                    if len(str_buffer) == 0:
+                        continue
+                    idx = str_buffer.find('\n')
+                    if idx == -1:
+                        idx = len(str_buffer)
+                    headers = self._parse_headers(fpath, str_buffer[:idx])
+                    str_buffer = str_buffer[idx+1:]
+                batch = self._make_record_batch(headers, str_buffer)
+                if len(batch) > 0:
+                    yield batch
+
+    def _read_lines(self, fh, rest_buffer):
+        # return the decoded complete lines of the next chunk of file,
+        # the bytes of the partial line left and whether reach the end
         if self._options.read_ahead_size <= 0:
-            assert aware_headers
-            return csv.DictReader(fh), [], True
+            return (rest_buffer + fh.read()).decode(), b'', True
         read_buffer = fh.read(self._options.read_ahead_size)
         read_finished = len(read_buffer) < self._options.read_ahead_size
-        idx = read_buffer.rfind('\n')
+        idx = read_buffer.rfind(b'\n')
         if read_finished:
             idx = len(read_buffer) - 1
         elif idx == -1 and len(read_buffer) > 0:
@@ -130,15 +202,38 @@ class CsvDictIter(RawDataIter):
                           self._options.read_ahead_size)
             traceback.print_stack()
             os._exit(-1) # pylint: disable=protected-access
-        str_buffer = read_buffer[0:idx+1] if len(rest_buffer) == 0 \
-                        else rest_buffer+read_buffer[0:idx+1]
-        if aware_headers:
-            return csv.DictReader(io.StringIO(str_buffer)), \
-                    read_buffer[idx+1:], read_finished
-        assert self._headers is not None
-        return csv.DictReader(io.StringIO(str_buffer),
-                              fieldnames=self._headers), \
-                read_buffer[idx+1:], read_finished
+        str_buffer = (rest_buffer + read_buffer[0:idx+1]).decode()
+        return str_buffer, read_buffer[idx+1:], read_finished
+
+    def _parse_headers(self, fpath, line):
+        headers = next(csv.reader([line]), [])
+        if self._headers is None:
+            self._headers = headers
+        elif self._headers != headers:
+            logging.fatal("the schema of %s is %s, mismatch "\
+                          "with previous %s", fpath,
+                          self._headers, headers)
+            traceback.print_stack()
+            os._exit(-1) # pylint: disable=protected-access
+        return headers
+
+    @staticmethod
+    def _make_record_batch(headers, str_buffer):
+        # split the lines and fields by str.split if there is no quoted
+        # field or line break other than \n and \r\n, otherwise by csv
+        # module
+        lines = str_buffer
+        if '\r' in lines:
+            lines = lines.replace('\r\n', '\n')
+        if '"' not in lines and '\r' not in lines:
+            rows = [line.split(',') for line in lines.split('\n')
+                    if len(line) > 0]
+            field_num = len(headers)
+            if all(len(row) == field_num for row in rows):
+                return CsvRecordBatch(headers, rows)
+        dict_reader = csv.DictReader(io.StringIO(str_buffer),
+                                     fieldnames=headers)
+        return RawDataIter.RecordBatch([CsvItem(raw) for raw in dict_reader])
 
     def _reset_iter(self, index_meta):
         if index_meta is not None:
@@ -16,6 +16,8 @@
 
 import logging
 
+from fedlearner.data_join.record_offset_index import find_checkpoint
+
 class RawDataIter(object):
     class Item(object):
         @property
@@ -48,6 +50,48 @@ class RawDataIter(object):
                     "csv_record not implement for basic Item"
                 )
 
+    class RecordBatch(object):
+        """Consecutive items of one raw data file, with their example ids,
+        event times and raw ids as parallel lists. Subclasses may fill the
+        lists directly from the records and only create an Item when one
+        is asked for by get_item."""
+        def __init__(self, items):
+            self._items = items
+            self._example_ids = None
+            self._event_times = None
+            self._raw_ids = None
+
+        def __len__(self):
+            return len(self._items)
+
+        def __iter__(self):
+            for offset in range(len(self)):
+                yield self.get_item(offset)
+
+        def get_item(self, offset):
+            return self._items[offset]
+
+        def slice(self, begin, end):
+            return RawDataIter.RecordBatch(self._items[begin:end])
+
+        @property
+        def example_ids(self):
+            if self._example_ids is None:
+                self._example_ids = [item.example_id for item in self]
+            return self._example_ids
+
+        @property
+        def event_times(self):
+            if self._event_times is None:
+                self._event_times = [item.event_time for item in self]
+            return self._event_times
+
+        @property
+        def raw_ids(self):
+            if self._raw_ids is None:
+                self._raw_ids = [item.raw_id for item in self]
+            return self._raw_ids
+
     def __init__(self, options):
         self._fiter = None
         self._index_meta = None
@@ -55,6 +99,10 @@ class RawDataIter(object):
         self._index = None
         self._iter_failed = False
         self._options = options
+        self._pending_batch = None
+        self._pending_offset = 0
+        self._offset_index = None
+        self._offset_index_loaded = False
 
     def reset_iter(self, index_meta=None, force=False):
         if index_meta != self._index_meta or self._iter_failed or force:
@@ -62,7 +110,9 @@ class RawDataIter(object):
             self._index_meta = None
             self._item = None
             self._index = None
-            self._fiter, self._item = self._reset_iter(index_meta)
+            self._offset_index = None
+            self._offset_index_loaded = False
+            self._set_fiter(*self._reset_iter(index_meta))
             self._index_meta = index_meta
             self._index = None if index_meta is None \
                     else index_meta.start_index
@@ -78,12 +128,13 @@ class RawDataIter(object):
         try:
             if self._index == target_index:
                 return
-            if self._iter_failed or self._index > target_index:
+            if not self._seek_by_offset_index(target_index) and \
+                    (self._iter_failed or self._index > target_index):
                 self.reset_iter(self._index_meta, True)
-            if self._index < target_index:
-                for index, _ in self:
-                    if index == target_index:
-                        return
+            while self._index < target_index:
+                self.next_batch(target_index - self._index)
+        except StopIteration:
+            return
         except Exception as e: # pylint: disable=broad-except
             logging.warning(
                     "Failed to seek file %s to index %d, reason %s",
@@ -121,6 +172,29 @@ class RawDataIter(object):
     def next(self):
         return self.__next__()
 
+    def next_batch(self, max_size):
+        """Return the index of the first item and a RecordBatch of at most
+        max_size items following the current one."""
+        self._check_valid()
+        if self._iter_failed:
+            self.seek_to_target(self._index)
+        try:
+            batch = self._next_batch(max_size)
+        except StopIteration:
+            logging.debug("file %s is EOF", self._index_meta.fpath)
+            raise
+        except Exception as e: # pylint: disable=broad-except
+            logging.warning(
+                    "Failed to next batch iter %s from %d, reason %s",
+                    self._index_meta.fpath, self._index + 1, e
+                )
+            self._iter_failed = True
+            raise
+        begin_index = self._index + 1
+        self._index += len(batch)
+        self._item = batch.get_item(len(batch) - 1)
+        return begin_index, batch
+
     def get_index(self):
         self._check_valid()
         return self._index
@@ -135,9 +209,100 @@ class RawDataIter(object):
                 RawDataIter.name()
             )
 
+    def _load_offset_index(self, index_meta):
+        # the RecordOffsetIndex of the file if the iter could start at a
+        # byte offset of it by _reset_iter_at_offset
+        return None
+
+    def _reset_iter_at_offset(self, index_meta, offset):
+        raise NotImplementedError(
+                "_reset_iter_at_offset not implement for class %s" %
+                RawDataIter.name()
+            )
+
+    def _seek_by_offset_index(self, target_index):
+        # jump to the nearest checkpoint before target_index, return False
+        # if there is no such checkpoint after current index
+        if not self._offset_index_loaded:
+            self._offset_index = self._load_offset_index( # pylint: disable=assignment-from-none
+                    self._index_meta
+                )
+            self._offset_index_loaded = True
+        if self._offset_index is None:
+            return False
+        start_index = self._index_meta.start_index
+        checkpoint = find_checkpoint(self._offset_index,
+                                     target_index - start_index)
+        if checkpoint is None:
+            return False
+        index = start_index + checkpoint[0]
+        if not self._iter_failed and self._index <= target_index and \
+                index <= self._index:
+            return False
+        self._fiter = None
+        self._set_fiter(*self._reset_iter_at_offset(self._index_meta,
+                                                    checkpoint[1]))
+        self._index = index
+        self._iter_failed = False
+        logging.debug("jump to index %d at offset %d of file %s",
+                      index, checkpoint[1], self._index_meta.fpath)
+        return True
+
+    def _set_fiter(self, fiter, item):
+        self._fiter = fiter
+        self._item = item
+        self._pending_batch = None
+        self._pending_offset = 0
+        if isinstance(item, RawDataIter.RecordBatch):
+            self._pending_batch = item
+            self._item = item.get_item(0)
+            self._advance_pending_batch(1)
+
     def _next(self):
         assert self._fiter is not None, "_fiter must be not None in _next"
-        return next(self._fiter)
+        if self._pending_batch is not None:
+            item = self._pending_batch.get_item(self._pending_offset)
+            self._advance_pending_batch(1)
+            return item
+        item = next(self._fiter)
+        if isinstance(item, RawDataIter.RecordBatch):
+            self._pending_batch = item
+            return self._next()
+        return item
+
+    def _next_batch(self, max_size):
+        # _fiter may yield Items or RecordBatches, consecutive Items are
+        # gathered into one RecordBatch
+        assert self._fiter is not None, \
+                "_fiter must be not None in _next_batch"
+        assert max_size > 0, "max_size must be positive"
+        if self._pending_batch is not None:
+            begin = self._pending_offset
+            end = min(begin + max_size, len(self._pending_batch))
+            batch = self._pending_batch.slice(begin, end)
+            self._advance_pending_batch(end - begin)
+            return batch
+        item = next(self._fiter)
+        if isinstance(item, RawDataIter.RecordBatch):
+            self._pending_batch = item
+            return self._next_batch(max_size)
+        items = [item]
+        while len(items) < max_size:
+            try:
+                item = next(self._fiter)
+            except StopIteration:
+                break
+            if isinstance(item, RawDataIter.RecordBatch):
+                self._pending_batch = item
+                break
+            items.append(item)
+        return RawDataIter.RecordBatch(items)
+
+    def _advance_pending_batch(self, size):
+        self._pending_offset += size
+        if self._pending_offset >= len(self._pending_batch):
+            self._pending_batch = None
+            self._pending_offset = 0
 
     def _check_valid(self):
         assert self._fiter is not None
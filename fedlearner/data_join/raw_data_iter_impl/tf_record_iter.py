@@ -21,17 +21,166 @@ import tensorflow.compat.v1 as tf
 
 import fedlearner.data_join.common as common
 from fedlearner.data_join.raw_data_iter_impl.raw_data_iter import RawDataIter
+from fedlearner.data_join.record_offset_index import (
+    load_record_offset_index, iter_tf_records
+)
+
+KEY_FIELDS = (b'example_id', b'event_time', b'raw_id')
+
+def _read_varint(buf, pos):
+    byte = buf[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def _read_length_delimited(buf, pos, tag):
+    # return (begin, end) of the length-delimited field starting at pos
+    if buf[pos] != tag:
+        raise ValueError('unexpected tag %d, expect %d'%(buf[pos], tag))
+    length, begin = _read_varint(buf, pos + 1)
+    if begin + length > len(buf):
+        raise ValueError('truncated field')
+    return begin, begin + length
+
+def extract_tf_example_fields(record, keys=KEY_FIELDS):
+    """Return the serialized tf.train.Feature of each of keys found in a
+    serialized tf.train.Example, by scanning the wire format instead of
+    parsing the whole example. As with a full parse, the last entry wins if
+    a key is repeated. Raise ValueError if the record is not laid out as
+    tf serializes examples, e.g. with a map value before its key."""
+    features = {}
+    key_lens = set(len(key) for key in keys)
+    pos, end = 0, len(record)
+    while pos < end:
+        # Example.features = 1
+        begin, pos = _read_length_delimited(record, pos, 0x0a)
+        while begin < pos:
+            # Features.feature = 1, map entries of key = 1, value = 2.
+            # the hot loop, only entries with a wanted key length are
+            # looked into
+            if record[begin] != 0x0a:
+                raise ValueError('unexpected tag of map entry')
+            length = record[begin + 1]
+            if length < 0x80:
+                entry_begin = begin + 2
+            else:
+                length, entry_begin = _read_varint(record, begin + 1)
+            begin = entry_begin + length
+            if begin > pos:
+                raise ValueError('truncated map entry')
+            if entry_begin == begin:
+                # empty entry, key is ''
+                continue
+            if record[entry_begin] != 0x0a:
+                raise ValueError('map entry does not start with its key')
+            if record[entry_begin + 1] not in key_lens:
+                continue
+            key_begin, key_end = _read_length_delimited(
+                record, entry_begin, 0x0a)
+            if key_end > begin:
+                raise ValueError('truncated map key')
+            key = record[key_begin:key_end]
+            if key in keys:
+                if key_end == begin:
+                    features[key] = b''
+                else:
+                    value_begin, value_end = _read_length_delimited(
+                        record, key_end, 0x12)
+                    if value_end != begin:
+                        raise ValueError('unexpected map value')
+                    features[key] = record[value_begin:value_end]
+    return features
+
+def _feature_first_value(feature):
+    # return kind and first value of a serialized tf.train.Feature
+    if not feature:
+        return None, None
+    kind = feature[0]
+    begin, end = _read_length_delimited(feature, 0, kind)
+    if kind == 0x0a:
+        if begin == end:
+            raise IndexError('empty bytes_list')
+        value_begin, value_end = _read_length_delimited(feature, begin, 0x0a)
+        return 'bytes_list', feature[value_begin:value_end]
+    if kind == 0x1a:
+        if begin == end:
+            raise IndexError('empty int64_list')
+        if feature[begin] == 0x0a:
+            # packed
+            begin, _ = _read_length_delimited(feature, begin, 0x0a)
+        elif feature[begin] == 0x08:
+            begin += 1
+        else:
+            raise ValueError('invalid int64_list')
+        value, _ = _read_varint(feature, begin)
+        if value >= 1 << 63:
+            value -= 1 << 64
+        return 'int64_list', value
+    if kind == 0x12:
+        return 'float_list', None
+    raise ValueError('invalid feature kind %d'%kind)
 
 class TfExampleItem(RawDataIter.Item):
-    def __init__(self, record_str):
+    def __init__(self, record_str, key_fields=None):
         self._record_str = record_str
         self._parse_example_error = False
-        example = self._parse_example()
-        self._example_id = self._parse_example_id(example, record_str)
-        self._event_time = self._parse_event_time(example, record_str)
-        self._raw_id = self._parse_raw_id(example, record_str)
         self._csv_record = None
-        self._gc_example(example)
+        if key_fields is None:
+            key_fields = self._parse_key_fields(record_str)
+        self._example_id, self._event_time, self._raw_id = key_fields
+
+    @property
+    def key_fields(self):
+        return self._example_id, self._event_time, self._raw_id
+
+    @classmethod
+    def scan_key_fields(cls, record_str):
+        features = extract_tf_example_fields(record_str)
+        return (cls._decode_bytes_feature(features, b'example_id',
+                                          common.InvalidExampleId),
+                cls._decode_event_time(features),
+                cls._decode_bytes_feature(features, b'raw_id',
+                                          common.InvalidRawId))
+
+    def _parse_key_fields(self, record_str):
+        try:
+            return self.scan_key_fields(record_str)
+        except Exception: # pylint: disable=broad-except
+            # unusual or malformed record, the full parse handles and
+            # reports it as before
+            example = self._parse_example()
+            key_fields = (self._parse_example_id(example, record_str),
+                          self._parse_event_time(example, record_str),
+                          self._parse_raw_id(example, record_str))
+            self._gc_example(example)
+            return key_fields
+
+    @staticmethod
+    def _decode_bytes_feature(features, key, default):
+        if key not in features:
+            return default
+        kind, value = _feature_first_value(features[key])
+        if kind != 'bytes_list':
+            raise ValueError('%s is not bytes_list'%key)
+        return value
+
+    @staticmethod
+    def _decode_event_time(features):
+        if b'event_time' not in features:
+            return common.InvalidEventTime
+        kind, value = _feature_first_value(features[b'event_time'])
+        if kind == 'int64_list':
+            return value
+        if kind == 'bytes_list':
+            return int(value)
+        raise ValueError('event_time not support %s'%kind)
 
     @property
     def example_id(self):
@@ -155,6 +304,40 @@ class TfExampleItem(RawDataIter.Item):
         del self._record_str
         del self._csv_record
 
+class TfRecordBatch(RawDataIter.RecordBatch):
+    def __init__(self, records, example_ids, event_times, raw_ids):
+        super(TfRecordBatch, self).__init__(records)
+        self._example_ids = example_ids
+        self._event_times = event_times
+        self._raw_ids = raw_ids
+
+    @classmethod
+    def from_records(cls, records):
+        example_ids, event_times, raw_ids = [], [], []
+        for record in records:
+            try:
+                example_id, event_time, raw_id = \
+                        TfExampleItem.scan_key_fields(record)
+            except Exception: # pylint: disable=broad-except
+                example_id, event_time, raw_id = \
+                        TfExampleItem(record).key_fields
+            example_ids.append(example_id)
+            event_times.append(event_time)
+            raw_ids.append(raw_id)
+        return cls(records, example_ids, event_times, raw_ids)
+
+    def get_item(self, offset):
+        return TfExampleItem(self._items[offset],
+                             (self._example_ids[offset],
+                              self._event_times[offset],
+                              self._raw_ids[offset]))
+
+    def slice(self, begin, end):
+        return TfRecordBatch(self._items[begin:end],
+                             self._example_ids[begin:end],
+                             self._event_times[begin:end],
+                             self._raw_ids[begin:end])
+
 class TfRecordIter(RawDataIter):
     @classmethod
     def name(cls):
@@ -184,11 +367,37 @@ class TfRecordIter(RawDataIter):
         if expt is not None:
             raise expt
 
-    def _inner_iter(self, fpath):
+    def _inner_iter(self, fpath, offset=0):
+        if offset > 0:
+            batch_size = self._options.read_batch_size if \
+                    self._options.read_batch_size > 0 else 1
+            records = []
+            for record in self._offset_record_iter(fpath, offset):
+                records.append(record)
+                if len(records) >= batch_size:
+                    yield TfRecordBatch.from_records(records)
+                    records = []
+            if len(records) > 0:
+                yield TfRecordBatch.from_records(records)
+            return
         with self._data_set(fpath) as data_set:
             for batch in iter(data_set):
-                for raw_data in batch.numpy():
-                    yield TfExampleItem(raw_data)
+                yield TfRecordBatch.from_records(list(batch.numpy()))
+
+    def _offset_record_iter(self, fpath, offset):
+        read_size = 1 << 20
+        if self._options is not None and self._options.read_ahead_size > 0:
+            read_size = self._options.read_ahead_size
+        return iter_tf_records(fpath, offset, read_size)
+
+    def _load_offset_index(self, index_meta):
+        if self._options is not None and self._options.compressed_type:
+            return None
+        return load_record_offset_index(index_meta.fpath)
+
+    def _reset_iter_at_offset(self, index_meta, offset):
+        fiter = self._inner_iter(index_meta.fpath, offset)
+        return fiter, next(fiter)
 
     def _reset_iter(self, index_meta):
         if index_meta is not None:
@@ -33,29 +33,41 @@ from fedlearner.data_join.item_batch_seq_processor import \
         ItemBatch, ItemBatchSeqProcessor
 from fedlearner.data_join.routine_worker import RoutineWorker
 from fedlearner.data_join.raw_data_visitor import FileBasedMockRawDataVisitor
+from fedlearner.data_join.raw_data_iter_impl.raw_data_iter import RawDataIter
 from fedlearner.data_join import common
 
 class RawDataBatch(ItemBatch):
     def __init__(self, begin_index):
         self._begin_index = begin_index
-        self._raw_datas = []
+        self._record_batches = []
+        self._size = 0
 
     @property
     def begin_index(self):
         return self._begin_index
 
+    @property
+    def record_batches(self):
+        return self._record_batches
+
     def __len__(self):
-        return len(self._raw_datas)
+        return self._size
 
     def __lt__(self, other):
         assert isinstance(other, RawDataBatch)
         return self.begin_index < other.begin_index
 
     def __iter__(self):
-        return iter(self._raw_datas)
+        for record_batch in self._record_batches:
+            for item in record_batch:
+                yield item
 
     def append(self, item):
-        self._raw_datas.append(item)
+        self.append_batch(RawDataIter.RecordBatch([item]))
+
+    def append_batch(self, record_batch):
+        self._record_batches.append(record_batch)
+        self._size += len(record_batch)
 
 class RawDataBatchFetcher(ItemBatchSeqProcessor):
     def __init__(self, etcd, options):
@@ -89,16 +101,20 @@ class RawDataBatchFetcher(ItemBatchSeqProcessor):
         while not self._raw_data_visitor.finished() and \
                 not self._fly_item_full():
             next_batch = self._make_item_batch(next_index)
-            for (index, item) in self._raw_data_visitor:
+            while len(next_batch) < self._batch_size:
+                try:
+                    index, record_batch = self._raw_data_visitor.next_batch(
+                            self._batch_size - len(next_batch)
+                        )
+                except StopIteration:
+                    break
                 if index != next_index:
                     logging.fatal("batch raw data visitor is not consecutive, "\
                                   "%d != %d", index, next_index)
                     traceback.print_stack()
                     os._exit(-1) # pylint: disable=protected-access
-                next_batch.append(item)
-                next_index += 1
-                if len(next_batch) >= self._batch_size:
-                    break
+                next_batch.append_batch(record_batch)
+                next_index += len(record_batch)
             yield next_batch, self._raw_data_visitor.finished()
         yield self._make_item_batch(next_index), \
                 self._raw_data_visitor.finished()
@@ -171,7 +187,8 @@ class RawDataPartitioner(object):
         def finish(self):
             meta = None
             if self._writer is not None:
-                self._writer.close()
+                writer = self._writer
+                writer.close()
                 self._writer = None
                 meta = RawDataPartitioner.FileMeta(
                         self._options.partitioner_rank_id,
@@ -183,6 +200,7 @@ class RawDataPartitioner(object):
                                      common.partition_repr(self._partition_id),
                                      meta.encode_meta_to_fname())
                 gfile.Rename(self.get_tmp_fpath(), fpath, True)
+                writer.write_offset_index(fpath)
             return meta
 
         def get_tmp_fpath(self):
@@ -276,12 +294,16 @@ class RawDataPartitioner(object):
             fetch_finished, batch, hint_index = \
                     fetcher.fetch_item_batch_by_index(next_index, hint_index)
             if batch is not None:
-                for index, item in enumerate(batch):
-                    raw_id = getattr(item, self._part_field)
-                    partition_id = CityHash32(raw_id) % \
-                            self._options.output_partition_num
-                    writer = self._get_file_writer(partition_id)
-                    writer.append_item(batch.begin_index+index, item)
+                index = batch.begin_index
+                for record_batch in batch.record_batches:
+                    part_keys = self._get_part_keys(record_batch)
+                    for offset, part_key in enumerate(part_keys):
+                        partition_id = CityHash32(part_key) % \
+                                self._options.output_partition_num
+                        writer = self._get_file_writer(partition_id)
+                        writer.append_item(index + offset,
+                                           record_batch.get_item(offset))
+                    index += len(record_batch)
                 next_index += len(batch)
                 round_dumped_item += len(batch)
                 fly_item_cnt = fetcher.get_flying_item_count()
@@ -313,6 +335,13 @@ class RawDataPartitioner(object):
             logging.info("-----------------------------------")
         self._notify_part_finished()
 
+    def _get_part_keys(self, record_batch):
+        if self._part_field == 'example_id':
+            return record_batch.example_ids
+        if self._part_field == 'raw_id':
+            return record_batch.raw_ids
+        return [getattr(item, self._part_field) for item in record_batch]
+
     def _raw_data_part_cond(self):
         if self._is_part_finished():
             self._notify_part_finished()
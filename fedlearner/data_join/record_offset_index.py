@@ -0,0 +1,120 @@
+# Copyright 2020 The FedLearner Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# coding: utf-8
+
+import bisect
+import logging
+import os
+import struct
+
+import tensorflow_io # pylint: disable=unused-import
+from tensorflow.compat.v1 import gfile
+
+from fedlearner.common import data_join_service_pb2 as dj_pb
+from fedlearner.data_join.common import OffsetIndexSuffix, gen_tmp_fpath
+
+# a tfrecord is framed by a uint64 length and its crc32 ahead of the
+# data, and the crc32 of the data after it
+RecordHeaderSize = 12
+RecordFooterSize = 4
+
+def encode_offset_index_fpath(fpath):
+    return fpath + OffsetIndexSuffix
+
+class RecordOffsetIndexBuilder(object):
+    """Tracks the byte offset of each record written to an uncompressed
+    tfrecord file, keeping one checkpoint every interval items."""
+    def __init__(self, interval=1024):
+        self._interval = interval
+        self._item_num = 0
+        self._offset = 0
+        self._next_checkpoint = 0
+        self._index = dj_pb.RecordOffsetIndex()
+
+    def append_record(self, record_size, item_num=1):
+        if self._item_num >= self._next_checkpoint:
+            self._index.item_index.append(self._item_num)
+            self._index.offset.append(self._offset)
+            self._next_checkpoint = self._item_num + self._interval
+        self._item_num += item_num
+        self._offset += RecordHeaderSize + record_size + RecordFooterSize
+
+    def dump(self, fpath):
+        """write the index of the data file which has been renamed to fpath
+        as its sidecar file"""
+        self._index.file_size = self._offset
+        tmp_fpath = gen_tmp_fpath(os.path.dirname(fpath))
+        with gfile.GFile(tmp_fpath, 'wb') as fh:
+            fh.write(self._index.SerializeToString())
+        gfile.Rename(tmp_fpath, encode_offset_index_fpath(fpath), True)
+
+def load_record_offset_index(fpath):
+    """Return the RecordOffsetIndex of fpath, None if there is no usable
+    one, e.g. the file is not written with an index or rewritten since."""
+    index_fpath = encode_offset_index_fpath(fpath)
+    try:
+        if not gfile.Exists(index_fpath):
+            return None
+        index = dj_pb.RecordOffsetIndex()
+        with gfile.GFile(index_fpath, 'rb') as fh:
+            index.ParseFromString(fh.read())
+        file_size = gfile.Stat(fpath).length
+        if file_size != index.file_size:
+            logging.warning("ignore offset index of %s since file size "\
+                            "%d != %d(indexed)", fpath, file_size,
+                            index.file_size)
+            return None
+        return index
+    except Exception as e: # pylint: disable=broad-except
+        logging.warning("Failed to load offset index of %s, reason %s",
+                        fpath, e)
+    return None
+
+def find_checkpoint(index, item_index):
+    """return the last checkpoint (item_index, offset) not after the given
+    item index of the file"""
+    pos = bisect.bisect_right(index.item_index, item_index) - 1
+    if pos < 0:
+        return None
+    return index.item_index[pos], index.offset[pos]
+
+def iter_tf_records(fpath, offset, read_size=1<<20):
+    """Yield records of an uncompressed tfrecord file from byte offset.
+    The crc of records is not verified."""
+    with gfile.GFile(fpath, 'rb') as fh:
+        fh.seek(offset)
+        buf = b''
+        pos = 0
+        while True:
+            if len(buf) - pos < RecordHeaderSize:
+                buf = buf[pos:] + fh.read(read_size)
+                pos = 0
+                if len(buf) == 0:
+                    return
+                if len(buf) < RecordHeaderSize:
+                    raise IOError("truncated record header in {}"\
+                                  .format(fpath))
+            length, = struct.unpack_from('<Q', buf, pos)
+            data_begin = pos + RecordHeaderSize
+            record_end = data_begin + length + RecordFooterSize
+            if record_end > len(buf):
+                buf = buf[pos:] + fh.read(max(read_size, record_end - pos))
+                data_begin -= pos
+                record_end -= pos
+                pos = 0
+                if record_end > len(buf):
+                    raise IOError("truncated record in {}".format(fpath))
+            yield buf[data_begin:data_begin+length]
+            pos = record_end
@@ -51,6 +51,10 @@ class IdBatch(ItemBatch):
         self._raw_ids.append(item.raw_id)
         self._items.append(item)
 
+    def append_batch(self, record_batch):
+        self._raw_ids.extend(record_batch.raw_ids)
+        self._items.extend(record_batch)
+
     @property
     def raw_ids(self):
         return self._raw_ids
@@ -104,16 +108,20 @@ class IdBatchFetcher(ItemBatchSeqProcessor):
             id_visitor.seek(next_index - 1)
         while not id_visitor.finished() and not self._fly_item_full():
             next_batch = self._make_item_batch(next_index)
-            for (index, item) in id_visitor:
+            while len(next_batch) < self._batch_size:
+                try:
+                    index, record_batch = id_visitor.next_batch(
+                            self._batch_size - len(next_batch)
+                        )
+                except StopIteration:
+                    break
                 if index != next_index:
                     logging.fatal("index of id visitor is not consecutive, "\
                                   "%d != %d", index, next_index)
                     traceback.print_stack()
                     os._exit(-1) # pylint: disable=protected-access
-                next_batch.append(item)
-                next_index += 1
-                if len(next_batch) >= self._batch_size:
-                    break
+                next_batch.append_batch(record_batch)
+                next_index += len(record_batch)
             yield next_batch, id_visitor.finished()
         yield self._make_item_batch(next_index), id_visitor.finished()
 
@@ -98,6 +98,7 @@ class SortRunDumper(object):
                 fname = meta.encode_sort_run_fname()
                 self._fpath = path.join(self._output_dir, fname)
                 gfile.Rename(self._tmp_fpath, self._fpath, True)
+                self._writer.write_offset_index(self._fpath)
             return meta
 
         @property
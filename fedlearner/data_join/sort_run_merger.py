@@ -163,6 +163,7 @@ class SortRunMergerWriter(object):
             fname = meta.encode_merged_sort_run_fname()
             fpath = os.path.join(self._merged_dir, fname)
             gfile.Rename(self._tmp_fpath, fpath, True)
+            self._writer.write_offset_index(fpath)
             self._merged_fpaths.append(fpath)
             self._writer = None
             self._process_index += 1
@@ -20,6 +20,8 @@ import os
 import threading
 import traceback
 
+from fedlearner.data_join.raw_data_iter_impl.raw_data_iter import RawDataIter
+
 class IndexMeta(object):
     def __init__(self, process_index, start_index, fpath):
         self.process_index = process_index
@@ -174,6 +176,22 @@ class Visitor(object):
     def next(self):
         return self._next_internal()
 
+    def next_batch(self, max_size):
+        """Return the index of the first item and a RecordBatch of at most
+        max_size items following the current one. A batch never spans two
+        raw data files."""
+        if self._finished:
+            raise StopIteration()
+        if self._iter is not None:
+            try:
+                begin_index, batch = self._iter.next_batch(max_size)
+                self._update_visited_max_index()
+                return begin_index, batch
+            except StopIteration:
+                pass
+        index, item = self._next_internal()
+        return index, RawDataIter.RecordBatch([item])
+
     def _next_internal(self):
         if self._finished:
             raise StopIteration()
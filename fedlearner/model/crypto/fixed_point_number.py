@@ -87,6 +87,56 @@ class FixedPointNumber(object):
 
         return cls(int_fixpoint % n, exponent, n, max_int)
 
+    @classmethod
+    def encode_batch(cls, scalars, n=None, max_int=None, precision=None):
+        """return (encodings, exponents) of an array of ints or floats.
+           Same as calling encode on every element, but exponents and
+           scaling are computed with numpy.
+        """
+        scalars = np.asarray(scalars)
+        if n is None:
+            n = cls.Q
+            max_int = cls.Q // 3 - 1
+
+        if precision is not None:
+            exponents = np.full(
+                scalars.shape, math.floor(math.log(precision, cls.BASE)),
+                dtype=np.int64)
+        elif np.issubdtype(scalars.dtype, np.integer):
+            exponents = np.zeros(scalars.shape, dtype=np.int64)
+        elif np.issubdtype(scalars.dtype, np.floating):
+            flt_exponents = np.frexp(scalars)[1]
+            lsb_exponents = cls.FLOAT_MANTISSA_BITS - flt_exponents
+            exponents = np.floor(
+                lsb_exponents / cls.LOG2_BASE).astype(np.int64)
+            # too low values are encoded as int 0
+            exponents[np.abs(scalars) < 1e-200] = 0
+        else:
+            raise TypeError("Don't know the precision of type %s."
+                            % scalars.dtype)
+
+        if np.issubdtype(scalars.dtype, np.floating):
+            scalars = np.where(np.abs(scalars) < 1e-200, 0.0, scalars)
+
+        if np.issubdtype(scalars.dtype, np.integer):
+            int_fixpoints = [int(i) * pow(cls.BASE, int(e))
+                             for i, e in zip(scalars, exponents)]
+        else:
+            # BASE is a power of two, so the scaling is exact in float64
+            scaled = np.rint(
+                scalars.astype(np.float64) * np.power(
+                    float(cls.BASE), exponents.astype(np.float64)))
+            int_fixpoints = [int(i) for i in scaled]
+
+        encodings = []
+        for int_fixpoint in int_fixpoints:
+            if abs(int_fixpoint) > max_int:
+                raise ValueError('Integer needs to be within +/- %d but got %d'
+                                 % (max_int, int_fixpoint))
+            encodings.append(int_fixpoint % n)
+
+        return encodings, exponents
+
     def decode(self):
         """return decode plaintext.
         """
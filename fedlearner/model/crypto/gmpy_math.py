@@ -36,6 +36,20 @@ def powmod(a, b, c):
         return int(gmpy2.powmod(a, b, c))
 
 
+def mpz_powmod(a, b, c):
+    """
+    return gmpy2.mpz: (a ** b) % c, without converting back to int
+    """
+    return gmpy2.powmod(a, b, c)
+
+
+def mpz(a):
+    """
+    return gmpy2.mpz: a as a gmp integer, for fast repeated arithmetic
+    """
+    return gmpy2.mpz(a)
+
+
 def invert(a, b):
     """return int: x, where a * x == 1 mod b
     """    
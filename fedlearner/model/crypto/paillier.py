@@ -18,6 +18,8 @@
 # pylint: disable-all
 
 import random
+import collections
+import numpy as np
 
 from fedlearner.model.crypto.fixed_point_number import FixedPointNumber
 from fedlearner.model.crypto import gmpy_math 
@@ -103,6 +105,90 @@ class PaillierPublicKey(object):
 
         return encryptednumber
 
+    def encrypt_batch(self, values, precision=None, obfuscator_pool=None):
+        """Encode and Paillier encrypt an array of real numbers.
+           Obfuscators are taken from obfuscator_pool if given.
+        """
+        encodings, exponents = FixedPointNumber.encode_batch(
+            values, self.n, self.max_int, precision)
+        if obfuscator_pool is not None:
+            obfuscators = obfuscator_pool.get(len(encodings))
+        else:
+            obfuscators = _generate_obfuscators(
+                (self.n, self.nsquare, len(encodings)))
+
+        # (n + 1) ** m == n * m + 1 mod n ** 2 for every 0 <= m < n
+        return [
+            PaillierEncryptedNumber(
+                self, (self.n * m + 1) * r % self.nsquare, int(e))
+            for m, e, r in zip(encodings, exponents, obfuscators)]
+
+
+def _generate_obfuscators(args):
+    """return a list of count random r ** n mod n ** 2.
+    """
+    n, nsquare, count = args
+    rand = random.SystemRandom()
+    return [gmpy_math.powmod(rand.randrange(1, n), n, nsquare)
+            for _ in range(count)]
+
+
+class PaillierObfuscatorPool(object):
+    """Precomputes obfuscators r ** n for a public key in a process pool,
+       so that encryption only costs a modular multiplication. At most
+       max_size obfuscators are generated ahead of use.
+    """
+    def __init__(self, public_key, pool=None, chunk_size=1024,
+                 max_size=1<<18):
+        self._public_key = public_key
+        self._pool = pool
+        self._chunk_size = chunk_size
+        self._max_size = max_size
+        self._ready = collections.deque()
+        self._pending = collections.deque()
+        self._num_pending = 0
+
+    def __len__(self):
+        return len(self._ready) + self._num_pending
+
+    def refill(self, count):
+        """schedule count obfuscators to be generated in the background,
+           bounded by max_size.
+        """
+        self._schedule(min(count, self._max_size - len(self)))
+
+    def _schedule(self, count):
+        if self._pool is None:
+            return
+        for begin in range(0, count, self._chunk_size):
+            size = min(self._chunk_size, count - begin)
+            args = (self._public_key.n, self._public_key.nsquare, size)
+            self._pending.append(
+                self._pool.apply_async(_generate_obfuscators, (args,)))
+            self._num_pending += size
+
+    def get(self, count):
+        """return count obfuscators, each of them is only used once.
+        """
+        if len(self) < count:
+            self._schedule(count - len(self))
+
+        ret = []
+        while len(ret) < count:
+            if self._ready:
+                num = min(count - len(ret), len(self._ready))
+                ret.extend(self._ready.popleft() for _ in range(num))
+            elif self._pending:
+                obfuscators = self._pending.popleft().get()
+                self._num_pending -= len(obfuscators)
+                self._ready.extend(obfuscators)
+            else:
+                ret.extend(_generate_obfuscators(
+                    (self._public_key.n, self._public_key.nsquare,
+                     count - len(ret))))
+
+        return ret
+
 
 class PaillierPrivateKey(object):
     """Contains a private key and associated decryption method.
@@ -174,6 +260,48 @@ class PaillierPrivateKey(object):
 
         return self.crt(mp, mq)
 
+    def raw_decrypt_batch(self, ciphertexts):
+        """return raw plaintexts of a list of int ciphertexts.
+           Same as calling raw_decrypt on every element, but keeps all
+           arithmetic in gmp integers.
+        """
+        p, q = gmpy_math.mpz(self.p), gmpy_math.mpz(self.q)
+        psquare, qsquare = gmpy_math.mpz(self.psquare), gmpy_math.mpz(self.qsquare)
+        hp, hq = gmpy_math.mpz(self.hp), gmpy_math.mpz(self.hq)
+        q_inverse = gmpy_math.mpz(self.q_inverse)
+
+        plaintexts = []
+        for ciphertext in ciphertexts:
+            ciphertext = gmpy_math.mpz(ciphertext)
+            mp = (gmpy_math.mpz_powmod(ciphertext, p - 1, psquare) - 1) \
+                // p * hp % p
+            mq = (gmpy_math.mpz_powmod(ciphertext, q - 1, qsquare) - 1) \
+                // q * hq % q
+            # crt, mq + u * q is already less than n
+            u = (mp - mq) * q_inverse % p
+            plaintexts.append(int(mq + u * q))
+
+        return plaintexts
+
+    def decrypt_batch(self, ciphertexts, exponents):
+        """return the decrypted & decoded plaintexts of a list of int
+           ciphertexts, exponents is an int or an array of ints.
+        """
+        n = self.public_key.n
+        max_int = self.public_key.max_int
+        mantissas = []
+        for encoding in self.raw_decrypt_batch(ciphertexts):
+            if encoding <= max_int:
+                mantissas.append(float(encoding))
+            elif encoding >= n - max_int:
+                mantissas.append(float(encoding - n))
+            else:
+                raise OverflowError('Overflow detected in decode number')
+
+        scales = np.power(float(FixedPointNumber.BASE),
+                          -np.asarray(exponents, dtype=np.float64))
+        return np.asarray(mantissas, dtype=np.float64) * scales
+
     def decrypt(self, encrypted_number):
         """return the decrypted & decoded plaintext of encrypted_number.
         """
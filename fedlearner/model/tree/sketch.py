@@ -0,0 +1,101 @@
+# Copyright 2020 The FedLearner Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# coding: utf-8
+
+import numpy as np
+
+
+class QuantileSketch(object):
+    """Mergeable weighted quantile summary of a stream of values.
+
+    Keeps at most max_size (value, weight) pairs. Values are exact until
+    the number of distinct values exceeds max_size, after that rank error
+    of each prune is bounded by total_weight / max_size."""
+    def __init__(self, max_size=1024):
+        assert max_size >= 2, "max_size must be at least 2"
+        self._max_size = max_size
+        self._values = np.zeros(0, dtype=np.float64)
+        self._weights = np.zeros(0, dtype=np.float64)
+        self._is_exact = True
+
+    @property
+    def is_exact(self):
+        return self._is_exact
+
+    @property
+    def values(self):
+        return self._values
+
+    @property
+    def weights(self):
+        return self._weights
+
+    @property
+    def total_weight(self):
+        return self._weights.sum()
+
+    def __len__(self):
+        return self._values.size
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        values, counts = np.unique(values, return_counts=True)
+        self._merge(values, counts.astype(np.float64), True)
+
+    def merge(self, other):
+        self._merge(other.values, other.weights, other.is_exact)
+
+    def _merge(self, values, weights, is_exact):
+        values, inverse = np.unique(
+            np.concatenate([self._values, values]), return_inverse=True)
+        weights = np.bincount(
+            inverse, weights=np.concatenate([self._weights, weights]),
+            minlength=values.size)
+        self._values, self._weights = values, weights
+        self._is_exact = self._is_exact and is_exact
+        if self._values.size > self._max_size:
+            self._prune()
+
+    def _prune(self):
+        # keep values at evenly spaced ranks, every dropped value gives its
+        # weight to the nearest kept one
+        ranks = np.cumsum(self._weights) - self._weights * 0.5
+        targets = np.linspace(ranks[0], ranks[-1], num=self._max_size)
+        keep = np.unique(np.clip(
+            np.searchsorted(ranks, targets), 0, ranks.size - 1))
+        group = np.searchsorted(
+            (keep[:-1] + keep[1:]) * 0.5, np.arange(ranks.size),
+            side='right')
+        self._weights = np.bincount(
+            group, weights=self._weights, minlength=keep.size)
+        self._values = self._values[keep]
+        self._is_exact = False
+
+    def quantiles(self, qs):
+        if self._values.size == 0:
+            return np.full(np.shape(qs), np.nan)
+        ranks = np.cumsum(self._weights) - self._weights * 0.5
+        return np.interp(
+            np.asarray(qs, dtype=np.float64) * self._weights.sum(),
+            ranks, self._values)
+
+    def get_thresholds(self, max_bins):
+        """return at most max_bins - 1 split thresholds, same as exact
+        binning if the sketch still has all distinct values."""
+        if self._is_exact and self._values.size <= max_bins:
+            return (self._values[:-1] + self._values[1:]) * 0.5
+        percentiles = np.linspace(0, 1, num=max_bins + 1)[1:-1]
+        return self.quantiles(percentiles)
@@ -16,20 +16,27 @@
 
 import os
 import csv
+import json
 import queue
+import shutil
+import hashlib
 import logging
+import itertools
 import argparse
 import traceback
-import itertools
+import multiprocessing as mp
 import numpy as np
 
 import tensorflow.compat.v1 as tf
 
 from fedlearner.trainer.bridge import Bridge
-from fedlearner.model.tree.tree import BoostingTreeEnsamble
+from fedlearner.model.tree.tree import BoostingTreeEnsamble, BinnedFeatures
 from fedlearner.trainer.trainer_master_client import LocalTrainerMasterClient
 from fedlearner.trainer.trainer_master_client import DataBlockInfo
 
+# number of rows parsed into python objects at a time when loading data
+READ_CHUNK_SIZE = 65536
+
 
 def create_argument_parser():
     parser = argparse.ArgumentParser(
@@ -107,6 +114,11 @@ def create_argument_parser():
                         type=int,
                         default=33,
                         help='Max number of histogram bins.')
+    parser.add_argument('--binning-method',
+                        default='exact',
+                        choices=['exact', 'sketch'],
+                        help='Compute bin thresholds exactly or with '
+                             'mergeable quantile sketches.')
     parser.add_argument('--num-parallel',
                         type=int,
                         default=1,
@@ -130,6 +142,11 @@ def create_argument_parser():
                         type=bool,
                         default=False,
                         help='Whether to use streaming transmit.')
+    parser.add_argument('--transmit-window',
+                        type=int,
+                        default=1,
+                        help='Max number of messages in flight when not '
+                             'streaming, at most 8. 1 sends synchronously.')
     parser.add_argument('--send-scores-to-follower',
                         type=bool,
                         default=False,
@@ -138,6 +155,22 @@ def create_argument_parser():
                         type=bool,
                         default=False,
                         help='Whether to send metrics to follower.')
+    parser.add_argument('--enable-packing',
+                        type=bool,
+                        default=False,
+                        help='Whether to pack multiple histogram bins into '
+                             'one ciphertext. Only used by leader.')
+    parser.add_argument('--data-cache-path',
+                        type=str,
+                        default=None,
+                        help='Local directory to cache parsed and binned '
+                             'training data. Cache is reused until data '
+                             'files change.')
+    parser.add_argument('--predict-chunk-size',
+                        type=int,
+                        default=65536,
+                        help='Number of rows read and scored at a time in '
+                             'test and eval mode.')
 
     return parser
 
@@ -173,20 +206,78 @@ def extract_field(field_names, field_name, required):
     return None
 
 
+def _iter_csv_rows(filename):
+    with tf.io.gfile.GFile(filename, 'r') as fin:
+        for row in csv.reader(fin):
+            yield row
+
+
+def _open_data_file(file_type, filename):
+    # return field names, key of each field in a row and an iterator of rows
+    if file_type == 'tfrecord':
+        rows = (parse_tfrecord(record)
+                for record in tf.io.tf_record_iterator(filename))
+        first = next(rows, None)
+        if first is None:
+            return [], {}, iter([])
+        field_names = list(first.keys())
+        field_keys = {name: name for name in field_names}
+        return field_names, field_keys, itertools.chain([first], rows)
+
+    rows = _iter_csv_rows(filename)
+    field_names = next(rows, [])
+    field_keys = {name: i for i, name in enumerate(field_names)}
+    return field_names, field_keys, rows
+
+
+def _read_data_chunks(file_type, filename, require_example_ids,
+                      require_labels, ignore_fields, cat_fields):
+    # parse a file into a list of bounded chunks so that only one chunk
+    # of python rows is alive at a time
+    logging.debug('Reading data file from %s', filename)
+
+    reader = DataChunkReader(file_type, filename, require_example_ids,
+                             require_labels, ignore_fields, cat_fields)
+    chunks = [reader.read(READ_CHUNK_SIZE)]
+    while len(chunks[-1][0]) == READ_CHUNK_SIZE:
+        chunks.append(reader.read(READ_CHUNK_SIZE))
+    return chunks
+
+
+def _concat_chunks(chunks):
+    _, _, cont_columns, cat_columns, labels, example_ids, raw_ids = \
+        chunks[0]
+    for chunk in chunks[1:]:
+        assert cont_columns == chunk[2], \
+            "columns mismatch between files %s vs %s"%(
+                cont_columns, chunk[2])
+        assert cat_columns == chunk[3], \
+            "columns mismatch between files %s vs %s"%(
+                cat_columns, chunk[3])
+
+    # concatenate once into buffers of the final size
+    features = np.concatenate([chunk[0] for chunk in chunks], axis=0)
+    cat_features = np.concatenate([chunk[1] for chunk in chunks], axis=0)
+    if labels is not None:
+        labels = np.concatenate([chunk[4] for chunk in chunks], axis=0)
+    if example_ids is not None:
+        example_ids = [i for chunk in chunks for i in chunk[5]]
+    if raw_ids is not None:
+        raw_ids = [i for chunk in chunks for i in chunk[6]]
+
+    return features, cat_features, cont_columns, cat_columns, \
+        labels, example_ids, raw_ids
+
+
 def read_data(file_type, filename, require_example_ids,
               require_labels, ignore_fields, cat_fields):
-    logging.debug('Reading data file from %s', filename)
+    return _concat_chunks(_read_data_chunks(
+        file_type, filename, require_example_ids,
+        require_labels, ignore_fields, cat_fields))
 
-    if file_type == 'tfrecord':
-        reader = tf.io.tf_record_iterator(filename)
-        reader, tmp_reader = itertools.tee(reader)
-        first_line = parse_tfrecord(next(tmp_reader))
-        field_names = first_line.keys()
-    else:
-        fin = tf.io.gfile.GFile(filename, 'r')
-        reader = csv.DictReader(fin)
-        field_names = reader.fieldnames
 
+def _parse_rows(rows, field_names, field_keys, require_example_ids,
+                require_labels, ignore_fields, cat_fields):
     example_ids = extract_field(
         field_names, 'example_id', require_example_ids)
     raw_ids = extract_field(
@@ -207,35 +298,52 @@ def read_data(file_type, filename, require_example_ids,
         lambda x: x in cat_fields and x not in ignore_fields, field_names))
     cat_columns.sort(key=lambda x: x[1])
 
-    features = []
-    cat_features = []
-    for line in reader:
-        if file_type == 'tfrecord':
-            line = parse_tfrecord(line)
-        if example_ids is not None:
-            example_ids.append(str(line['example_id']))
-        if raw_ids is not None:
-            raw_ids.append(str(line['raw_id']))
-        if labels is not None:
-            labels.append(float(line['label']))
-        features.append([float(line[i]) for i in cont_columns])
-        cat_features.append([int(line[i]) for i in cat_columns])
-
-    features = np.array(features, dtype=np.float)
-    cat_features = np.array(cat_features, dtype=np.int32)
+    def column(name):
+        key = field_keys[name]
+        return [row[key] for row in rows]
+
+    # parse column by column into preallocated buffers
+    features = np.empty((len(rows), len(cont_columns)), dtype=np.float32)
+    for i, name in enumerate(cont_columns):
+        features[:, i] = column(name)
+    cat_features = np.empty((len(rows), len(cat_columns)), dtype=np.int32)
+    for i, name in enumerate(cat_columns):
+        cat_features[:, i] = column(name)
+    if example_ids is not None:
+        example_ids = [str(i) for i in column('example_id')]
+    if raw_ids is not None:
+        raw_ids = [str(i) for i in column('raw_id')]
     if labels is not None:
-        labels = np.asarray(labels, dtype=np.float)
+        labels = np.asarray(column('label'), dtype=np.float64)
 
     return features, cat_features, cont_columns, cat_columns, \
         labels, example_ids, raw_ids
 
 
-def read_data_dir(file_ext, file_type, path, require_example_ids,
-                  require_labels, ignore_fields, cat_fields):
+class DataChunkReader(object):
+    """Reads a data file a given number of rows at a time, in the same
+    format as read_data."""
+    def __init__(self, file_type, filename, require_example_ids,
+                 require_labels, ignore_fields, cat_fields):
+        logging.debug('Reading data file from %s in chunks', filename)
+        self._field_names, self._field_keys, self._rows = \
+            _open_data_file(file_type, filename)
+        self._params = (require_example_ids, require_labels,
+                        ignore_fields, cat_fields)
+
+    def read(self, num_rows):
+        rows = list(itertools.islice(self._rows, num_rows))
+        return _parse_rows(
+            rows, self._field_names, self._field_keys, *self._params)
+
+
+def _read_data_helper(args):
+    return _read_data_chunks(*args)
+
+
+def _list_data_files(file_ext, path):
     if not tf.io.gfile.isdir(path):
-        return read_data(
-            file_type, path, require_example_ids,
-            require_labels, ignore_fields, cat_fields)
+        return [path]
 
     files = []
     for dirname, _, filenames in tf.io.gfile.walk(path):
@@ -245,49 +353,157 @@ def read_data_dir(file_ext, file_type, path, require_example_ids,
                 continue
             subdirname = os.path.join(path, os.path.relpath(dirname, path))
             files.append(os.path.join(subdirname, filename))
+    return files
+
+
+def _data_cache_dir(cache_path, files, *params):
+    # parsed data is reused as long as no file is added, removed or modified
+    if not cache_path:
+        return None
+    stats = []
+    for filename in sorted(files):
+        stat = tf.io.gfile.stat(filename)
+        stats.append([filename, stat.length, stat.mtime_nsec])
+    key = hashlib.md5(
+        json.dumps([stats, list(params)]).encode()).hexdigest()
+    return os.path.join(cache_path, key)
+
+
+def _load_data_cache(dirname):
+    with open(os.path.join(dirname, 'columns.json'), 'r') as fin:
+        cont_columns, cat_columns = json.load(fin)
+
+    def load(name, mmap_mode=None):
+        filename = os.path.join(dirname, name + '.npy')
+        if not os.path.exists(filename):
+            return None
+        return np.load(filename, mmap_mode=mmap_mode)
+
+    features = load('features', mmap_mode='r')
+    cat_features = load('cat_features', mmap_mode='r')
+    labels = load('labels')
+    example_ids = load('example_ids')
+    if example_ids is not None:
+        example_ids = example_ids.tolist()
+    raw_ids = load('raw_ids')
+    if raw_ids is not None:
+        raw_ids = raw_ids.tolist()
+
+    return features, cat_features, cont_columns, cat_columns, \
+        labels, example_ids, raw_ids
+
+
+def _save_data_cache(dirname, features, cat_features, cont_columns,
+                     cat_columns, labels, example_ids, raw_ids):
+    tmp_dirname = '%s.tmp.%d'%(dirname, os.getpid())
+    os.makedirs(tmp_dirname, exist_ok=True)
+
+    def save(name, value):
+        if value is not None:
+            np.save(os.path.join(tmp_dirname, name + '.npy'),
+                    np.asarray(value))
+
+    save('features', features)
+    save('cat_features', cat_features)
+    save('labels', labels)
+    save('example_ids', example_ids)
+    save('raw_ids', raw_ids)
+    with open(os.path.join(tmp_dirname, 'columns.json'), 'w') as fout:
+        json.dump([cont_columns, cat_columns], fout)
+
+    try:
+        os.rename(tmp_dirname, dirname)
+    except OSError:
+        # another process finished writing the same cache first
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
 
-    features = None
-    for fullname in files:
-        ifeatures, icat_features, icont_columns, icat_columns, \
-            ilabels, iexample_ids, iraw_ids = read_data(
-                file_type, fullname, require_example_ids,
-                require_labels, ignore_fields, cat_fields
-            )
-        if features is None:
-            features = ifeatures
-            cat_features = icat_features
-            cont_columns = icont_columns
-            cat_columns = icat_columns
-            labels = ilabels
-            example_ids = iexample_ids
-            raw_ids = iraw_ids
-        else:
-            assert cont_columns == icont_columns, \
-                "columns mismatch between files %s vs %s"%(
-                    cont_columns, icont_columns)
-            assert cat_columns == icat_columns, \
-                "columns mismatch between files %s vs %s"%(
-                    cat_columns, icat_columns)
-            features = np.concatenate((features, ifeatures), axis=0)
-            cat_features = np.concatenate(
-                (cat_features, icat_features), axis=0)
-            if labels is not None:
-                labels = np.concatenate((labels, ilabels), axis=0)
-            if example_ids is not None:
-                example_ids.extend(iexample_ids)
-            if raw_ids is not None:
-                raw_ids.extend(iraw_ids)
-
-    assert features is not None, "No data found in %s"%path
+
+def read_data_dir(file_ext, file_type, path, require_example_ids,
+                  require_labels, ignore_fields, cat_fields,
+                  num_parallel=1, cache_path=None, pool=None):
+    # pool should be given once a bridge has connected, forking a new one
+    # alongside running grpc threads is not supported
+    files = _list_data_files(file_ext, path)
+    assert files, "No data found in %s"%path
+
+    cache_dir = _data_cache_dir(
+        cache_path, files, file_type, require_example_ids,
+        require_labels, ignore_fields, cat_fields)
+    if cache_dir and os.path.exists(cache_dir):
+        logging.info('Loading cached data from %s', cache_dir)
+        return _load_data_cache(cache_dir)
+
+    args = [(file_type, fullname, require_example_ids,
+             require_labels, ignore_fields, cat_fields)
+            for fullname in files]
+    if pool is not None and len(files) > 1:
+        rets = pool.map(_read_data_helper, args)
+    elif num_parallel > 1 and len(files) > 1:
+        pool = mp.Pool(min(num_parallel, len(files)))
+        rets = pool.map(_read_data_helper, args)
+        pool.close()
+        pool.join()
+    else:
+        rets = [_read_data_helper(i) for i in args]
+
+    features, cat_features, cont_columns, cat_columns, \
+        labels, example_ids, raw_ids = _concat_chunks(
+            [chunk for chunks in rets for chunk in chunks])
+    del rets
+
+    if cache_dir:
+        logging.info('Caching parsed data to %s', cache_dir)
+        _save_data_cache(
+            cache_dir, features, cat_features, cont_columns, cat_columns,
+            labels, example_ids, raw_ids)
 
     return features, cat_features, cont_columns, cat_columns, \
         labels, example_ids, raw_ids
 
 
+def load_binned_features(features, cat_features, max_bins, cache_dir=None,
+                         binning_method='exact', num_parallel=1, pool=None):
+    # like read_data_dir, pool should be given once a bridge has connected
+    def make_binned():
+        own_pool = None
+        if pool is None and num_parallel > 1:
+            own_pool = mp.Pool(num_parallel)
+        binned = BinnedFeatures(
+            features, max_bins, cat_features=cat_features,
+            binning_method=binning_method, num_parallel=num_parallel,
+            pool=pool or own_pool)
+        if own_pool:
+            own_pool.close()
+            own_pool.join()
+        return binned
+
+    if not cache_dir:
+        return make_binned()
+
+    binned_dir = os.path.join(
+        cache_dir, 'binned_%s_%d'%(binning_method, max_bins))
+    if os.path.exists(binned_dir):
+        logging.info('Loading binned features from %s', binned_dir)
+        return BinnedFeatures.load(binned_dir)
+
+    binned = make_binned()
+    logging.info('Caching binned features to %s', binned_dir)
+    binned.save(binned_dir)
+    return binned
+
+
 def train(args, booster):
     X, cat_X, X_names, cat_X_names, y, example_ids, _ = read_data_dir(
         args.file_ext, args.file_type, args.data_path, args.verify_example_ids,
-        args.role != 'follower', args.ignore_fields, args.cat_fields)
+        args.role != 'follower', args.ignore_fields, args.cat_fields,
+        args.num_parallel, args.data_cache_path, booster.pool)
+    binned = load_binned_features(
+        X, cat_X, args.max_bins, _data_cache_dir(
+            args.data_cache_path,
+            _list_data_files(args.file_ext, args.data_path),
+            args.file_type, args.verify_example_ids, args.role != 'follower',
+            args.ignore_fields, args.cat_fields),
+        args.binning_method, args.num_parallel, booster.pool)
 
     if args.validation_data_path:
         val_X, val_cat_X, val_X_names, val_cat_X_names, val_y, \
@@ -295,7 +511,8 @@ def train(args, booster):
             read_data_dir(
                 args.file_ext, args.file_type, args.validation_data_path,
                 args.verify_example_ids, args.role != 'follower',
-                args.ignore_fields, args.cat_fields)
+                args.ignore_fields, args.cat_fields,
+                args.num_parallel, args.data_cache_path, booster.pool)
         assert X_names == val_X_names, \
             "Train data and validation data must have same features"
         assert cat_X_names == val_cat_X_names, \
@@ -319,50 +536,136 @@ def train(args, booster):
         validation_example_ids=val_example_ids,
         output_path=args.output_path,
         feature_names=X_names,
-        cat_feature_names=cat_X_names)
+        cat_feature_names=cat_X_names,
+        binned_features=binned)
+
+
+class PredictionWriter(object):
+    """Appends predictions chunk by chunk to filename.tmp and renames it
+    to filename on close."""
+    def __init__(self, filename, has_example_ids, has_raw_ids):
+        self._filename = filename
+        logging.debug("Writing predictions to %s.tmp", filename)
+        headers = []
+        if has_example_ids:
+            headers.append('example_id')
+        if has_raw_ids:
+            headers.append('raw_id')
+        headers.append('prediction')
+        self._fout = tf.io.gfile.GFile(filename+'.tmp', 'w')
+        self._fout.write(','.join(headers) + '\n')
+
+    def write(self, pred, example_ids=None, raw_ids=None):
+        lines = []
+        if example_ids is not None:
+            lines.append(example_ids)
+        if raw_ids is not None:
+            lines.append(raw_ids)
+        lines.append(pred)
+        self._fout.write(''.join(
+            [','.join([str(i) for i in line]) + '\n'
+             for line in zip(*lines)]))
+
+    def close(self):
+        self._fout.close()
+        logging.debug("Renaming %s.tmp to %s", self._filename, self._filename)
+        tf.io.gfile.rename(
+            self._filename+'.tmp', self._filename, overwrite=True)
 
 
 def write_predictions(filename, pred, example_ids=None, raw_ids=None):
-    logging.debug("Writing predictions to %s.tmp", filename)
-    headers = []
-    lines = []
-    if example_ids is not None:
-        headers.append('example_id')
-        lines.append(example_ids)
-    if raw_ids is not None:
-        headers.append('raw_id')
-        lines.append(raw_ids)
-    headers.append('prediction')
-    lines.append(pred)
-    lines = zip(*lines)
+    writer = PredictionWriter(
+        filename, example_ids is not None, raw_ids is not None)
+    writer.write(pred, example_ids, raw_ids)
+    writer.close()
 
-    fout = tf.io.gfile.GFile(filename+'.tmp', 'w')
-    fout.write(','.join(headers) + '\n')
-    for line in lines:
-        fout.write(','.join([str(i) for i in line]) + '\n')
-    fout.close()
 
-    logging.debug("Renaming %s.tmp to %s", filename, filename)
-    tf.io.gfile.rename(filename+'.tmp', filename, overwrite=True)
+def _read_predict_chunk(args, bridge, reader):
+    # follower decides chunk boundaries since leader may have no data,
+    # leader reads the same rows and checks the example id range
+    if args.role == 'leader':
+        bridge.start(bridge.new_iter_id())
+        num_rows = int(bridge.receive(bridge.current_iter_id, 'chunk_size')[0])
+        id_range = bridge.receive(
+            bridge.current_iter_id, 'chunk_example_ids')
+        bridge.commit()
+        if num_rows == 0:
+            if reader is not None:
+                num_left = len(reader.read(1)[0])
+                assert num_left == 0, \
+                    "Follower finished but leader still has rows left"
+            return None
+        if reader is None:
+            return (None,)*7
+        chunk = reader.read(num_rows)
+        assert len(chunk[0]) == num_rows, \
+            "Leader has %d rows left but follower sent %d"%(
+                len(chunk[0]), num_rows)
+        example_ids = chunk[5]
+        if example_ids is not None and id_range.size > 0:
+            assert [example_ids[0].encode(), example_ids[-1].encode()] == \
+                list(id_range), \
+                "Example id range mismatch: %s-%s vs %s-%s"%(
+                    example_ids[0], example_ids[-1], id_range[0], id_range[1])
+        return chunk
+
+    chunk = reader.read(args.predict_chunk_size)
+    num_rows = len(chunk[0])
+    if args.role == 'follower':
+        example_ids = chunk[5]
+        if example_ids and num_rows:
+            id_range = np.asarray([example_ids[0], example_ids[-1]])
+        else:
+            id_range = np.asarray([], dtype=np.str_)
+        bridge.start(bridge.new_iter_id())
+        bridge.send(
+            bridge.current_iter_id, 'chunk_size', np.asarray([num_rows]))
+        bridge.send(bridge.current_iter_id, 'chunk_example_ids', id_range)
+        bridge.commit()
+    if num_rows == 0:
+        return None
+    return chunk
+
 
 def test_one_file(args, bridge, booster, data_file, output_file):
     if data_file is None:
-        X = cat_X = X_names = cat_X_names = y = example_ids = raw_ids = None
+        reader = None
     else:
-        X, cat_X, X_names, cat_X_names, y, example_ids, raw_ids = \
-            read_data(
-                args.file_type, data_file, args.verify_example_ids,
-                False, args.ignore_fields, args.cat_fields)
-
-    pred = booster.batch_predict(
-        X,
-        example_ids=example_ids,
-        cat_features=cat_X,
-        feature_names=X_names,
-        cat_feature_names=cat_X_names)
-
-    if y is not None:
-        metrics = booster.loss.metrics(pred, y)
+        reader = DataChunkReader(
+            args.file_type, data_file, args.verify_example_ids,
+            False, args.ignore_fields, args.cat_fields)
+
+    writer = None
+    # predictions are only kept alongside labels, the exact auc and ks
+    # of LogisticLoss.metrics need all of them at once
+    preds, labels = [], []
+    while True:
+        chunk = _read_predict_chunk(args, bridge, reader)
+        if chunk is None:
+            break
+        X, cat_X, X_names, cat_X_names, y, example_ids, raw_ids = chunk
+
+        pred = booster.batch_predict(
+            X,
+            example_ids=example_ids,
+            cat_features=cat_X,
+            feature_names=X_names,
+            cat_feature_names=cat_X_names)
+        if y is not None:
+            preds.append(pred)
+            labels.append(y)
+
+        if output_file:
+            if writer is None:
+                tf.io.gfile.makedirs(os.path.dirname(output_file))
+                writer = PredictionWriter(
+                    output_file, example_ids is not None,
+                    raw_ids is not None)
+            writer.write(pred, example_ids, raw_ids)
+
+    if labels:
+        metrics = booster.loss.metrics(
+            np.concatenate(preds), np.concatenate(labels))
     else:
         metrics = {}
     logging.info("Test metrics: %s", metrics)
@@ -373,8 +676,10 @@ def test_one_file(args, bridge, booster, data_file, output_file):
         bridge.commit()
 
     if output_file:
-        tf.io.gfile.makedirs(os.path.dirname(output_file))
-        write_predictions(output_file, pred, example_ids, raw_ids)
+        if writer is None:
+            tf.io.gfile.makedirs(os.path.dirname(output_file))
+            writer = PredictionWriter(output_file, False, False)
+        writer.close()
 
     if args.role == 'leader':
         bridge.start(bridge.new_iter_id())
@@ -504,10 +809,12 @@ def run(args):
     if args.role != 'local':
         bridge = Bridge(args.role, int(args.local_addr.split(':')[1]),
                         args.peer_addr, args.application_id, 0,
-                        streaming_mode=args.use_streaming)
+                        streaming_mode=args.use_streaming,
+                        transmit_window=args.transmit_window)
     else:
         bridge = None
 
+    booster = None
     try:
         booster = BoostingTreeEnsamble(
             bridge,
@@ -519,7 +826,9 @@ def run(args):
             num_parallel=args.num_parallel,
             loss_type=args.loss_type,
             send_scores_to_follower=args.send_scores_to_follower,
-            send_metrics_to_follower=args.send_metrics_to_follower)
+            send_metrics_to_follower=args.send_metrics_to_follower,
+            enable_packing=args.enable_packing,
+            binning_method=args.binning_method)
 
         if args.load_model_path:
             booster.load_saved_model(args.load_model_path)
@@ -537,6 +846,8 @@ def run(args):
             traceback.format_exc())
         raise e
     finally:
+        if booster:
+            booster.close()
         if bridge:
             bridge.terminate()
 
@@ -16,6 +16,7 @@
 
 import os
 import math
+import shutil
 import queue
 import time
 import logging
@@ -26,7 +27,8 @@ from google.protobuf import text_format
 import tensorflow.compat.v1 as tf
 
 from fedlearner.model.tree.loss import LogisticLoss, MSELoss
-from fedlearner.model.crypto import paillier, fixed_point_number
+from fedlearner.model.tree.sketch import QuantileSketch
+from fedlearner.model.crypto import paillier, fixed_point_number, gmpy_math
 from fedlearner.common import tree_model_pb2 as tree_pb2
 from fedlearner.common import common_pb2
 
@@ -39,6 +41,14 @@ KEY_NBITS = 1024
 CIPHER_NBYTES = (KEY_NBITS * 2)//8
 
 MAX_PARTITION_SIZE = 4096
+PREDICT_BLOCK_SIZE = 2**22
+# processes precomputing obfuscators on leader, at a lower priority than
+# the processes growing trees
+OBFUSCATOR_NUM_PROCESSES = 2
+OBFUSCATOR_NICENESS = 10
+
+SKETCH_SIZE = 4096
+SKETCH_CHUNK_SIZE = 65536
 
 
 def _send_public_key(bridge, public_key):
@@ -57,12 +67,10 @@ def _encode_encrypted_numbers(numbers):
         i.ciphertext(False).to_bytes(CIPHER_NBYTES, 'little') \
         for i in numbers]
 
-def _encrypt_numbers(public_key, numbers):
+def _encrypt_numbers(public_key, numbers, obfuscator_pool=None):
     return _encode_encrypted_numbers(
-        [public_key.encrypt(i, PRECISION) for i in numbers])
-
-def _decrypt_number(private_key, numbers):
-    return [private_key.decrypt(i) for i in numbers]
+        public_key.encrypt_batch(
+            numbers, PRECISION, obfuscator_pool=obfuscator_pool))
 
 def _from_ciphertext(public_key, ciphertext):
     return [
@@ -70,31 +78,83 @@ def _from_ciphertext(public_key, ciphertext):
             public_key, int.from_bytes(i, 'little'), EXPONENT)
         for i in ciphertext]
 
-def _encrypt_and_send_numbers(bridge, name, public_key, numbers):
-    num_parts = (len(numbers) + MAX_PARTITION_SIZE - 1)//MAX_PARTITION_SIZE
-    bridge.send_proto(
-        bridge.current_iter_id, '%s_partition_info'%name,
-        tree_pb2.PartitionInfo(num_partitions=num_parts)
-    )
-    for i in range(num_parts):
-        part = numbers[i*MAX_PARTITION_SIZE:(i+1)*MAX_PARTITION_SIZE]
-        msg = tree_pb2.EncryptedNumbers()
-        msg.ciphertext.extend(_encrypt_numbers(public_key, part))
-        bridge.send_proto(
-            bridge.current_iter_id, '%s_part_%d'%(name, i), msg)
+def _encrypt_and_send_numbers(bridge, name, public_key, numbers,
+                              obfuscator_pool=None):
+    # parts are encrypted lazily, overlapping with sending earlier ones
+    def parts():
+        for i in range(0, len(numbers), MAX_PARTITION_SIZE):
+            msg = tree_pb2.EncryptedNumbers()
+            msg.ciphertext.extend(_encrypt_numbers(
+                public_key, numbers[i:i+MAX_PARTITION_SIZE],
+                obfuscator_pool))
+            yield msg
+    bridge.send_stream(bridge.current_iter_id, name, parts())
 
 def _receive_encrypted_numbers(bridge, name, public_key):
-    part_info = tree_pb2.PartitionInfo()
-    bridge.receive_proto(
-        bridge.current_iter_id, '%s_partition_info'%name).Unpack(part_info)
     ret = []
-    for i in range(part_info.num_partitions):
+    for part in bridge.receive_stream(bridge.current_iter_id, name):
         msg = tree_pb2.EncryptedNumbers()
-        bridge.receive_proto(
-            bridge.current_iter_id, '%s_part_%d'%(name, i)).Unpack(msg)
+        part.Unpack(msg)
         ret.extend(_from_ciphertext(public_key, msg.ciphertext))
     return ret
 
+def _get_packing_slot_bits(public_key, grad, hess):
+    # every histogram bin is bounded by the sum of absolute values
+    max_sum = max(np.abs(np.asarray(grad, dtype=np.float64)).sum(),
+                  np.abs(np.asarray(hess, dtype=np.float64)).sum())
+    value_bits = int(math.ceil(math.log2(max_sum + 1))) + \
+        int(fixed_point_number.FixedPointNumber.LOG2_BASE) * EXPONENT
+    # one bit for the sign offset and one bit of headroom
+    slot_bits = value_bits + 2
+    if _get_num_slots(public_key, slot_bits) < 2:
+        return 0
+    return slot_bits
+
+def _get_num_slots(public_key, slot_bits):
+    # packed plaintext must stay below n
+    return (public_key.n.bit_length() - 1)//slot_bits
+
+def _pack_ciphertexts_helper(args):
+    ciphertexts, public_key, slot_bits, num_slots = args
+    n = gmpy_math.mpz(public_key.n)
+    nsquare = gmpy_math.mpz(public_key.nsquare)
+    shift = 1 << slot_bits
+    offset = 1 << (slot_bits - 2)
+    rets = []
+    for i in range(0, len(ciphertexts), num_slots):
+        packed = gmpy_math.mpz(1)
+        plain_offset = 0
+        for c in reversed(ciphertexts[i:i+num_slots]):
+            packed = gmpy_math.mpz(
+                gmpy_math.powmod(packed, shift, nsquare)) * c % nsquare
+            plain_offset = (plain_offset << slot_bits) + offset
+        # shift every slot by offset so that negative values unpack
+        # correctly, and re-randomize with a fresh r^n per ciphertext
+        packed = public_key.apply_obfuscator(
+            packed * (1 + n * plain_offset) % nsquare)
+        rets.append(int(packed).to_bytes(CIPHER_NBYTES, 'little'))
+    return rets
+
+def _decrypt_packed_histogram_helper(args):
+    private_key, ciphertexts, slot_bits, num_slots = args
+    mask = (1 << slot_bits) - 1
+    offset = 1 << (slot_bits - 2)
+    scale = float(fixed_point_number.FixedPointNumber.BASE)**(-EXPONENT)
+    rets = []
+    for plaintext in private_key.raw_decrypt_batch(
+            [int.from_bytes(c, 'little') for c in ciphertexts]):
+        for _ in range(num_slots):
+            rets.append(((plaintext & mask) - offset) * scale)
+            plaintext >>= slot_bits
+    return rets
+
+def _pack_mask(mask):
+    return np.packbits(mask).tobytes()
+
+def _unpack_mask(buf, size):
+    return np.unpackbits(
+        np.frombuffer(buf, dtype=np.uint8))[:size].astype(bool)
+
 def _get_dtype_for_max_value(max_value):
     if max_value < np.iinfo(np.int8).max:
         return np.int8
@@ -103,52 +163,150 @@ def _get_dtype_for_max_value(max_value):
     return np.int32
 
 
+def _compute_sketch_thresholds_helper(args):
+    features, max_bins = args
+    thresholds = []
+    for i in range(features.shape[1]):
+        x = features[:, i]
+        # sketch the column chunk by chunk, merging pairwise so that
+        # pruning errors only add up over log(#chunks) levels
+        sketches = []
+        for begin in range(0, x.shape[0], SKETCH_CHUNK_SIZE):
+            sketch = QuantileSketch(SKETCH_SIZE)
+            sketch.update(np.asarray(
+                x[begin:begin+SKETCH_CHUNK_SIZE], dtype=BST_TYPE))
+            sketches.append(sketch)
+        while len(sketches) > 1:
+            for left, right in zip(sketches[::2], sketches[1::2]):
+                left.merge(right)
+            sketches = sketches[::2]
+        if not sketches:
+            sketches.append(QuantileSketch(SKETCH_SIZE))
+        thresholds.append(
+            sketches[0].get_thresholds(max_bins).astype(BST_TYPE))
+    return thresholds
+
+
 class BinnedFeatures(object):
-    def __init__(self, features, max_bins, cat_features=None):
+    def __init__(self, features, max_bins, cat_features=None,
+                 binned=None, thresholds=None, binning_method='exact',
+                 num_parallel=1, pool=None):
         super(BinnedFeatures, self).__init__()
 
+        assert binning_method in ('exact', 'sketch'), \
+            "Invalid binning method %s"%binning_method
         self._max_bins = max_bins
+        self._binning_method = binning_method
+        self._num_parallel = num_parallel
+        self._pool = pool
+        # raw features are not needed once binned, they can be None when
+        # binned and thresholds are given
         self.features = features
-        self.binned, self.thresholds = self._bin_features(features)
+        if binned is None:
+            binned, thresholds = self._bin_features(features)
+        self.binned, self.thresholds = binned, thresholds
         self.num_bins = [len(i) + 2 for i in self.thresholds]
 
         if cat_features is None:
-            cat_features = np.zeros((features.shape[0], 0), dtype=np.int32)
+            cat_features = np.zeros((binned.shape[0], 0), dtype=np.int32)
         self.cat_features = cat_features
         self.cat_num_bins = [
             cat_features[:, i].max()+1 for i in range(cat_features.shape[1])]
 
-        self.num_features = self.features.shape[1]
+        self.num_samples = self.binned.shape[0]
+        self.num_features = self.binned.shape[1]
         self.num_cat_features = self.cat_features.shape[1]
         self.num_all_features = self.num_features + self.num_cat_features
 
+    @property
+    def max_bins(self):
+        return self._max_bins
+
+    @property
+    def binning_method(self):
+        return self._binning_method
+
+    def save(self, path):
+        """Saves thresholds and bins to a local directory, bins are
+        memory-mapped by load."""
+        tmp_path = '%s.tmp.%d'%(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        # np.save keeps the fortran order of binned
+        np.save(os.path.join(tmp_path, 'binned.npy'), self.binned)
+        np.save(os.path.join(tmp_path, 'cat_features.npy'),
+                np.asarray(self.cat_features))
+        np.savez(os.path.join(tmp_path, 'thresholds.npz'),
+                 *self.thresholds, max_bins=self._max_bins,
+                 binning_method=self._binning_method)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process finished saving first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with np.load(os.path.join(path, 'thresholds.npz')) as fin:
+            max_bins = int(fin['max_bins'])
+            binning_method = str(fin['binning_method'])
+            thresholds = [
+                fin['arr_%d'%i] for i in range(len(fin.files) - 2)]
+        binned = np.load(
+            os.path.join(path, 'binned.npy'), mmap_mode=mmap_mode)
+        cat_features = np.load(
+            os.path.join(path, 'cat_features.npy'), mmap_mode=mmap_mode)
+        return cls(None, max_bins, cat_features=cat_features,
+                   binned=binned, thresholds=thresholds,
+                   binning_method=binning_method)
+
     def _bin_features(self, features):
-        thresholds = []
+        if self._binning_method == 'sketch':
+            thresholds = self._compute_sketch_thresholds(features)
+        else:
+            thresholds = [
+                self._compute_exact_threshold(features[:, i])
+                for i in range(features.shape[1])]
+
         binned = np.zeros_like(features, dtype=np.uint8, order='F')
-        for i in range(features.shape[1]):
+        for i, threshold in enumerate(thresholds):
             x = features[:, i]
-            missing_mask = np.isnan(x)
-            nonmissing_x = x
-            if missing_mask.any():
-                nonmissing_x = x[~missing_mask]
-            nonmissing_x = np.ascontiguousarray(
-                nonmissing_x, dtype=BST_TYPE)
-            unique_x = np.unique(nonmissing_x)
-            if len(unique_x) <= self._max_bins:
-                threshold = (unique_x[:-1] + unique_x[1:]) * 0.5
-            else:
-                percentiles = np.linspace(0, 100, num=self._max_bins + 1)
-                percentiles = percentiles[1:-1]
-                threshold = np.percentile(
-                    nonmissing_x, percentiles, interpolation='midpoint')
-                assert threshold.size == self._max_bins - 1
-            thresholds.append(threshold)
-
             binned[:, i] = np.searchsorted(threshold, x, side='right')
-            binned[missing_mask, i] = threshold.size + 1
+            binned[np.isnan(x), i] = threshold.size + 1
 
         return binned, thresholds
 
+    def _compute_exact_threshold(self, x):
+        missing_mask = np.isnan(x)
+        nonmissing_x = x
+        if missing_mask.any():
+            nonmissing_x = x[~missing_mask]
+        nonmissing_x = np.ascontiguousarray(
+            nonmissing_x, dtype=BST_TYPE)
+        unique_x = np.unique(nonmissing_x)
+        if len(unique_x) <= self._max_bins:
+            threshold = (unique_x[:-1] + unique_x[1:]) * 0.5
+        else:
+            percentiles = np.linspace(0, 100, num=self._max_bins + 1)
+            percentiles = percentiles[1:-1]
+            threshold = np.percentile(
+                nonmissing_x, percentiles, interpolation='midpoint')
+            assert threshold.size == self._max_bins - 1
+        return threshold
+
+    def _compute_sketch_thresholds(self, features):
+        if not self._pool:
+            return _compute_sketch_thresholds_helper(
+                (features, self._max_bins))
+
+        job_size = \
+            (features.shape[1] + self._num_parallel - 1)//self._num_parallel
+        args = [
+            (features[:, job_size*i:job_size*(i+1)], self._max_bins)
+            for i in range(self._num_parallel)
+        ]
+        return sum(
+            self._pool.map(_compute_sketch_thresholds_helper, args), [])
+
 
 def _compute_histogram_helper(args):
     base, values, binned_features, num_bins, zero = args
@@ -162,6 +320,53 @@ def _compute_histogram_helper(args):
     return hists
 
 
+def _compute_fused_histogram_helper(args):
+    base, values, binned_features, num_bins, dtype = args
+    values = [np.asarray(i, dtype=np.float64) for i in values]
+    hists = [[] for _ in values]
+    for i, num in enumerate(num_bins):
+        logging.debug('Computing histogram for feature %d', base + i)
+        bins = binned_features[:, i]
+        for hist, value in zip(hists, values):
+            hist.append(np.bincount(
+                bins, weights=value, minlength=num).astype(dtype))
+
+    return hists
+
+
+def _compute_encrypted_histogram_helper(args):
+    base, values, binned_features, num_bins, (public_key, obfuscate) = args
+    nsquare = gmpy_math.mpz(public_key.nsquare)
+    hists = [[] for _ in values]
+    for i, num in enumerate(num_bins):
+        logging.debug(
+            'Computing encrypted histogram for feature %d', base + i)
+        bins = binned_features[:, i].tolist()
+        for hist, ciphertexts in zip(hists, values):
+            # 1 is the encryption of zero without obfuscator
+            bin_ciphertexts = [1] * num
+            for b, c in zip(bins, ciphertexts):
+                bin_ciphertexts[b] = bin_ciphertexts[b] * c % nsquare
+            # every bin gets its own random r^n, otherwise the leader who
+            # encrypted the samples could tell which of them share a bin
+            if obfuscate:
+                bin_ciphertexts = [
+                    public_key.apply_obfuscator(c) for c in bin_ciphertexts]
+            hist.append(bin_ciphertexts)
+
+    return hists
+
+
+def _take_rows(matrix, rows):
+    # gather column by column so that every feature of the result is
+    # contiguous, which is what the histogram kernels scan
+    ret = np.empty(
+        (len(rows), matrix.shape[1]), dtype=matrix.dtype, order='F')
+    for i in range(matrix.shape[1]):
+        np.take(matrix[:, i], rows, out=ret[:, i])
+    return ret
+
+
 class HistogramBuilder(object):
     def __init__(self, binned_features, dtype=BST_TYPE,
                  num_parallel=1, pool=None):
@@ -170,44 +375,124 @@ class HistogramBuilder(object):
         self._zero = dtype(0.0)
         self._num_parallel = num_parallel
         self._pool = pool
+        # plain float histograms can use the fused bincount kernel, other
+        # dtypes (e.g. encrypted numbers) are accumulated with np.add.at
+        self._is_fused = isinstance(dtype, type) and \
+            np.issubdtype(dtype, np.floating)
 
-    def compute_histogram(self, values, sample_ids):
+    def _make_jobs(self, values, sample_ids, extra):
         if not self._pool:
-            hists = _compute_histogram_helper(
-                (0, values[sample_ids], self._bins.binned[sample_ids],
-                 self._bins.num_bins, self._zero))
-            cat_hists = _compute_histogram_helper(
-                (self._bins.num_features, values[sample_ids],
-                 self._bins.cat_features[sample_ids],
-                 self._bins.cat_num_bins, self._zero))
-            return hists + cat_hists
-
-        num_jobs = self._num_parallel
+            num_jobs = 1
+        else:
+            num_jobs = self._num_parallel
         job_size = \
             (self._bins.num_features + num_jobs - 1)//num_jobs
         cat_job_size = \
             (self._bins.num_cat_features + num_jobs - 1)//num_jobs
-        args = [
+        return [
             (job_size*i,
-             values[sample_ids],
-             self._bins.binned[
-                 sample_ids, job_size*i:job_size*(i+1)],
+             values,
+             _take_rows(
+                 self._bins.binned[:, job_size*i:job_size*(i+1)],
+                 sample_ids),
              self._bins.num_bins[job_size*i:job_size*(i+1)],
-             self._zero)
-            for i in range(self._num_parallel)
+             extra)
+            for i in range(num_jobs)
         ] + [
             (self._bins.num_features + cat_job_size*i,
-             values[sample_ids],
-             self._bins.cat_features[
-                 sample_ids, cat_job_size*i:cat_job_size*(i+1)],
+             values,
+             _take_rows(
+                 self._bins.cat_features[
+                     :, cat_job_size*i:cat_job_size*(i+1)],
+                 sample_ids),
              self._bins.cat_num_bins[cat_job_size*i:cat_job_size*(i+1)],
-             self._zero)
-            for i in range(self._num_parallel)
+             extra)
+            for i in range(num_jobs)
         ]
 
-        rets = self._pool.map(_compute_histogram_helper, args)
+    def _map(self, func, args):
+        if not self._pool:
+            return [func(i) for i in args]
+        return self._pool.map(func, args)
+
+    def compute_histogram(self, values, sample_ids):
+        if self._is_fused:
+            return self.compute_histograms([values], sample_ids)[0]
+
+        sample_ids = np.asarray(sample_ids, dtype=np.int64)
+        args = self._make_jobs(values[sample_ids], sample_ids, self._zero)
+        rets = self._map(_compute_histogram_helper, args)
         return sum(rets, [])
 
+    def compute_histograms(self, values_list, sample_ids):
+        """Computes histograms for several value arrays (e.g. grad and
+        hess) sharing the same samples in a single pass over the bins."""
+        if not self._is_fused:
+            return [self.compute_histogram(values, sample_ids)
+                    for values in values_list]
+
+        sample_ids = np.asarray(sample_ids, dtype=np.int64)
+        values_list = [
+            np.asarray(values)[sample_ids] for values in values_list]
+        args = self._make_jobs(values_list, sample_ids, self._dtype)
+        rets = self._map(_compute_fused_histogram_helper, args)
+        return [
+            sum([ret[i] for ret in rets], [])
+            for i in range(len(values_list))]
+
+
+class EncryptedHistogramBuilder(HistogramBuilder):
+    """Builds histograms of paillier encrypted values. Instead of adding
+    PaillierEncryptedNumbers one by one, exponents are aligned once per call
+    and raw ciphertexts are multiplied modulo n^2. Bins are re-randomized
+    unless obfuscate is False, e.g. when they are packed and every packed
+    ciphertext is re-randomized instead."""
+    def __init__(self, binned_features, public_key,
+                 num_parallel=1, pool=None, obfuscate=True):
+        super(EncryptedHistogramBuilder, self).__init__(
+            binned_features, BST_TYPE, num_parallel, pool)
+        self._public_key = public_key
+        self._obfuscate = obfuscate
+        self._is_fused = False
+
+    def _to_ciphertexts(self, values):
+        if len(values) == 0:
+            return EXPONENT, []
+        exponent = max(i.exponent for i in values)
+        ciphertexts = [
+            gmpy_math.mpz(
+                (i if i.exponent == exponent else
+                 i.increase_exponent_to(exponent)).ciphertext(False))
+            for i in values]
+        return exponent, ciphertexts
+
+    def compute_histogram(self, values, sample_ids):
+        return self.compute_histograms([values], sample_ids)[0]
+
+    def compute_histograms(self, values_list, sample_ids):
+        sample_ids = np.asarray(sample_ids, dtype=np.int64)
+        exponents = []
+        ciphertexts = []
+        for values in values_list:
+            exponent, ciphertext = self._to_ciphertexts(
+                np.asarray(values)[sample_ids])
+            exponents.append(exponent)
+            ciphertexts.append(ciphertext)
+
+        args = self._make_jobs(
+            ciphertexts, sample_ids, (self._public_key, self._obfuscate))
+        rets = self._map(_compute_encrypted_histogram_helper, args)
+
+        all_hists = []
+        for i, exponent in enumerate(exponents):
+            all_hists.append([
+                np.asarray([
+                    paillier.PaillierEncryptedNumber(
+                        self._public_key, int(c), exponent)
+                    for c in hist])
+                for ret in rets for hist in ret[i]])
+        return all_hists
+
 
 class GrowerNode(object):
     def __init__(self, node_id):
@@ -246,9 +531,12 @@ class GrowerNode(object):
                 idx, self.feature_id - self.num_features]
             return np.in1d(x, self.cat_threshold)
 
-        x = binned.features[idx, self.feature_id]
-        isnan = np.isnan(x)
-        return np.where(isnan, self.default_left, x < self.threshold)
+        # x < threshold iff bin of x <= bin index of threshold
+        x = binned.binned[idx, self.feature_id]
+        split_point = np.searchsorted(
+            binned.thresholds[self.feature_id], self.threshold)
+        isnan = x == binned.num_bins[self.feature_id] - 1
+        return np.where(isnan, self.default_left, x <= split_point)
 
     def to_proto(self):
         return tree_pb2.RegressionTreeNodeProto(
@@ -266,6 +554,85 @@ class GrowerNode(object):
             weight=self.weight)
 
 
+def _pad_histograms(hists):
+    lengths = np.asarray([len(i) for i in hists], dtype=np.int64)
+    padded = np.zeros((len(hists), lengths.max()), dtype=np.float64)
+    for i, hist in enumerate(hists):
+        padded[i, :len(hist)] = hist
+    return padded, lengths
+
+
+def _compute_split_gains(left_g, left_h, right_g, right_h, lam):
+    sum_g = left_g + right_g
+    sum_h = left_h + right_h
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gains = left_g*left_g/(left_h + lam) + \
+            right_g*right_g/(right_h + lam) - \
+            sum_g*sum_g/(sum_h + lam)
+    gains[np.isnan(gains)] = -np.inf
+    return gains
+
+
+def _find_cont_splits(grad_hists, hess_hists, lam):
+    """return best gain, default_left, [left_g, left_h, right_g, right_h]
+    and split_point of every continuous feature. Last bin of histograms
+    holds missing values, which go to either side."""
+    grad, lengths = _pad_histograms(grad_hists)
+    hess, _ = _pad_histograms(hess_hists)
+    num_features, num_bins = len(grad_hists), lengths.max()
+    rows = np.arange(num_features)
+    left_g = np.cumsum(grad, axis=1)
+    left_h = np.cumsum(hess, axis=1)
+    sum_g = left_g[rows, lengths - 1][:, None]
+    sum_h = left_h[rows, lengths - 1][:, None]
+    nan_g = grad[rows, lengths - 1][:, None]
+    nan_h = hess[rows, lengths - 1][:, None]
+
+    # axis 2 is default_left in [True, False]
+    left_g = np.stack([left_g + nan_g, left_g], axis=2)
+    left_h = np.stack([left_h + nan_h, left_h], axis=2)
+    right_g = sum_g[:, :, None] - left_g
+    right_h = sum_h[:, :, None] - left_h
+    gains = _compute_split_gains(left_g, left_h, right_g, right_h, lam)
+    invalid = np.arange(num_bins)[None, :] >= (lengths - 2)[:, None]
+    gains[invalid] = -np.inf
+
+    # first best in (split_point, default_left) order
+    gains = gains.reshape(num_features, -1)
+    best = np.argmax(gains, axis=1)
+    sums = np.stack([
+        i.reshape(num_features, -1)[rows, best]
+        for i in [left_g, left_h, right_g, right_h]], axis=1)
+    return gains[rows, best], best % 2 == 0, sums, \
+        [[i] for i in best // 2]
+
+
+def _find_cat_splits(grad_hists, hess_hists, lam):
+    """return best gain, default_left, [left_g, left_h, right_g, right_h]
+    and split_point of every categorical feature. Categories are sorted by
+    g/h and every prefix is a candidate left set."""
+    grad, lengths = _pad_histograms(grad_hists)
+    hess, _ = _pad_histograms(hess_hists)
+    num_features, num_bins = len(grad_hists), lengths.max()
+    rows = np.arange(num_features)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        order = np.argsort(grad/hess + lam, axis=1, kind='stable')
+    left_g = np.cumsum(np.take_along_axis(grad, order, axis=1), axis=1)
+    left_h = np.cumsum(np.take_along_axis(hess, order, axis=1), axis=1)
+    sum_g = grad.sum(axis=1)[:, None]
+    sum_h = np.broadcast_to(hess.sum(axis=1)[:, None], left_h.shape)
+    right_g = sum_g - left_g
+    gains = _compute_split_gains(left_g, left_h, right_g, sum_h, lam)
+    invalid = np.arange(num_bins)[None, :] >= lengths[:, None]
+    gains[invalid] = -np.inf
+
+    best = np.argmax(gains, axis=1)
+    sums = np.stack([
+        i[rows, best] for i in [left_g, left_h, right_g, sum_h]], axis=1)
+    return gains[rows, best], np.ones(num_features, dtype=bool), sums, \
+        [list(order[i, :best[i] + 1]) for i in rows]
+
+
 class BaseGrower(object):
     def __init__(self, binned, labels, grad, hess,
                  grow_policy='depthwise', max_leaves=None, max_depth=None,
@@ -273,7 +640,7 @@ class BaseGrower(object):
                  num_parallel=1, pool=None):
         self._binned = binned
         self._labels = labels
-        self._num_samples = binned.features.shape[0]
+        self._num_samples = binned.num_samples
         self._is_cat_feature = \
             [False] * binned.num_features + [True] * binned.num_cat_features
         self._grad = grad
@@ -305,7 +672,10 @@ class BaseGrower(object):
 
         self._nodes = []
         self._add_node(0)
-        self._nodes[0].sample_ids = list(range(binned.features.shape[0]))
+        # every node's sample_ids is a view into this row index buffer,
+        # which is partitioned in place when splitting
+        self._nodes[0].sample_ids = np.arange(
+            binned.num_samples, dtype=np.int32)
         self._num_leaves = 1
 
     def _initialize_feature_importance(self):
@@ -370,10 +740,13 @@ class BaseGrower(object):
             self._feature_importance = self._feature_importance/ \
                                         self._feature_importance.sum()
     def _compute_histogram(self, node):
-        node.grad_hists = self._hist_builder.compute_histogram(
-            self._grad, node.sample_ids)
-        node.hess_hists = self._hist_builder.compute_histogram(
-            self._hess, node.sample_ids)
+        node.grad_hists, node.hess_hists = \
+            self._hist_builder.compute_histograms(
+                [self._grad, self._hess], node.sample_ids)
+
+    def _compute_histograms(self, nodes):
+        for node in nodes:
+            self._compute_histogram(node)
 
     def _compute_histogram_from_sibling(self, node, sibling):
         parent = self._nodes[node.parent]
@@ -382,81 +755,47 @@ class BaseGrower(object):
         node.hess_hists = [
             p - l for p, l in zip(parent.hess_hists, sibling.hess_hists)]
 
-    def _compare_split(self, split_info, default_left,
-                       feature_id, split_point,
-                       left_g, left_h, right_g, right_h):
-        lam = self._l2_regularization
-        lr = self._learning_rate
-        sum_g = left_g + right_g
-        sum_h = left_h + right_h
-        gain = left_g*left_g/(left_h + lam) + \
-            right_g*right_g/(right_h + lam) - \
-            sum_g*sum_g/(sum_h + lam)
-        if gain > split_info.gain:
-            split_info.gain = gain
-            split_info.feature_id = feature_id
-            split_info.split_point[:] = split_point
-            split_info.default_left = default_left
-            split_info.left_weight = - lr * left_g/(left_h + lam)
-            split_info.right_weight = - lr * right_g/(right_h + lam)
-
     def _find_split_and_push(self, node):
         assert len(self._is_cat_feature) == len(node.grad_hists)
 
         split_info = tree_pb2.SplitInfo(
             node_id=node.node_id, gain=-1e38)
-        for fid, is_cat in enumerate(self._is_cat_feature):
-            if is_cat:
-                self._find_cat_split(node, fid, split_info)
-            else:
-                self._find_cont_split(node, fid, split_info)
+        is_cat = np.asarray(self._is_cat_feature, dtype=bool)
+        # best split of every feature, filled by group
+        gains = np.full(is_cat.size, -np.inf)
+        split_points = [None] * is_cat.size
+        default_lefts = np.zeros(is_cat.size, dtype=bool)
+        sums = np.zeros((is_cat.size, 4))
+        for fids, find_splits in [
+                (np.nonzero(~is_cat)[0], _find_cont_splits),
+                (np.nonzero(is_cat)[0], _find_cat_splits)]:
+            if fids.size == 0:
+                continue
+            ret = find_splits(
+                [node.grad_hists[i] for i in fids],
+                [node.hess_hists[i] for i in fids],
+                self._l2_regularization)
+            gains[fids], default_lefts[fids], sums[fids] = ret[:3]
+            for fid, split_point in zip(fids, ret[3]):
+                split_points[fid] = split_point
+
+        if gains.size > 0:
+            fid = int(np.argmax(gains))
+            if gains[fid] > split_info.gain:
+                lam = self._l2_regularization
+                lr = self._learning_rate
+                left_g, left_h, right_g, right_h = sums[fid]
+                split_info.gain = gains[fid]
+                split_info.feature_id = fid
+                split_info.split_point[:] = split_points[fid]
+                split_info.default_left = default_lefts[fid]
+                split_info.left_weight = - lr * left_g/(left_h + lam)
+                split_info.right_weight = - lr * right_g/(right_h + lam)
 
         self._split_candidates.put((-split_info.gain, split_info))
 
         return split_info.gain, split_info
 
-    def _find_cont_split(self, node, fid, split_info):
-        grad_hist = node.grad_hists[fid]
-        hess_hist = node.hess_hists[fid]
-        sum_g = sum(grad_hist)
-        sum_h = sum(hess_hist)
-        left_g = 0.0
-        left_h = 0.0
-        nan_g = grad_hist[-1]
-        nan_h = hess_hist[-1]
-        for i in range(len(grad_hist) - 2):
-            left_g += grad_hist[i]
-            left_h += hess_hist[i]
-            self._compare_split(
-                split_info, True, fid, [i],
-                left_g + nan_g, left_h + nan_h,
-                sum_g - left_g - nan_g, sum_h - left_h - nan_h)
-            self._compare_split(
-                split_info, False, fid, [i],
-                left_g, left_h,
-                sum_g - left_g, sum_h - left_h)
-
-    def _find_cat_split(self, node, fid, split_info):
-        grad_hist = node.grad_hists[fid]
-        hess_hist = node.hess_hists[fid]
-        sum_g = sum(grad_hist)
-        sum_h = sum(hess_hist)
-        left_g = 0.0
-        left_h = 0.0
-        split_point = []
-        order = [
-            (i, g/h + self._l2_regularization)
-            for i, (g, h) in enumerate(zip(grad_hist, hess_hist))]
-        order.sort(key=lambda x: x[1])
-        for i, _ in order:
-            split_point.append(i)
-            left_g += grad_hist[i]
-            left_h += hess_hist[i]
-            self._compare_split(
-                split_info, True, fid, split_point,
-                left_g, left_h,
-                sum_g - left_g, sum_h)
-
     def _add_node(self, parent_id):
         node_id = len(self._nodes)
         node = GrowerNode(node_id)
@@ -481,22 +820,37 @@ class BaseGrower(object):
         right_child = self._nodes[node.right_child]
 
         is_left = node.is_left_sample(self._binned, node.sample_ids)
-        left_child.sample_ids = list(np.asarray(node.sample_ids)[is_left])
-        right_child.sample_ids = list(np.asarray(node.sample_ids)[~is_left])
-
-    def _split_next(self):
-        _, split_info = self._split_candidates.get()
-        node = self._nodes[split_info.node_id]
-
+        self._partition_node(node, is_left)
+        return is_left
+
+    def _partition_node(self, node, is_left):
+        # stable partition keeps both parties' row orders identical, so
+        # that splits can be sent as masks over the parent's rows
+        sample_ids = node.sample_ids
+        left_ids = sample_ids[is_left]
+        num_left = left_ids.size
+        sample_ids[num_left:] = sample_ids[~is_left]
+        sample_ids[:num_left] = left_ids
+        self._nodes[node.left_child].sample_ids = sample_ids[:num_left]
+        self._nodes[node.right_child].sample_ids = sample_ids[num_left:]
+
+    def _add_children(self, node, left_weight, right_weight):
         node.left_child = self._add_node(node.node_id)
         left_child = self._nodes[node.left_child]
-        left_child.weight = split_info.left_weight
+        left_child.weight = left_weight
 
         node.right_child = self._add_node(node.node_id)
         right_child = self._nodes[node.right_child]
-        right_child.weight = split_info.right_weight
+        right_child.weight = right_weight
 
         self._num_leaves += 1
+        return left_child, right_child
+
+    def _split_next(self):
+        _, split_info = self._split_candidates.get()
+        node = self._nodes[split_info.node_id]
+        left_child, right_child = self._add_children(
+            node, split_info.left_weight, split_info.right_weight)
 
         self._set_node_partition(node, split_info)
 
@@ -507,6 +861,9 @@ class BaseGrower(object):
 
         return left_child, right_child, split_info
 
+    def _split_nodes(self, num_splits):
+        return [self._split_next() for _ in range(num_splits)]
+
     def _log_split(self, left_child, right_child, split_info):
         parent = self._nodes[split_info.node_id]
 
@@ -541,7 +898,7 @@ class BaseGrower(object):
         return proto
 
     def get_prediction(self):
-        prediction = np.zeros(self._binned.features.shape[0], dtype=BST_TYPE)
+        prediction = np.zeros(self._binned.num_samples, dtype=BST_TYPE)
         for node in self._nodes:
             if node.left_child is not None:
                 continue
@@ -553,38 +910,46 @@ class BaseGrower(object):
         self._initialize_feature_importance()
         self._find_split_and_push(self._nodes[0])
 
+        # depthwise trees split a whole level at a time, so that two-party
+        # growers exchange once per level instead of once per node
+        num_splits = 1
         while self._num_leaves < self._max_leaves:
-            left_child, right_child, split_info = self._split_next()
-            self._log_split(left_child, right_child, split_info)
-            self._compute_histogram(left_child)
-            self._find_split_and_push(left_child)
-            self._compute_histogram_from_sibling(right_child, left_child)
-            self._find_split_and_push(right_child)
+            splits = self._split_nodes(num_splits)
+            for left_child, right_child, split_info in splits:
+                self._log_split(left_child, right_child, split_info)
+            self._compute_histograms([split[0] for split in splits])
+            for left_child, right_child, _ in splits:
+                self._find_split_and_push(left_child)
+                self._compute_histogram_from_sibling(right_child, left_child)
+                self._find_split_and_push(right_child)
+            if self._grow_policy == 'depthwise':
+                num_splits = min(
+                    2*len(splits), self._max_leaves - self._num_leaves)
 
         self._normalize_feature_importance()
         self._log_feature_importance()
 
 def _decrypt_histogram_helper(args):
-    base, public_key, private_key, hists = args
-    rets = []
-    for i, hist in enumerate(hists):
-        logging.debug('Decrypting histogram for feature %d', base + i)
-        hist = _from_ciphertext(public_key, hist.ciphertext)
-        rets.append(np.asarray(_decrypt_number(private_key, hist)))
-    return rets
+    private_key, ciphertexts = args
+    return list(private_key.decrypt_batch(
+        [int.from_bytes(c, 'little') for c in ciphertexts], EXPONENT))
 
 class LeaderGrower(BaseGrower):
     def __init__(self, bridge, public_key, private_key,
-                 binned, labels, grad, hess, **kwargs):
+                 binned, labels, grad, hess, enable_packing=False, **kwargs):
         super(LeaderGrower, self).__init__(
             binned, labels, grad, hess, dtype=np.float32, **kwargs)
         self._bridge = bridge
         self._public_key = public_key
         self._private_key = private_key
+        self._slot_bits = 0
+        if enable_packing:
+            self._slot_bits = _get_packing_slot_bits(public_key, grad, hess)
 
         bridge.start(bridge.new_iter_id())
         follower_num_features, follower_num_cat_features = \
             bridge.receive(bridge.current_iter_id, 'feature_dim')
+        bridge.send(bridge.current_iter_id, 'slot_bits', self._slot_bits)
         bridge.commit()
         self._is_cat_feature.extend(
             [False] * follower_num_features + \
@@ -594,95 +959,125 @@ class LeaderGrower(BaseGrower):
         self._feature_importance = np.zeros(len(self._nodes[0].grad_hists))
 
     def _receive_and_decrypt_histogram(self, name):
-        msg = tree_pb2.Histograms()
-        self._bridge.receive_proto(
-            self._bridge.current_iter_id, name).Unpack(msg)
-        if not self._pool:
-            return _decrypt_histogram_helper(
-                (0, self._public_key, self._private_key, msg.hists))
-
-        job_size = (len(msg.hists) + self._num_parallel - 1)//self._num_parallel
+        # decrypt parts as they arrive, overlapping with the transfer
+        hist_sizes, values = [], []
+        for part in self._bridge.receive_stream(
+                self._bridge.current_iter_id, name):
+            msg = tree_pb2.Histograms()
+            part.Unpack(msg)
+            if self._slot_bits:
+                hist_sizes.extend(msg.hist_sizes)
+                values.extend(self._map_ciphertexts(
+                    _decrypt_packed_histogram_helper,
+                    msg.packed_hists.ciphertext, self._slot_bits,
+                    _get_num_slots(self._public_key, self._slot_bits)))
+            else:
+                hist_sizes.extend([len(hist.ciphertext) for hist in msg.hists])
+                values.extend(self._map_ciphertexts(
+                    _decrypt_histogram_helper,
+                    [c for hist in msg.hists for c in hist.ciphertext]))
+
+        hists = []
+        base = 0
+        for size in hist_sizes:
+            hists.append(np.asarray(values[base:base+size]))
+            base += size
+        return hists
+
+    def _map_ciphertexts(self, func, ciphertexts, *extra):
+        # split by ciphertext count, so that workers are evenly loaded
+        # regardless of the number of bins of each feature
+        num_parallel = self._num_parallel if self._pool else 1
+        job_size = (len(ciphertexts) + num_parallel - 1)//num_parallel
         args = [
-            (i*job_size,
-             self._public_key, self._private_key,
-             msg.hists[i*job_size:(i+1)*job_size])
-            for i in range(self._num_parallel)
+            (self._private_key, ciphertexts[i*job_size:(i+1)*job_size]) \
+                + extra
+            for i in range(num_parallel)
         ]
-        hists = self._pool.map(_decrypt_histogram_helper, args)
-        return sum(hists, [])
+        if self._pool:
+            return sum(self._pool.map(func, args), [])
+        return func(args[0])
 
     def _compute_histogram(self, node):
+        self._compute_histograms([node])
+
+    def _compute_histograms(self, nodes):
         self._bridge.start(self._bridge.new_iter_id())
-        grad_hists = self._hist_builder.compute_histogram(
-            self._grad, node.sample_ids)
-        hess_hists = self._hist_builder.compute_histogram(
-            self._hess, node.sample_ids)
+        hists = [
+            self._hist_builder.compute_histograms(
+                [self._grad, self._hess], node.sample_ids)
+            for node in nodes]
+        # follower sends histograms of all nodes in one message
         follower_grad_hists = self._receive_and_decrypt_histogram('grad_hists')
         follower_hess_hists = self._receive_and_decrypt_histogram('hess_hists')
-        node.grad_hists = grad_hists + follower_grad_hists
-        node.hess_hists = hess_hists + follower_hess_hists
+        num_hists = len(follower_grad_hists)//len(nodes)
+        for i, node in enumerate(nodes):
+            grad_hists, hess_hists = hists[i]
+            node.grad_hists = grad_hists + \
+                follower_grad_hists[i*num_hists:(i+1)*num_hists]
+            node.hess_hists = hess_hists + \
+                follower_hess_hists[i*num_hists:(i+1)*num_hists]
         self._bridge.commit()
 
-    def _split_next(self):
+    def _split_nodes(self, num_splits):
         self._bridge.start(self._bridge.new_iter_id())
 
-        _, split_info = self._split_candidates.get()
-        node = self._nodes[split_info.node_id]
-
-        node.left_child = self._add_node(node.node_id)
-        left_child = self._nodes[node.left_child]
-        left_child.weight = split_info.left_weight
-
-        node.right_child = self._add_node(node.node_id)
-        right_child = self._nodes[node.right_child]
-        right_child.weight = split_info.right_weight
-
-        self._num_leaves += 1
-
-        if split_info.feature_id < self._binned.num_all_features:
-            self._set_node_partition(node, split_info)
-            self._compute_IG_NI(node, \
-                left_child, right_child)
-            self._feature_importance[split_info.feature_id] += node.NI
-            self._bridge.send_proto(
-                self._bridge.current_iter_id, 'split_info',
-                tree_pb2.SplitInfo(
+        splits = []
+        msg = tree_pb2.SplitInfos()
+        for _ in range(num_splits):
+            _, split_info = self._split_candidates.get()
+            node = self._nodes[split_info.node_id]
+            left_child, right_child = self._add_children(
+                node, split_info.left_weight, split_info.right_weight)
+            splits.append((left_child, right_child, split_info))
+
+            if split_info.feature_id < self._binned.num_all_features:
+                is_left = self._set_node_partition(node, split_info)
+                self._compute_IG_NI(node, \
+                    left_child, right_child)
+                self._feature_importance[split_info.feature_id] += node.NI
+                msg.split_infos.add(
                     node_id=split_info.node_id, feature_id=-1,
-                    left_samples=left_child.sample_ids,
-                    right_samples=right_child.sample_ids))
-        else:
-            node.is_owner = False
-            fid = split_info.feature_id - self._binned.num_all_features
-            self._bridge.send_proto(
-                self._bridge.current_iter_id, 'split_info',
-                tree_pb2.SplitInfo(
+                    left_mask=_pack_mask(is_left))
+            else:
+                node.is_owner = False
+                fid = split_info.feature_id - self._binned.num_all_features
+                msg.split_infos.add(
                     node_id=split_info.node_id, feature_id=fid,
                     split_point=split_info.split_point,
-                    default_left=split_info.default_left))
+                    default_left=split_info.default_left)
 
-            follower_split_info = tree_pb2.SplitInfo()
-            self._bridge.receive_proto(
-                self._bridge.current_iter_id, 'follower_split_info') \
-                .Unpack(follower_split_info)
-            left_child.sample_ids = list(follower_split_info.left_samples)
-            right_child.sample_ids = list(follower_split_info.right_samples)
-
-            self._compute_IG_NI(node, \
-                left_child, right_child)
-            self._feature_importance[split_info.feature_id] += node.NI
-            split_info.feature_id = -1
+        self._bridge.send_proto(
+            self._bridge.current_iter_id, 'split_infos', msg)
 
+        if any(not split_info.feature_id < self._binned.num_all_features
+               for _, _, split_info in splits):
+            follower_msg = tree_pb2.SplitInfos()
+            self._bridge.receive_proto(
+                self._bridge.current_iter_id, 'follower_split_infos') \
+                .Unpack(follower_msg)
+            left_masks = {
+                i.node_id: i.left_mask for i in follower_msg.split_infos}
+            for left_child, right_child, split_info in splits:
+                if split_info.node_id not in left_masks:
+                    continue
+                node = self._nodes[split_info.node_id]
+                self._partition_node(node, _unpack_mask(
+                    left_masks[split_info.node_id], len(node.sample_ids)))
+                self._compute_IG_NI(node, \
+                    left_child, right_child)
+                self._feature_importance[split_info.feature_id] += node.NI
+                split_info.feature_id = -1
 
         self._bridge.commit()
-        return left_child, right_child, split_info
+        return splits
 
 
 class FollowerGrower(BaseGrower):
     def __init__(self, bridge, public_key, binned, labels,
                 grad, hess, **kwargs):
-        dtype = lambda x: public_key.encrypt(x, PRECISION)
         super(FollowerGrower, self).__init__(
-            binned, labels, grad, hess, dtype=dtype, **kwargs)
+            binned, labels, grad, hess, **kwargs)
         self._bridge = bridge
         self._public_key = public_key
 
@@ -690,8 +1085,15 @@ class FollowerGrower(BaseGrower):
         bridge.send(
             bridge.current_iter_id, 'feature_dim',
             [binned.num_features, binned.num_cat_features])
+        self._slot_bits = int(
+            bridge.receive(bridge.current_iter_id, 'slot_bits'))
         bridge.commit()
 
+        # packed ciphertexts are re-randomized one by one instead of bins
+        self._hist_builder = EncryptedHistogramBuilder(
+            binned, public_key, self._num_parallel, self._pool,
+            obfuscate=not self._slot_bits)
+
     def _compute_histogram_from_sibling(self, node, sibling):
         pass
 
@@ -702,62 +1104,108 @@ class FollowerGrower(BaseGrower):
         pass
 
     def _send_histograms(self, name, hists):
+        self._bridge.send_stream(
+            self._bridge.current_iter_id, name,
+            self._iter_histogram_parts(hists))
+
+    def _iter_histogram_parts(self, hists):
+        # about MAX_PARTITION_SIZE ciphertexts per part, so that leader can
+        # start decrypting before all histograms arrive
+        if self._slot_bits:
+            packed = self._pack_histograms(hists)
+            for i in range(0, max(len(packed), 1), MAX_PARTITION_SIZE):
+                msg = tree_pb2.Histograms()
+                if i == 0:
+                    msg.hist_sizes.extend([len(hist) for hist in hists])
+                msg.packed_hists.ciphertext.extend(
+                    packed[i:i+MAX_PARTITION_SIZE])
+                yield msg
+            return
+
         msg = tree_pb2.Histograms()
+        num_ciphertexts = 0
         for hist in hists:
-            ciphertext = _encode_encrypted_numbers(hist)
-            msg.hists.append(
-                tree_pb2.EncryptedNumbers(ciphertext=ciphertext))
-        self._bridge.send_proto(self._bridge.current_iter_id, name, msg)
+            msg.hists.append(tree_pb2.EncryptedNumbers(
+                ciphertext=_encode_encrypted_numbers(hist)))
+            num_ciphertexts += len(hist)
+            if num_ciphertexts >= MAX_PARTITION_SIZE:
+                yield msg
+                msg = tree_pb2.Histograms()
+                num_ciphertexts = 0
+        if msg.hists:
+            yield msg
+
+    def _pack_histograms(self, hists):
+        num_slots = _get_num_slots(self._public_key, self._slot_bits)
+        ciphertexts = [
+            gmpy_math.mpz(i.ciphertext(False)) for hist in hists for i in hist]
+        num_parallel = self._num_parallel if self._pool else 1
+        num_packed = (len(ciphertexts) + num_slots - 1)//num_slots
+        job_size = \
+            (num_packed + num_parallel - 1)//num_parallel*num_slots
+        args = [
+            (ciphertexts[i*job_size:(i+1)*job_size], self._public_key,
+             self._slot_bits, num_slots)
+            for i in range(num_parallel)
+        ]
+        if self._pool:
+            return sum(self._pool.map(_pack_ciphertexts_helper, args), [])
+        return _pack_ciphertexts_helper(args[0])
 
     def _compute_histogram(self, node):
+        self._compute_histograms([node])
+
+    def _compute_histograms(self, nodes):
         self._bridge.start(self._bridge.new_iter_id())
-        grad_hists = self._hist_builder.compute_histogram(
-            self._grad, node.sample_ids)
-        hess_hists = self._hist_builder.compute_histogram(
-            self._hess, node.sample_ids)
+        grad_hists, hess_hists = [], []
+        for node in nodes:
+            node_grad_hists, node_hess_hists = \
+                self._hist_builder.compute_histograms(
+                    [self._grad, self._hess], node.sample_ids)
+            grad_hists.extend(node_grad_hists)
+            hess_hists.extend(node_hess_hists)
         self._send_histograms('grad_hists', grad_hists)
         self._send_histograms('hess_hists', hess_hists)
         self._bridge.commit()
 
-    def _split_next(self):
+    def _split_nodes(self, num_splits):
         self._bridge.start(self._bridge.new_iter_id())
 
-        split_info = tree_pb2.SplitInfo()
+        msg = tree_pb2.SplitInfos()
         self._bridge.receive_proto(
-            self._bridge.current_iter_id, 'split_info') \
-            .Unpack(split_info)
-
-        node = self._nodes[split_info.node_id]
-
-        node.left_child = self._add_node(node.node_id)
-        left_child = self._nodes[node.left_child]
-        left_child.weight = float('nan')
-
-        node.right_child = self._add_node(node.node_id)
-        right_child = self._nodes[node.right_child]
-        right_child.weight = float('nan')
+            self._bridge.current_iter_id, 'split_infos').Unpack(msg)
+        assert len(msg.split_infos) == num_splits
+
+        splits = []
+        follower_msg = tree_pb2.SplitInfos()
+        for split_info in msg.split_infos:
+            node = self._nodes[split_info.node_id]
+            left_child, right_child = self._add_children(
+                node, float('nan'), float('nan'))
+            splits.append((left_child, right_child, split_info))
+
+            if split_info.feature_id >= 0:
+                is_left = self._set_node_partition(node, split_info)
+                follower_msg.split_infos.add(
+                    node_id=split_info.node_id,
+                    left_mask=_pack_mask(is_left))
+            else:
+                node.is_owner = False
+                self._partition_node(node, _unpack_mask(
+                    split_info.left_mask, len(node.sample_ids)))
 
-        self._num_leaves += 1
+            node.gini = float('nan')
+            node.entropy = float('nan')
+            node.IG = float('nan')
+            node.NI = float('nan')
 
-        if split_info.feature_id >= 0:
-            self._set_node_partition(node, split_info)
+        if follower_msg.split_infos:
             self._bridge.send_proto(
-                self._bridge.current_iter_id, 'follower_split_info',
-                tree_pb2.SplitInfo(
-                    left_samples=left_child.sample_ids,
-                    right_samples=right_child.sample_ids))
-        else:
-            node.is_owner = False
-            left_child.sample_ids = list(split_info.left_samples)
-            right_child.sample_ids = list(split_info.right_samples)
-
-        node.gini = float('nan')
-        node.entropy = float('nan')
-        node.IG = float('nan')
-        node.NI = float('nan')
+                self._bridge.current_iter_id, 'follower_split_infos',
+                follower_msg)
 
         self._bridge.commit()
-        return left_child, right_child, split_info
+        return splits
 
 def _vectorize_tree(tree):
     vec = {}
@@ -808,12 +1256,124 @@ def _vectorized_assignment(vec, assignment, direction, peer_direction=None):
     new_assignment = vec['children'][direction.astype(np.int32), assignment]
     return np.where(vec['is_leaf'][assignment], assignment, new_assignment)
 
+def _predict_chunk_helper(args):
+    compiled, features, cat_features, begin = args
+    return compiled.predict_raw(features, cat_features, begin)
+
+class CompiledEnsemble(object):
+    """All nodes of all trees packed into flat arrays, categorical
+    thresholds are rows of a bitset matrix. Rows are routed through all
+    trees at once, one level per step."""
+    def __init__(self, trees=None):
+        self.roots = np.zeros(0, dtype=np.int32)
+        self.feature_id = np.zeros(0, dtype=np.int32)
+        self.threshold = np.zeros(0, dtype=np.float64)
+        self.default_left = np.zeros(0, dtype=bool)
+        self.is_leaf = np.zeros(0, dtype=bool)
+        self.weight = np.zeros(0, dtype=BST_TYPE)
+        self.left = np.zeros(0, dtype=np.int32)
+        self.right = np.zeros(0, dtype=np.int32)
+        # row 0 is the empty set used by continuous nodes
+        self.cat_set = np.zeros(0, dtype=np.int32)
+        self.cat_bitset = np.zeros((1, 1), dtype=bool)
+        if trees:
+            self.add_trees(trees)
+
+    @property
+    def num_trees(self):
+        return self.roots.size
+
+    def add_trees(self, trees):
+        offset = self.feature_id.size
+        roots, cat_sets, cat_thresholds = [], [], []
+        num_cat_sets = self.cat_bitset.shape[0]
+        nodes = []
+        for tree in trees:
+            roots.append(offset + len(nodes))
+            base = offset + len(nodes)
+            for node in tree.nodes:
+                nodes.append((node, base))
+                if node.left_child != 0 and node.cat_threshold:
+                    cat_sets.append(num_cat_sets + len(cat_thresholds))
+                    cat_thresholds.append(list(node.cat_threshold))
+                else:
+                    cat_sets.append(0)
+
+        def concat(old, values, dtype):
+            return np.concatenate([old, np.asarray(values, dtype=dtype)])
+
+        self.roots = concat(self.roots, roots, np.int32)
+        self.feature_id = concat(
+            self.feature_id, [n.feature_id for n, _ in nodes], np.int32)
+        self.threshold = concat(
+            self.threshold, [n.threshold for n, _ in nodes], np.float64)
+        self.default_left = concat(
+            self.default_left, [n.default_left for n, _ in nodes], bool)
+        self.is_leaf = concat(
+            self.is_leaf, [n.left_child == 0 for n, _ in nodes], bool)
+        self.weight = concat(
+            self.weight, [n.weight for n, _ in nodes], BST_TYPE)
+        self.left = concat(
+            self.left, [b + n.left_child for n, b in nodes], np.int32)
+        self.right = concat(
+            self.right, [b + n.right_child for n, b in nodes], np.int32)
+        self.cat_set = concat(self.cat_set, cat_sets, np.int32)
+
+        width = max([self.cat_bitset.shape[1]] + \
+            [max(i) + 1 for i in cat_thresholds])
+        bitset = np.zeros(
+            (num_cat_sets + len(cat_thresholds), width), dtype=bool)
+        bitset[:num_cat_sets, :self.cat_bitset.shape[1]] = self.cat_bitset
+        for i, cat_threshold in enumerate(cat_thresholds):
+            bitset[num_cat_sets + i, cat_threshold] = True
+        self.cat_bitset = bitset
+
+    def predict_assignments(self, features, cat_features, begin=0):
+        """return leaf node ids (global) of trees from begin on,
+        in shape [num_trees - begin, num_rows]."""
+        N, num_features = features.shape
+        rows = np.arange(N)[None, :]
+        assignment = np.repeat(self.roots[begin:, None], N, axis=1)
+        width = self.cat_bitset.shape[1]
+        while True:
+            is_leaf = self.is_leaf[assignment]
+            if is_leaf.all():
+                break
+            fid = self.feature_id[assignment]
+            is_cont = fid < num_features
+            x = features[rows, np.where(is_cont, fid, 0)]
+            go_left = np.where(
+                np.isnan(x), self.default_left[assignment],
+                x < self.threshold[assignment])
+            if cat_features.shape[1] > 0 and not is_cont.all():
+                cat_x = cat_features[
+                    rows, np.where(is_cont, 0, fid - num_features)]
+                in_set = self.cat_bitset[
+                    self.cat_set[assignment],
+                    np.clip(cat_x, 0, width - 1)]
+                in_set &= (cat_x >= 0) & (cat_x < width)
+                go_left = np.where(is_cont, go_left, in_set)
+            assignment = np.where(
+                is_leaf, assignment,
+                np.where(go_left, self.left[assignment],
+                         self.right[assignment]))
+        return assignment
+
+    def predict_raw(self, features, cat_features, begin=0):
+        raw_prediction = np.zeros(features.shape[0], dtype=BST_TYPE)
+        # sum tree by tree, same order as training
+        for assignment in self.predict_assignments(
+                features, cat_features, begin):
+            raw_prediction += self.weight[assignment]
+        return raw_prediction
+
 class BoostingTreeEnsamble(object):
     def __init__(self, bridge, learning_rate=0.3, max_iters=50, max_depth=6,
                  max_leaves=0, l2_regularization=1.0, max_bins=33,
                  grow_policy='depthwise', num_parallel=1,
                  loss_type='logistic', send_scores_to_follower=False,
-                 send_metrics_to_follower=False):
+                 send_metrics_to_follower=False, enable_packing=False,
+                 binning_method='exact'):
         self._learning_rate = learning_rate
         self._max_iters = max_iters
         self._max_depth = max_depth
@@ -827,6 +1387,7 @@ class BoostingTreeEnsamble(object):
 
         assert max_bins < 255, "Only support max_bins < 255"
         self._max_bins = max_bins
+        self._binning_method = binning_method
 
         if loss_type == 'logistic':
             self._loss = LogisticLoss()
@@ -835,17 +1396,32 @@ class BoostingTreeEnsamble(object):
         else:
             raise ValueError("Invalid loss type%s"%loss_type)
         self._trees = []
+        self._compiled = CompiledEnsemble()
         self._feature_names = None
         self._cat_feature_names = None
 
         self._send_scores_to_follower = send_scores_to_follower
         self._send_metrics_to_follower = send_metrics_to_follower
+        self._enable_packing = enable_packing
 
         self._bridge = bridge
+        self._obfuscator_procs = None
+        self._obfuscator_pool = None
         if bridge is not None:
             self._role = self._bridge.role
+            # obfuscators are precomputed in the background by their own
+            # processes, so that they never queue before decryption and
+            # histogram tasks of self._pool. both pools are forked before
+            # the bridge starts its grpc threads
+            if self._role == 'leader' and self._pool is not None:
+                self._obfuscator_procs = mp.Pool(
+                    OBFUSCATOR_NUM_PROCESSES, initializer=os.nice,
+                    initargs=(OBFUSCATOR_NICENESS,))
             self._bridge.connect()
             self._make_key_pair()
+            if self._obfuscator_procs is not None:
+                self._obfuscator_pool = paillier.PaillierObfuscatorPool(
+                    self._public_key, self._obfuscator_procs)
         else:
             self._role = 'local'
 
@@ -853,6 +1429,21 @@ class BoostingTreeEnsamble(object):
     def loss(self):
         return self._loss
 
+    @property
+    def pool(self):
+        """worker processes forked before the bridge connected, None if
+        num_parallel is 1. They can be shared with data loading."""
+        return self._pool
+
+    def close(self):
+        for pool in [self._pool, self._obfuscator_procs]:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        self._pool = None
+        self._obfuscator_procs = None
+        self._obfuscator_pool = None
+
     def _compute_metrics(self, pred, label):
         if self._role == 'local':
             return self._loss.metrics(pred, label)
@@ -1003,6 +1594,7 @@ class BoostingTreeEnsamble(object):
         model = tree_pb2.BoostingTreeEnsambleProto()
         text_format.Parse(fin.read(), model)
         self._trees = list(model.trees)
+        self._compiled = CompiledEnsemble(self._trees)
         self._feature_importance = np.asarray(model.feature_importance)
         self._feature_names = list(model.feature_names)
         self._cat_feature_names = list(model.cat_feature_names)
@@ -1043,16 +1635,22 @@ class BoostingTreeEnsamble(object):
             assert cat_feature_names == self._cat_feature_names, \
                 "Predict data's feature names does not match loaded model"
 
+        return self._batch_predict(
+            features, cat_features, get_raw_score, example_ids)
+
+    def _batch_predict(self, features, cat_features, get_raw_score,
+                       example_ids, begin=0):
+        # only trees from begin on are evaluated
         if features is not None and cat_features is None:
             cat_features = np.zeros((features.shape[0], 0), dtype=np.int32)
 
         if self._bridge is None:
             return self._batch_predict_local(
-                features, cat_features, get_raw_score)
+                features, cat_features, get_raw_score, begin)
 
         if self._role == 'leader':
             leader_no_data = True
-            for tree in self._trees:
+            for tree in self._trees[begin:]:
                 for node in tree.nodes:
                     if node.is_owner:
                         leader_no_data = False
@@ -1066,56 +1664,60 @@ class BoostingTreeEnsamble(object):
         if msg.leader_no_data:
             if self._role == 'leader':
                 return self._batch_predict_one_side_leader(
-                    get_raw_score)
+                    get_raw_score, begin)
             return self._batch_predict_one_side_follower(
-                features, cat_features, get_raw_score)
+                features, cat_features, get_raw_score, begin)
 
         return self._batch_predict_two_side(
-            features, cat_features, get_raw_score)
-
-
-    def _batch_predict_local(self, features, cat_features, get_raw_score):
-        N = features.shape[0]
+            features, cat_features, get_raw_score, begin)
 
-        raw_prediction = np.zeros(N, dtype=BST_TYPE)
-        for idx, tree in enumerate(self._trees):
-            logging.debug("Running prediction for tree %d", idx)
-
-            vec_tree = _vectorize_tree(tree)
-            assignment = np.zeros(N, dtype=np.int32)
-            while vec_tree['is_leaf'][assignment].sum() < N:
-                direction = _vectorized_direction(
-                    vec_tree, features, cat_features, assignment)
-                assignment = _vectorized_assignment(
-                    vec_tree, assignment, direction)
-
-            raw_prediction += vec_tree['weight'][assignment]
 
+    def _predict_chunks(self, features, cat_features, begin):
+        # bound the number of (tree, row) pairs routed at once
+        num_trees = max(self._compiled.num_trees - begin, 1)
+        chunk_size = max(PREDICT_BLOCK_SIZE//num_trees, 1)
+        args = [
+            (self._compiled, features[i:i+chunk_size],
+             cat_features[i:i+chunk_size], begin)
+            for i in range(0, features.shape[0], chunk_size)]
+        if self._pool and len(args) > 1:
+            rets = self._pool.map(_predict_chunk_helper, args)
+        else:
+            rets = [_predict_chunk_helper(i) for i in args]
+        if not rets:
+            return np.zeros(0, dtype=BST_TYPE)
+        return np.concatenate(rets)
+
+    def _batch_predict_local(self, features, cat_features, get_raw_score,
+                             begin=0):
+        raw_prediction = self._predict_chunks(features, cat_features, begin)
         if get_raw_score:
             return raw_prediction
         return self._loss.predict(raw_prediction)
 
     def _batch_predict_one_side_follower(self, features, cat_features,
-                                         get_raw_score):
-        N = features.shape[0]
-
-        for idx, tree in enumerate(self._trees):
-            logging.debug("Running prediction for tree %d", idx)
-
-            vec_tree = _vectorize_tree(tree)
-            assignment = np.zeros(
-                N, dtype=_get_dtype_for_max_value(len(tree.nodes)))
-            while vec_tree['is_leaf'][assignment].sum() < N:
-                direction = _vectorized_direction(
-                    vec_tree, features, cat_features, assignment)
-                assignment = _vectorized_assignment(
-                    vec_tree, assignment, direction)
-
-            self._bridge.start(self._bridge.new_iter_id())
-            self._bridge.send(
-                self._bridge.current_iter_id, 'follower_assignment_%d'%idx,
-                assignment)
-            self._bridge.commit()
+                                         get_raw_score, begin=0):
+        trees = self._trees[begin:]
+        roots = self._compiled.roots[begin:, None]
+        assignments = np.empty(
+            (len(trees), features.shape[0]),
+            dtype=_get_dtype_for_max_value(
+                max([len(tree.nodes) for tree in trees], default=0)))
+        # route row chunks bounded like _predict_chunks into the output,
+        # converting global node ids to ids within each tree
+        chunk_size = max(PREDICT_BLOCK_SIZE//max(len(trees), 1), 1)
+        for i in range(0, features.shape[0], chunk_size):
+            assignments[:, i:i+chunk_size] = \
+                self._compiled.predict_assignments(
+                    features[i:i+chunk_size], cat_features[i:i+chunk_size],
+                    begin) - roots
+
+        # send assignments of all trees at once
+        self._bridge.start(self._bridge.new_iter_id())
+        self._bridge.send(
+            self._bridge.current_iter_id, 'follower_assignments',
+            assignments)
+        self._bridge.commit()
 
         self._bridge.start(self._bridge.new_iter_id())
         raw_prediction = self._bridge.receive(
@@ -1126,22 +1728,20 @@ class BoostingTreeEnsamble(object):
             return raw_prediction
         return self._loss.predict(raw_prediction)
 
-    def _batch_predict_one_side_leader(self, get_raw_score):
-        raw_prediction = None
-        for idx, tree in enumerate(self._trees):
-            logging.debug("Running prediction for tree %d", idx)
-            vec_tree = _vectorize_tree(tree)
-            assert not vec_tree['is_owner'].sum(), \
-                "Model cannot predict with no data"
-
-            self._bridge.start(self._bridge.new_iter_id())
-            assignment = self._bridge.receive(
-                self._bridge.current_iter_id, 'follower_assignment_%d'%idx)
-            self._bridge.commit()
+    def _batch_predict_one_side_leader(self, get_raw_score, begin=0):
+        # _batch_predict only gets here once it found no node owned by
+        # the leader, so the follower's assignments end at leaves
+        self._bridge.start(self._bridge.new_iter_id())
+        assignments = self._bridge.receive(
+            self._bridge.current_iter_id, 'follower_assignments')
+        self._bridge.commit()
 
-            if raw_prediction is None:
-                raw_prediction = np.zeros(assignment.shape[0], dtype=BST_TYPE)
-            raw_prediction += vec_tree['weight'][assignment]
+        # assignments hold node ids within each tree, look their weights
+        # up in the compiled ensemble one tree at a time
+        roots = self._compiled.roots[begin:]
+        raw_prediction = np.zeros(assignments.shape[1], dtype=BST_TYPE)
+        for root, assignment in zip(roots, assignments):
+            raw_prediction += self._compiled.weight[root + assignment]
 
         self._bridge.start(self._bridge.new_iter_id())
         self._bridge.send(
@@ -1154,31 +1754,50 @@ class BoostingTreeEnsamble(object):
         return self._loss.predict(raw_prediction)
 
 
-    def _batch_predict_two_side(self, features, cat_features, get_raw_score):
+    def _batch_predict_two_side(self, features, cat_features, get_raw_score,
+                                begin=0):
         N = features.shape[0]
         peer_role = 'leader' if self._role == 'follower' else 'follower'
-        raw_prediction = np.zeros(N, dtype=BST_TYPE)
-        for idx, tree in enumerate(self._trees):
-            logging.debug("Running prediction for tree %d", idx)
-            vec_tree = _vectorize_tree(tree)
-            assignment = np.zeros(N, dtype=np.int32)
-            while vec_tree['is_leaf'][assignment].sum() < N:
-                direction = _vectorized_direction(
-                    vec_tree, features, cat_features, assignment)
-
-                self._bridge.start(self._bridge.new_iter_id())
-                self._bridge.send(
-                    self._bridge.current_iter_id,
-                    '%s_direction_%d'%(self._role, idx),
-                    direction)
-                peer_direction = self._bridge.receive(
-                    self._bridge.current_iter_id,
-                    '%s_direction_%d'%(peer_role, idx))
-                self._bridge.commit()
+        vec_trees = [_vectorize_tree(tree) for tree in self._trees[begin:]]
+        assignments = [np.zeros(N, dtype=np.int32) for _ in vec_trees]
+        # advance all trees by one level per exchange, both parties hold
+        # the same assignments and therefore agree on unfinished trees
+        level = 0
+        while True:
+            active = [
+                i for i, (vec_tree, assignment) in enumerate(
+                    zip(vec_trees, assignments))
+                if vec_tree['is_leaf'][assignment].sum() < N]
+            if not active:
+                break
+            logging.debug(
+                "Running prediction for level %d of %d trees",
+                level, len(active))
+
+            directions = [
+                _vectorized_direction(
+                    vec_trees[i], features, cat_features, assignments[i])
+                for i in active]
+            self._bridge.start(self._bridge.new_iter_id())
+            self._bridge.send(
+                self._bridge.current_iter_id,
+                '%s_directions'%self._role,
+                np.stack([np.packbits(d) for d in directions]))
+            peer_directions = self._bridge.receive(
+                self._bridge.current_iter_id,
+                '%s_directions'%peer_role)
+            self._bridge.commit()
 
-                assignment = _vectorized_assignment(
-                    vec_tree, assignment, direction, peer_direction)
+            for i, direction, peer_direction in zip(
+                    active, directions, peer_directions):
+                peer_direction = np.unpackbits(peer_direction)[:N] \
+                    .astype(bool)
+                assignments[i] = _vectorized_assignment(
+                    vec_trees[i], assignments[i], direction, peer_direction)
+            level += 1
 
+        raw_prediction = np.zeros(N, dtype=BST_TYPE)
+        for vec_tree, assignment in zip(vec_trees, assignments):
             raw_prediction += vec_tree['weight'][assignment]
 
         self._bridge.start(self._bridge.new_iter_id())
@@ -1219,13 +1838,27 @@ class BoostingTreeEnsamble(object):
             feature_names=None,
             cat_feature_names=None,
             checkpoint_path=None,
-            output_path=None):
+            output_path=None,
+            binned_features=None):
         num_examples = features.shape[0]
         assert example_ids is None or num_examples == len(example_ids)
 
+        # start generating obfuscators for encrypting grad and hess
+        if self._obfuscator_pool is not None:
+            self._obfuscator_pool.refill(2*num_examples)
+
         # sort feature columns
-        binned = BinnedFeatures(
-            features, self._max_bins, cat_features=cat_features)
+        if binned_features is not None:
+            assert binned_features.num_samples == num_examples and \
+                binned_features.max_bins == self._max_bins and \
+                binned_features.binning_method == self._binning_method, \
+                "Binned features do not match training data"
+            binned = binned_features
+        else:
+            binned = BinnedFeatures(
+                features, self._max_bins, cat_features=cat_features,
+                binning_method=self._binning_method,
+                num_parallel=self._num_parallel, pool=self._pool)
 
         # load checkpoint if exists
         if checkpoint_path:
@@ -1253,6 +1886,16 @@ class BoostingTreeEnsamble(object):
             self._cat_feature_names = cat_feature_names
             sum_prediction = np.zeros(num_examples, dtype=BST_TYPE)
 
+        # raw validation scores are updated with each new tree
+        if validation_features is not None:
+            if len(self._trees) > 0:
+                val_sum_prediction = self._batch_predict(
+                    validation_features, validation_cat_features, True,
+                    validation_example_ids)
+            else:
+                val_sum_prediction = np.zeros(
+                    validation_features.shape[0], dtype=BST_TYPE)
+
         # start iterations
         while len(self._trees) < self._max_iters:
             begin_time = time.time()
@@ -1270,6 +1913,7 @@ class BoostingTreeEnsamble(object):
             else:
                 tree = self._fit_one_round_follower(binned)
             self._trees.append(tree)
+            self._compiled.add_trees([tree])
 
             logging.info("Elapsed time for one round %s s",
                          str(time.time()-begin_time))
@@ -1306,10 +1950,10 @@ class BoostingTreeEnsamble(object):
 
             # validation
             if validation_features is not None:
-                val_pred = self.batch_predict(
-                    validation_features,
-                    example_ids=validation_example_ids,
-                    cat_features=validation_cat_features)
+                val_sum_prediction += self._batch_predict(
+                    validation_features, validation_cat_features, True,
+                    validation_example_ids, begin=num_iter)
+                val_pred = self._loss.predict(val_sum_prediction)
                 metrics = self._compute_metrics(val_pred, validation_labels)
                 logging.info(
                     "Validation metrics for iter %d: %s", num_iter, metrics)
@@ -1353,14 +1997,22 @@ class BoostingTreeEnsamble(object):
 
         self._bridge.start(self._bridge.new_iter_id())
         _encrypt_and_send_numbers(
-            self._bridge, 'grad', self._public_key, grad)
+            self._bridge, 'grad', self._public_key, grad,
+            self._obfuscator_pool)
         _encrypt_and_send_numbers(
-            self._bridge, 'hess', self._public_key, hess)
+            self._bridge, 'hess', self._public_key, hess,
+            self._obfuscator_pool)
         self._bridge.commit()
 
+        # overlap obfuscators of next round with growing this tree
+        if self._obfuscator_pool is not None and \
+                len(self._trees) + 1 < self._max_iters:
+            self._obfuscator_pool.refill(len(grad) + len(hess))
+
         grower = LeaderGrower(
             self._bridge, self._public_key, self._private_key,
             binned, labels, grad, hess,
+            enable_packing=self._enable_packing,
             learning_rate=self._learning_rate,
             max_depth=self._max_depth,
             max_leaves=self._max_leaves,
@@ -1381,10 +2033,10 @@ class BoostingTreeEnsamble(object):
         self._bridge.start(self._bridge.new_iter_id())
         grad = np.asarray(_receive_encrypted_numbers(
             self._bridge, 'grad', self._public_key))
-        assert len(grad) == binned.features.shape[0]
+        assert len(grad) == binned.num_samples
         hess = np.asarray(_receive_encrypted_numbers(
             self._bridge, 'hess', self._public_key))
-        assert len(hess) == binned.features.shape[0]
+        assert len(hess) == binned.num_samples
         self._bridge.commit()
         logging.info(
             'Follower starting iteration %d.',
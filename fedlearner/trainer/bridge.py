@@ -22,12 +22,15 @@ except ImportError:
     import Queue as queue
 import logging
 import os
+import zlib
 import threading
 import collections
 from concurrent import futures
 
 import grpc
+import numpy as np
 import google.protobuf.any_pb2
+import google.protobuf.message
 import tensorflow.compat.v1 as tf
 
 from fedlearner.common import common_pb2 as common_pb
@@ -36,6 +39,64 @@ from fedlearner.common import trainer_worker_service_pb2_grpc as tws_grpc
 from fedlearner.proxy.channel import make_insecure_channel, ChannelType
 from fedlearner.common import metrics
 
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# seconds to wait for earlier messages before asking for a resend
+MAX_OUT_OF_ORDER_WAIT = 1.0
+# worker threads of the grpc server. out of order calls hold a worker
+# while waiting, so the peer's window must leave room for the earlier
+# message and for heartbeats
+SERVER_MAX_WORKERS = 10
+MAX_TRANSMIT_WINDOW = SERVER_MAX_WORKERS - 2
+
+# raw tensors smaller than this are never compressed
+MIN_COMPRESS_SIZE = 4096
+# compressed data is only sent if it saves at least 10%
+MAX_COMPRESS_RATIO = 0.9
+
+# message codecs by name, fastest first
+CODECS = collections.OrderedDict()
+if lz4_frame is not None:
+    CODECS['lz4'] = (lz4_frame.compress, lz4_frame.decompress)
+if zstandard is not None:
+    CODECS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor(level=1).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data))
+CODECS['zlib'] = (lambda data: zlib.compress(data, 1), zlib.decompress)
+
+
+def make_raw_tensor(x, compression=None):
+    x = np.ascontiguousarray(x)
+    data = x.tobytes()
+    raw_tensor = tws_pb.RawTensor(dtype=x.dtype.str, shape=x.shape)
+    if compression and len(data) >= MIN_COMPRESS_SIZE:
+        compressed = CODECS[compression][0](data)
+        metrics.emit_counter('send_raw_bytes', len(data))
+        if len(compressed) <= len(data) * MAX_COMPRESS_RATIO:
+            raw_tensor.compression = compression
+            data = compressed
+        # bytes actually sent, raw when compression did not pay off
+        metrics.emit_counter('send_compressed_bytes', len(data))
+    raw_tensor.data = data
+    return raw_tensor
+
+
+def make_ndarray(raw_tensor):
+    # copied out of the immutable message bytes so that receivers own a
+    # writable array, like tf.make_ndarray returns
+    data = raw_tensor.data
+    if raw_tensor.compression:
+        data = CODECS[raw_tensor.compression][1](data)
+    return np.frombuffer(data, dtype=np.dtype(raw_tensor.dtype)) \
+        .reshape(raw_tensor.shape).copy()
+
 
 def make_ready_client(channel, stop_event=None):
     channel_ready = grpc.channel_ready_future(channel)
@@ -56,6 +117,28 @@ def make_ready_client(channel, stop_event=None):
     return tws_grpc.TrainerWorkerServiceStub(channel)
 
 
+class _ReceiveSlot(object):
+    """Data messages of one (iter_id, name). Arrivals only wake the
+    receivers waiting on this slot."""
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._items = []
+
+    def put(self, data):
+        with self._condition:
+            self._items.append(data)
+            self._condition.notifyAll()
+
+    def get(self, index=0, release=False):
+        with self._condition:
+            while len(self._items) <= index:
+                self._condition.wait()
+            data = self._items[index]
+            if release:
+                self._items[index] = None
+            return data
+
+
 class Bridge(object):
     class TrainerWorkerServicer(tws_grpc.TrainerWorkerServiceServicer):
         def __init__(self, bridge):
@@ -88,7 +171,10 @@ class Bridge(object):
                  app_id=None,
                  rank=0,
                  streaming_mode=True,
-                 compression=grpc.Compression.NoCompression):
+                 compression=grpc.Compression.NoCompression,
+                 transmit_window=1,
+                 chunk_size=2**24,
+                 message_compression=True):
         self._role = role
         self._listen_port = listen_port
         self._remote_address = remote_address
@@ -98,6 +184,17 @@ class Bridge(object):
         self._rank = rank
         self._streaming_mode = streaming_mode
         self._compression = compression
+        # max number of unacked messages in non-streaming mode, 1 sends
+        # synchronously
+        assert 1 <= transmit_window <= MAX_TRANSMIT_WINDOW, \
+            "transmit_window must be in [1, %d]"%MAX_TRANSMIT_WINDOW
+        self._transmit_window = transmit_window
+        # data messages larger than chunk_size bytes are sent in fragments
+        self._chunk_size = chunk_size
+        # codecs for raw tensors, the first one also supported by peer is
+        # used, ciphertexts and other protos are never compressed
+        self._compressions = list(CODECS) if message_compression else []
+        self._message_compression = None
 
         self._prefetch_handlers = []
         self._data_block_handler_fn = None
@@ -114,10 +211,15 @@ class Bridge(object):
         self._condition = threading.Condition()
         self._current_iter_id = None
         self._next_iter_id = 0
+        # iter_id -> name -> _ReceiveSlot, receivers may create slots
+        # before the iteration starts
         self._received_data = {}
+        self._received_chunks = []
 
         # grpc client
         self._transmit_send_lock = threading.Lock()
+        # fragments of one message are sent back to back
+        self._transmit_chunks_lock = threading.Lock()
         self._client_lock = threading.Lock()
         self._grpc_options = [
             ('grpc.max_send_message_length', 2**31-1),
@@ -133,10 +235,10 @@ class Bridge(object):
         self._client_daemon_shutdown_fn = None
 
         # server
-        self._transmit_receive_lock = threading.Lock()
+        self._transmit_receive_lock = threading.Condition()
         self._next_receive_seq_num = 0
         self._server = grpc.server(
-            futures.ThreadPoolExecutor(max_workers=10),
+            futures.ThreadPoolExecutor(max_workers=SERVER_MAX_WORKERS),
             options=self._grpc_options,
             compression=self._compression)
         tws_grpc.add_TrainerWorkerServiceServicer_to_server(
@@ -144,7 +246,9 @@ class Bridge(object):
         self._server.add_insecure_port('[::]:%d' % listen_port)
 
     def __del__(self):
-        self.terminate()
+        # __init__ may have failed on invalid arguments
+        if hasattr(self, '_connected'):
+            self.terminate()
 
     @property
     def role(self):
@@ -256,6 +360,62 @@ class Bridge(object):
                 client = make_ready_client(channel, stop_event)
                 self._check_remote_heartbeat(client)
 
+    def _transmit_daemon_fn(self):
+        # keep up to transmit_window unary calls in flight. acks are
+        # checked in seq_num order, on failure go back to the first unacked
+        # message and resend it with all later ones
+        inflight = collections.deque()
+        resend_list = collections.deque()
+        stopping = False
+        while not stopping or inflight or resend_list:
+            while len(inflight) < self._transmit_window:
+                if resend_list:
+                    msg = resend_list.popleft()
+                elif stopping:
+                    break
+                else:
+                    try:
+                        msg = self._transmit_queue.get(block=not inflight)
+                    except queue.Empty:
+                        break
+                    if msg is None:
+                        stopping = True
+                        continue
+                logging.debug("Async send message seq_num=%d", msg.seq_num)
+                with self._client_lock:
+                    future = self._client.Transmit.future(msg)
+                inflight.append((msg, future))
+
+            if not inflight:
+                continue
+            msg, future = inflight.popleft()
+            try:
+                rsp = future.result()
+                if rsp.status.code == common_pb.STATUS_SUCCESS:
+                    logging.debug("Message with seq_num=%d is confirmed",
+                                  msg.seq_num)
+                    continue
+                if rsp.status.code == common_pb.STATUS_MESSAGE_DUPLICATED:
+                    logging.debug("Resent Message with seq_num=%d is "
+                                  "confirmed", msg.seq_num)
+                    continue
+                logging.warning(
+                    "Transmit of seq_num=%d failed with %d, peer wants "
+                    "seq_num=%d", msg.seq_num, rsp.status.code,
+                    rsp.next_seq_num)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.warning("Bridge transmit failed: %s. Retry in 1s...",
+                                repr(e))
+                metrics.emit_counter('reconnect_counter', 1)
+                time.sleep(1)
+
+            pending = [msg] + [m for m, _ in inflight] + list(resend_list)
+            for _, f in inflight:
+                f.cancel()
+            inflight.clear()
+            resend_list = collections.deque(pending)
+            metrics.emit_counter('resend_counter', len(pending))
+
     def _transmit(self, msg):
         assert self._connected, "Cannot transmit before connect"
         metrics.emit_counter('send_counter', 1)
@@ -263,7 +423,7 @@ class Bridge(object):
             msg.seq_num = self._next_send_seq_num
             self._next_send_seq_num += 1
 
-            if self._streaming_mode:
+            if self._streaming_mode or self._transmit_window > 1:
                 self._transmit_queue.put(msg)
                 return
 
@@ -281,6 +441,12 @@ class Bridge(object):
             logging.debug("Received message seq_num=%d."
                           " Wanted seq_num=%d.",
                           request.seq_num, self._next_receive_seq_num)
+            # pipelined unary calls may be handled out of order, give
+            # earlier messages a moment to arrive
+            deadline = time.time() + MAX_OUT_OF_ORDER_WAIT
+            while request.seq_num > self._next_receive_seq_num and \
+                    time.time() < deadline:
+                self._transmit_receive_lock.wait(deadline - time.time())
             if request.seq_num > self._next_receive_seq_num:
                 return tws_pb.TrainerWorkerResponse(
                     status=common_pb.Status(
@@ -294,19 +460,15 @@ class Bridge(object):
 
             # request.seq_num == self._next_receive_seq_num
             self._next_receive_seq_num += 1
+            self._transmit_receive_lock.notifyAll()
 
             if request.HasField('start'):
                 with self._condition:
-                    self._received_data[request.start.iter_id] = {}
+                    self._received_data.setdefault(request.start.iter_id, {})
             elif request.HasField('commit'):
                 pass
             elif request.HasField('data'):
-                with self._condition:
-                    assert request.data.iter_id in self._received_data
-                    self._received_data[
-                        request.data.iter_id][
-                            request.data.name] = request.data
-                    self._condition.notifyAll()
+                self._data_message_handler(request.data)
             elif request.HasField('prefetch'):
                 for func in self._prefetch_handlers:
                     func(request.prefetch)
@@ -319,6 +481,29 @@ class Bridge(object):
             return tws_pb.TrainerWorkerResponse(
                 next_seq_num=self._next_receive_seq_num)
 
+    def _data_message_handler(self, data):
+        if data.num_chunks > 0:
+            # fragments of different messages never interleave, unchunked
+            # messages may arrive in between
+            assert data.chunk_index == len(self._received_chunks)
+            self._received_chunks.append(data.chunk)
+            if len(self._received_chunks) < data.num_chunks:
+                return
+            data = tws_pb.DataMessage.FromString(
+                b''.join(self._received_chunks))
+            self._received_chunks = []
+
+        with self._condition:
+            assert data.iter_id in self._received_data
+        self._receive_slot(data.iter_id, data.name).put(data)
+
+    def _receive_slot(self, iter_id, name):
+        with self._condition:
+            slots = self._received_data.setdefault(iter_id, {})
+            if name not in slots:
+                slots[name] = _ReceiveSlot()
+            return slots[name]
+
     def _data_block_handler(self, request):
         assert self._connected, "Cannot load data before connect"
         if not self._data_block_handler_fn:
@@ -353,8 +538,17 @@ class Bridge(object):
                 self._connected = True
                 self._condition.notifyAll()
 
+        self._set_message_compression(request.compressions)
         return tws_pb.ConnectResponse(app_id=self._app_id,
-                                      worker_rank=self._rank)
+                                      worker_rank=self._rank,
+                                      compressions=self._compressions)
+
+    def _set_message_compression(self, peer_compressions):
+        for name in self._compressions:
+            if name in peer_compressions:
+                self._message_compression = name
+                break
+        logging.debug('Message compression: %s', self._message_compression)
 
     def _heartbeat_handler(self, request):
         return tws_pb.HeartbeatResponse(app_id=self._app_id,
@@ -387,11 +581,13 @@ class Bridge(object):
         # Get ACK from peer
         msg = tws_pb.ConnectRequest(app_id=self._app_id,
                                     worker_rank=self._rank,
-                                    identifier=self._identifier)
+                                    identifier=self._identifier,
+                                    compressions=self._compressions)
 
-        self._rpc_with_retry(
+        rsp = self._rpc_with_retry(
             lambda: self._client.Connect(msg),
             "Bridge failed to connect")
+        self._set_message_compression(rsp.compressions)
         logging.debug('Has connected to peer.')
 
         # Ensure REQ from peer
@@ -405,6 +601,13 @@ class Bridge(object):
             self._client_daemon = threading.Thread(
                 target=self._client_daemon_fn)
             self._client_daemon.start()
+        elif self._transmit_window > 1:
+            logging.debug('enter async transmit mode.')
+            self._client_daemon_shutdown_fn = \
+                lambda: self._transmit_queue.put(None)
+            self._client_daemon = threading.Thread(
+                target=self._transmit_daemon_fn)
+            self._client_daemon.start()
         logging.debug('finish connect.')
 
     def terminate(self, forced=False):
@@ -431,7 +634,8 @@ class Bridge(object):
             while not self._peer_terminated:
                 self._condition.wait()
 
-        self._server.stop(None)
+        # let the response to peer's terminate request go out first
+        self._server.stop(1).wait()
         logging.debug("Bridge connection terminated")
 
     @property
@@ -486,22 +690,65 @@ class Bridge(object):
             iter_id=iter_id, sample_ids=sample_ids))
         self._transmit(msg)
 
+    def _make_data_message(self, iter_id, name, x):
+        if isinstance(x, google.protobuf.message.Message):
+            any_proto = google.protobuf.any_pb2.Any()
+            any_proto.Pack(x)
+            return tws_pb.DataMessage(
+                iter_id=iter_id, name=name, any_data=any_proto)
+        x = np.asarray(x)
+        if x.dtype.kind in 'biuf':
+            return tws_pb.DataMessage(
+                iter_id=iter_id, name=name,
+                raw_tensor=make_raw_tensor(x, self._message_compression))
+        # strings and objects still go through TensorProto
+        return tws_pb.DataMessage(
+            iter_id=iter_id, name=name, tensor=tf.make_tensor_proto(x))
+
+    def _transmit_data(self, data):
+        size = data.ByteSize()
+        if size <= self._chunk_size:
+            msg = tws_pb.TrainerWorkerMessage(data=data)
+            self._transmit(msg)
+            return msg
+
+        serialized = data.SerializeToString()
+        num_chunks = (size + self._chunk_size - 1)//self._chunk_size
+        with self._transmit_chunks_lock:
+            for i in range(num_chunks):
+                msg = tws_pb.TrainerWorkerMessage(data=tws_pb.DataMessage(
+                    iter_id=data.iter_id, name=data.name,
+                    num_chunks=num_chunks, chunk_index=i,
+                    chunk=serialized[
+                        i*self._chunk_size:(i+1)*self._chunk_size]))
+                self._transmit(msg)
+        return msg
+
     def send_proto(self, iter_id, name, proto):
-        any_proto = google.protobuf.any_pb2.Any()
-        any_proto.Pack(proto)
-        msg = tws_pb.TrainerWorkerMessage(data=tws_pb.DataMessage(
-            iter_id=iter_id, name=name, any_data=any_proto))
-        self._transmit(msg)
+        msg = self._transmit_data(
+            self._make_data_message(iter_id, name, proto))
         logging.debug('Data: send protobuf %s for iter %d. seq_num=%d.',
                       name, iter_id, msg.seq_num)
 
     def send(self, iter_id, name, x):
-        msg = tws_pb.TrainerWorkerMessage(data=tws_pb.DataMessage(
-            iter_id=iter_id, name=name, tensor=tf.make_tensor_proto(x)))
-        self._transmit(msg)
+        msg = self._transmit_data(self._make_data_message(iter_id, name, x))
         logging.debug('Data: send %s for iter %d. seq_num=%d.',
                       name, iter_id, msg.seq_num)
 
+    def send_stream(self, iter_id, name, items):
+        """Send arrays or protos from items one by one under name, each is
+        transmitted as soon as it is produced."""
+        num_items = 0
+        for item in items:
+            data = self._make_data_message(iter_id, name, item)
+            data.is_stream = True
+            self._transmit_data(data)
+            num_items += 1
+        self._transmit_data(tws_pb.DataMessage(
+            iter_id=iter_id, name=name, is_stream=True, end_of_stream=True))
+        logging.debug('Data: send stream %s of %d items for iter %d.',
+                      name, num_items, iter_id)
+
     def send_op(self, name, x):
         def func(x):
             assert self._current_iter_id is not None, "Bridge not started"
@@ -513,11 +760,7 @@ class Bridge(object):
     def receive_proto(self, iter_id, name):
         logging.debug('Data: Waiting to receive proto %s for iter %d.',
                       name, iter_id)
-        with self._condition:
-            while (iter_id not in self._received_data) \
-                    or (name not in self._received_data[iter_id]):
-                self._condition.wait()
-            data = self._received_data[iter_id][name]
+        data = self._receive_slot(iter_id, name).get()
         logging.debug('Data: received %s for iter %d.', name, iter_id)
         return data.any_data
 
@@ -525,18 +768,38 @@ class Bridge(object):
         logging.debug('Data: Waiting to receive %s for iter %d.', name,
                       iter_id)
         start_time = time.time()
-        with self._condition:
-            while (iter_id not in self._received_data) \
-                    or (name not in self._received_data[iter_id]):
-                self._condition.wait()
-            data = self._received_data[iter_id][name]
+        data = self._receive_slot(iter_id, name).get()
         duration = time.time() - start_time
         metrics.emit_timer('receive_timer', duration)
         logging.debug(
             'Data: received %s for iter %d after %f sec.',
             name, iter_id, duration)
+        return self._decode_data(data)
+
+    def _decode_data(self, data):
+        if data.HasField('any_data'):
+            return data.any_data
+        if data.HasField('raw_tensor'):
+            return make_ndarray(data.raw_tensor)
         return tf.make_ndarray(data.tensor)
 
+    def receive_stream(self, iter_id, name):
+        """Yield items of a stream sent by send_stream as they arrive,
+        arrays for arrays and Any for protos."""
+        logging.debug('Data: Waiting to receive stream %s for iter %d.',
+                      name, iter_id)
+        slot = self._receive_slot(iter_id, name)
+        index = 0
+        while True:
+            # consumed items are released right away
+            data = slot.get(index, release=True)
+            if data.end_of_stream:
+                break
+            index += 1
+            yield self._decode_data(data)
+        logging.debug('Data: received stream %s of %d items for iter %d.',
+                      name, index, iter_id)
+
     def receive_op(self, name, dtype):
         def func():
             assert self._current_iter_id is not None, "Bridge not started"
@@ -0,0 +1,97 @@
+# Copyright 2020 The FedLearner Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# coding: utf-8
+
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+from fedlearner.common import data_join_service_pb2 as dj_pb
+from fedlearner.data_join import common, visitor
+from fedlearner.data_join.raw_data_iter_impl.csv_dict_iter import \
+    CsvDictIter, CsvRecordBatch
+from fedlearner.data_join.raw_data_iter_impl.raw_data_iter import RawDataIter
+
+class TestCsvDictIter(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _write_csv(self, fname, rows, lineterminator='\n'):
+        fpath = os.path.join(self._dir, fname)
+        with open(fpath, 'w', newline='') as fh:
+            writer = csv.writer(fh, lineterminator=lineterminator)
+            writer.writerow(['example_id', 'event_time', 'raw_id', 'feat'])
+            writer.writerows(rows)
+        return fpath
+
+    def _read_all(self, fpath, read_ahead_size):
+        options = dj_pb.RawDataOptions(raw_data_iter='CSV_DICT',
+                                       read_ahead_size=read_ahead_size)
+        rd_iter = CsvDictIter(options)
+        rd_iter.reset_iter(visitor.IndexMeta(0, 0, fpath))
+        # the first row is the current item after reset
+        batches = [RawDataIter.RecordBatch([rd_iter.get_item()])]
+        try:
+            while True:
+                batches.append(rd_iter.next_batch(100)[1])
+        except StopIteration:
+            pass
+        return batches
+
+    def _check(self, fpath, read_ahead_size):
+        with open(fpath, newline='') as fh:
+            expected = list(csv.DictReader(fh))
+        batches = self._read_all(fpath, read_ahead_size)
+        self.assertEqual(sum(len(batch) for batch in batches), len(expected))
+        example_ids, event_times, raws = [], [], []
+        for batch in batches:
+            example_ids.extend(batch.example_ids)
+            event_times.extend(batch.event_times)
+            raws.extend(dict(item.csv_record) for item in batch)
+        self.assertEqual(raws, [dict(raw) for raw in expected])
+        self.assertEqual(example_ids,
+                         [raw['example_id'].encode() for raw in expected])
+        return batches, event_times
+
+    def test_csv_dict_iter(self):
+        rows = [[str(i), str(20200101 + i), 'raw_%d'%i, str(i * 0.5)]
+                for i in range(1000)]
+        for lineterminator in ['\n', '\r\n']:
+            fpath = self._write_csv('0.csv', rows, lineterminator)
+            for read_ahead_size in [0, 1 << 10, 1 << 20]:
+                batches, event_times = self._check(fpath, read_ahead_size)
+                self.assertTrue(all(isinstance(batch, CsvRecordBatch)
+                                    for batch in batches[1:]))
+                self.assertEqual(event_times,
+                                 [20200101 + i for i in range(1000)])
+        item = batches[1].get_item(2)
+        self.assertEqual(item.raw_id, b'raw_3')
+        self.assertEqual(item.csv_record['feat'], '1.5')
+
+        # quoted fields and invalid event times
+        rows[10][3] = 'a,"b"'
+        rows[900][1] = 'abc'
+        fpath = self._write_csv('1.csv', rows)
+        _, event_times = self._check(fpath, 1 << 10)
+        self.assertEqual(event_times[10], 20200111)
+        self.assertEqual(event_times[900], common.InvalidEventTime)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -120,6 +120,11 @@ class TestDumpedExampleId(unittest.TestCase):
             expected_index += 1
         self.assertEqual(10240, expected_index)
         self.assertTrue(visitor.finished())
+        # jump by the offset index of the dumped file
+        visitor.seek(5000)
+        self.assertEqual(5000, visitor.get_item().index)
+        visitor.seek(4500)
+        self.assertEqual(4500, visitor.get_item().index)
         visitor.seek(200)
         expected_index = 200
         self.assertEqual(expected_index, visitor.get_index())
@@ -34,7 +34,10 @@ from fedlearner.data_join import (
     example_id_dumper, raw_data_visitor, visitor
 )
 from fedlearner.data_join.data_block_manager import DataBlockBuilder
-from fedlearner.data_join.raw_data_iter_impl.tf_record_iter import TfExampleItem
+from fedlearner.data_join.raw_data_iter_impl.tf_record_iter import \
+    TfExampleItem, TfRecordBatch
+from fedlearner.data_join.joiner_impl.stream_joiner import \
+    _JoinWindow, _CmpCtnt
 
 class TestExampleJoin(unittest.TestCase):
     def setUp(self):
@@ -233,6 +236,41 @@ class TestExampleJoin(unittest.TestCase):
               self.example_joiner_options.min_matching_window,
               self.example_joiner_options.max_matching_window))
 
+    def test_join_window(self):
+        window = _JoinWindow(0.05, 0.90)
+        window.append_batch(0, TfRecordBatch(
+                ['i%d' % i for i in range(4)], [b'3', b'1', b'2', b'1'],
+                [5, 3, 5, 4], [b''] * 4))
+        # only the valid items of a batch are appended
+        window.append_batch(4, TfRecordBatch(
+                ['x', 'i4'], [common.InvalidExampleId, b'0'],
+                [0, 1], [b''] * 2), [1])
+        self.assertEqual(window.size(), 5)
+        self.assertTrue(window.forward_pt())
+        self.assertEqual(window.committed_pt(), _CmpCtnt(1, b'0'))
+        self.assertEqual(window.qt(), _CmpCtnt(5, b'3'))
+        probe_ids = [b'1', b'9', b'2']
+        positions = window.find([hash(eid) for eid in probe_ids], probe_ids)
+        # the latest item of a duplicated example id is found
+        self.assertEqual(list(positions), [3, -1, 2])
+        self.assertEqual([(index, item.tf_record) for index, item in
+                          window.entries(positions[[0, 2]])],
+                         [(3, 'i3'), (2, 'i2')])
+        self.assertEqual(list(window.before(_CmpCtnt(5, b'3'))),
+                         [False, True, True, True, True])
+        window.evict(window.before(_CmpCtnt(4, b'1')))
+        self.assertEqual(window.index_example_ids(0, window.size()),
+                         [(0, b'3'), (2, b'2'), (3, b'1')])
+        self.assertEqual(list(window.indices), [0, 2, 3])
+        # the batch of which all items are evicted is released
+        self.assertEqual(len(window._batches), 1)
+        self.assertTrue(window.forward_pt())
+        self.assertEqual(window.committed_pt(), _CmpCtnt(4, b'1'))
+        self.assertFalse(window.forward_pt())
+        window.reset(True)
+        self.assertEqual(window.size(), 0)
+        self.assertIsNone(window.committed_pt())
+
     def tearDown(self):
         if gfile.Exists(self.data_source.output_base_dir):
             gfile.DeleteRecursively(self.data_source.output_base_dir)
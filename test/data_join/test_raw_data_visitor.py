@@ -176,6 +176,47 @@ class TestRawDataVisitor(unittest.TestCase):
         self.assertEqual(expected_index, 400)
         self.assertTrue(rdv2.finished())
 
+    def test_raw_data_visitor_batch(self):
+        manifest = self.manifest_manager.alloc_sync_exampld_id(2)
+        raw_data_options = dj_pb.RawDataOptions(raw_data_iter='TF_RECORD', read_ahead_size=1<<20, read_batch_size=32)
+        rdv = raw_data_visitor.RawDataVisitor(
+                self.etcd, self.data_source,
+                manifest.partition_id, raw_data_options
+            )
+        self._gen_raw_data_file(0, 2)
+        rdv.active_visitor()
+        expected_index = 0
+        while True:
+            try:
+                index, batch = rdv.next_batch(50)
+            except StopIteration:
+                break
+            self.assertEqual(index, expected_index)
+            self.assertEqual(batch.example_ids,
+                             ['{}'.format(i).encode()
+                              for i in range(index, index + len(batch))])
+            self.assertEqual(batch.event_times,
+                             [common.InvalidEventTime] * len(batch))
+            self.assertEqual([item.example_id for item in batch],
+                             batch.example_ids)
+            self.assertLessEqual(len(batch), 50)
+            # a batch never crosses the boundary of raw data files
+            self.assertEqual(index // 100, (index + len(batch) - 1) // 100)
+            expected_index += len(batch)
+        self.assertEqual(expected_index, 200)
+        self.assertTrue(rdv.finished())
+
+        index, item = rdv.seek(120)
+        self.assertEqual(item.example_id, b'120')
+        index, item = next(rdv)
+        self.assertEqual(index, 121)
+        index, batch = rdv.next_batch(10)
+        self.assertEqual(index, 122)
+        self.assertEqual(batch.example_ids[-1], b'131')
+        index, item = next(rdv)
+        self.assertEqual(item.example_id, b'132')
+        self.assertEqual(rdv.seek(60)[1].example_id, b'60')
+
     def tearDown(self):
         self.etcd.delete_prefix(common.data_source_etcd_base_dir(self.data_source.data_source_meta.name))
         if gfile.Exists(self.raw_data_dir):
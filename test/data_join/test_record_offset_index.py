@@ -0,0 +1,107 @@
+# Copyright 2020 The FedLearner Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import tensorflow.compat.v1 as tf
+tf.enable_eager_execution()
+from tensorflow.compat.v1 import gfile
+
+from fedlearner.common import data_join_service_pb2 as dj_pb
+from fedlearner.data_join import visitor
+from fedlearner.data_join.output_writer_impl import create_output_writer
+from fedlearner.data_join.raw_data_iter_impl.tf_record_iter import \
+    TfExampleItem, TfRecordIter
+from fedlearner.data_join.record_offset_index import (
+    load_record_offset_index, find_checkpoint, iter_tf_records,
+    encode_offset_index_fpath
+)
+
+class TestRecordOffsetIndex(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _write_file(self, fname, num, compressed_type=''):
+        writer_options = dj_pb.WriterOptions(output_writer='TF_RECORD',
+                                             compressed_type=compressed_type,
+                                             offset_index=True)
+        tmp_fpath = os.path.join(self._dir, fname + '.tmp')
+        writer = create_output_writer(writer_options, tmp_fpath)
+        for i in range(num):
+            feat = {'example_id': tf.train.Feature(
+                bytes_list=tf.train.BytesList(value=[str(i).encode()]))}
+            example = tf.train.Example(
+                features=tf.train.Features(feature=feat))
+            writer.write_item(TfExampleItem(example.SerializeToString()))
+        writer.close()
+        fpath = os.path.join(self._dir, fname)
+        gfile.Rename(tmp_fpath, fpath)
+        writer.write_offset_index(fpath)
+        return fpath
+
+    def test_offset_index(self):
+        fpath = self._write_file('0.rd', 5000)
+        index = load_record_offset_index(fpath)
+        self.assertEqual(list(index.item_index), [0, 1024, 2048, 3072, 4096])
+        self.assertEqual(index.file_size, os.path.getsize(fpath))
+        self.assertEqual(find_checkpoint(index, 2047)[0], 1024)
+        self.assertEqual(find_checkpoint(index, 2048)[0], 2048)
+        records = list(iter_tf_records(fpath, index.offset[2], 100))
+        self.assertEqual(len(records), 5000 - 2048)
+        self.assertEqual(TfExampleItem(records[0]).example_id, b'2048')
+        self.assertEqual(TfExampleItem(records[-1]).example_id, b'4999')
+
+        # a compressed file is not indexed
+        gzip_fpath = self._write_file('1.rd', 10, 'GZIP')
+        self.assertFalse(gfile.Exists(encode_offset_index_fpath(gzip_fpath)))
+        self.assertIsNone(load_record_offset_index(gzip_fpath))
+
+        # the index is ignored if the file is rewritten without it
+        shutil.copy(encode_offset_index_fpath(fpath),
+                    encode_offset_index_fpath(gzip_fpath))
+        self.assertIsNone(load_record_offset_index(gzip_fpath))
+
+    def test_seek_by_offset_index(self):
+        fpath = self._write_file('0.rd', 5000)
+        options = dj_pb.RawDataOptions(raw_data_iter='TF_RECORD',
+                                       read_ahead_size=1<<12,
+                                       read_batch_size=64)
+        rd_iter = TfRecordIter(options)
+        rd_iter.reset_iter(visitor.IndexMeta(0, 100, fpath))
+        with mock.patch.object(TfRecordIter, '_reset_iter_at_offset',
+                               wraps=rd_iter._reset_iter_at_offset) as jump:
+            for target in [3500, 3600, 1500, 120, 5099]:
+                rd_iter.seek_to_target(target)
+                self.assertEqual(rd_iter.get_index(), target)
+                self.assertEqual(rd_iter.get_item().example_id,
+                                 str(target - 100).encode())
+            # seeking forward within a checkpoint interval doesn't jump
+            self.assertEqual(jump.call_count, 4)
+        self.assertRaises(StopIteration, rd_iter.next_batch, 10)
+        rd_iter.seek_to_target(4000)
+        index, batch = rd_iter.next_batch(100)
+        self.assertEqual(index, 4001)
+        self.assertEqual(batch.example_ids[0], b'3901')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# Copyright 2020 The FedLearner Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# coding: utf-8
+
+import unittest
+
+import tensorflow.compat.v1 as tf
+
+from fedlearner.data_join import common
+from fedlearner.data_join.raw_data_iter_impl.tf_record_iter import \
+    TfExampleItem, extract_tf_example_fields
+
+class TestTfExampleItem(unittest.TestCase):
+    def _make_record(self, **kwargs):
+        feat = {}
+        for i in range(20):
+            feat['f%d'%i] = tf.train.Feature(
+                float_list=tf.train.FloatList(value=[i*0.5]))
+        for key, value in kwargs.items():
+            if isinstance(value, int):
+                feat[key] = tf.train.Feature(
+                    int64_list=tf.train.Int64List(value=[value, 1]))
+            elif isinstance(value, bytes):
+                feat[key] = tf.train.Feature(
+                    bytes_list=tf.train.BytesList(value=[value, b'x']))
+            else:
+                feat[key] = value
+        example = tf.train.Example(features=tf.train.Features(feature=feat))
+        return example.SerializeToString()
+
+    def _check_item(self, record, example_id, event_time, raw_id):
+        item = TfExampleItem(record)
+        self.assertEqual(item.example_id, example_id)
+        self.assertEqual(item.event_time, event_time)
+        self.assertEqual(item.raw_id, raw_id)
+        self.assertEqual(item.tf_record, record)
+
+    def test_key_fields(self):
+        record = self._make_record(example_id=b'id_' + b'a'*200,
+                                   event_time=20200101, raw_id=b'raw')
+        self.assertEqual(sorted(extract_tf_example_fields(record)),
+                         [b'event_time', b'example_id', b'raw_id'])
+        self._check_item(record, b'id_' + b'a'*200, 20200101, b'raw')
+        self.assertEqual(TfExampleItem(record).csv_record['f3'], 1.5)
+
+        self._check_item(self._make_record(example_id=b'1', event_time=-5),
+                         b'1', -5, common.InvalidRawId)
+        self._check_item(self._make_record(event_time=b'20201231'),
+                         common.InvalidExampleId, 20201231,
+                         common.InvalidRawId)
+        self._check_item(self._make_record(), common.InvalidExampleId,
+                         common.InvalidEventTime, common.InvalidRawId)
+
+    def test_fallback(self):
+        # records the scanner rejects get the same result as a full parse
+        self._check_item(self._make_record(
+            example_id=1, event_time=tf.train.Feature()),
+            common.InvalidExampleId, common.InvalidEventTime,
+            common.InvalidRawId)
+        self._check_item(self._make_record(
+            example_id=tf.train.Feature(bytes_list=tf.train.BytesList())),
+            common.InvalidExampleId, common.InvalidEventTime,
+            common.InvalidRawId)
+        record = self._make_record(example_id=b'1')
+        self._check_item(record[:-3], common.InvalidExampleId,
+                         common.InvalidEventTime, common.InvalidRawId)
+
+        # map entry with its value before the key
+        feature = tf.train.Feature(
+            bytes_list=tf.train.BytesList(value=[b'1'])).SerializeToString()
+        entry = b'\x12' + bytes([len(feature)]) + feature + \
+            b'\x0a\x0aexample_id'
+        features = b'\x0a' + bytes([len(entry)]) + entry
+        record = b'\x0a' + bytes([len(features)]) + features
+        with self.assertRaises(ValueError):
+            extract_tf_example_fields(record)
+        self._check_item(record, b'1', common.InvalidEventTime,
+                         common.InvalidRawId)
+
+    def test_repeated_key(self):
+        # merged examples repeat keys, the last one wins like a full parse
+        record = self._make_record(
+            example_id=b'1', event_time=5, raw_id=b'r') + \
+            self._make_record(example_id=b'2')
+        example = tf.train.Example()
+        example.ParseFromString(record)
+        self.assertEqual(
+            example.features.feature['example_id'].bytes_list.value[0], b'2')
+        self._check_item(record, b'2', 5, b'r')
+
+if __name__ == '__main__':
+    unittest.main()
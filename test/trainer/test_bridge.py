@@ -107,6 +107,137 @@ class TestBridge(unittest.TestCase):
         bridge2.terminate()
         t.join()
 
+    def test_raw_tensor(self):
+        for x in [np.arange(12, dtype=np.float32).reshape(3, 4),
+                  np.asfortranarray(np.arange(6).reshape(2, 3)),
+                  np.asarray([True, False]), np.int32(7),
+                  np.zeros((0, 5), dtype=np.uint8)]:
+            y = fl.trainer.bridge.make_ndarray(
+                fl.trainer.bridge.make_raw_tensor(x))
+            self.assertEqual(y.dtype, x.dtype)
+            self.assertTrue(y.flags.writeable)
+            np.testing.assert_equal(y, x)
+
+        # compressed only when it saves enough
+        x = np.zeros((100, 100), dtype=bool)
+        raw_tensor = fl.trainer.bridge.make_raw_tensor(x, 'zlib')
+        self.assertEqual(raw_tensor.compression, 'zlib')
+        self.assertLess(len(raw_tensor.data), x.size)
+        y = fl.trainer.bridge.make_ndarray(raw_tensor)
+        self.assertTrue(y.flags.writeable)
+        np.testing.assert_equal(y, x)
+        x = np.random.uniform(size=10000)
+        raw_tensor = fl.trainer.bridge.make_raw_tensor(x, 'zlib')
+        self.assertEqual(raw_tensor.compression, '')
+        np.testing.assert_equal(fl.trainer.bridge.make_ndarray(raw_tensor), x)
+
+    def test_transmit_window(self):
+        # a full window must not exhaust the peer's server workers
+        with self.assertRaises(AssertionError):
+            fl.trainer.bridge.Bridge(
+                'leader', 49955, 'localhost:49956', streaming_mode=False,
+                transmit_window=fl.trainer.bridge.SERVER_MAX_WORKERS)
+
+        bridge1 = fl.trainer.bridge.Bridge(
+            'leader', 49955, 'localhost:49956', streaming_mode=False,
+            transmit_window=8, chunk_size=1000)
+        bridge2 = fl.trainer.bridge.Bridge(
+            'follower', 49956, 'localhost:49955', streaming_mode=False)
+
+        t = threading.Thread(target=lambda _: bridge1.connect(), args=(None,))
+        t.start()
+        bridge2.connect()
+        t.join()
+        self.assertEqual(bridge1._message_compression,
+                         list(fl.trainer.bridge.CODECS)[0])
+
+        for iter_id in range(3):
+            # receivers may wait before the peer starts the iteration
+            early = []
+            receiver = threading.Thread(target=lambda i: early.append(
+                bridge2.receive(i, 'early')), args=(iter_id,))
+            receiver.start()
+            time.sleep(0.1)
+            bridge1.start(iter_id)
+            bridge2.start(iter_id)
+            bridge1.send(iter_id, 'early', np.asarray([iter_id]))
+            receiver.join()
+            np.testing.assert_equal(early[0], [iter_id])
+            for i in range(20):
+                bridge1.send(iter_id, 'x_%d'%i, np.asarray([iter_id, i]))
+            for i in range(20):
+                np.testing.assert_equal(
+                    bridge2.receive(iter_id, 'x_%d'%i), [iter_id, i])
+            # payloads above chunk_size are fragmented and reassembled
+            x = np.random.normal(size=(100, 10))
+            bridge1.send(iter_id, 'large', x)
+            np.testing.assert_equal(bridge2.receive(iter_id, 'large'), x)
+            x = np.arange(10000) // 100
+            bridge1.send(iter_id, 'compressed', x)
+            np.testing.assert_equal(
+                bridge2.receive(iter_id, 'compressed'), x)
+            bridge1.send_stream(
+                iter_id, 'stream',
+                (np.full(j*100, j) for j in range(5)))
+            for j, y in enumerate(bridge2.receive_stream(iter_id, 'stream')):
+                np.testing.assert_equal(y, np.full(j*100, j))
+            self.assertEqual(j, 4)
+            bridge1.send(iter_id, 'ids', np.asarray(['a', 'b']))
+            self.assertEqual(list(bridge2.receive(iter_id, 'ids')),
+                             [b'a', b'b'])
+            bridge1.commit()
+            bridge2.commit()
+
+        t = threading.Thread(target=lambda _: bridge1.terminate(), args=(None,))
+        t.start()
+        bridge2.terminate()
+        t.join()
+        self.assertEqual(
+            bridge2._next_receive_seq_num, bridge1._next_send_seq_num)
+
+    def test_concurrent_chunks(self):
+        bridge1 = fl.trainer.bridge.Bridge(
+            'leader', 49957, 'localhost:49958', streaming_mode=False,
+            transmit_window=4, chunk_size=1000)
+        bridge2 = fl.trainer.bridge.Bridge(
+            'follower', 49958, 'localhost:49957', streaming_mode=False)
+
+        t = threading.Thread(target=lambda _: bridge1.connect(), args=(None,))
+        t.start()
+        bridge2.connect()
+        t.join()
+
+        # yield between fragments so that senders run interleaved
+        transmit = bridge1._transmit
+        def slow_transmit(msg):
+            time.sleep(0.001)
+            transmit(msg)
+        bridge1._transmit = slow_transmit
+
+        bridge1.start(0)
+        bridge2.start(0)
+        # fragments of messages sent from different threads must not mix
+        xs = [np.random.normal(size=(100, 20)) for _ in range(4)]
+        barrier = threading.Barrier(len(xs))
+        def send(i):
+            barrier.wait()
+            bridge1.send(0, 'x_%d'%i, xs[i])
+        senders = [threading.Thread(target=send, args=(i,))
+                   for i in range(len(xs))]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        for i, x in enumerate(xs):
+            np.testing.assert_equal(bridge2.receive(0, 'x_%d'%i), x)
+        bridge1.commit()
+        bridge2.commit()
+
+        t = threading.Thread(target=lambda _: bridge1.terminate(), args=(None,))
+        t.start()
+        bridge2.terminate()
+        t.join()
+
 
 if __name__ == '__main__':
         unittest.main()
@@ -15,6 +15,8 @@
 # coding: utf-8
 
 import unittest
+import multiprocessing as mp
+import numpy as np
 from fedlearner.model.crypto import paillier
 
 
@@ -34,6 +36,59 @@ class TestPaillier(unittest.TestCase):
 
         self.assertAlmostEqual(c, a + b)
 
+    def test_encrypt_batch(self):
+        public_key, private_key = paillier.PaillierKeypair.generate_keypair()
+        values = np.asarray([3.14159, -101.0, 0.0, 1e-5, -2.5e10])
+
+        ciphers = public_key.encrypt_batch(values, precision=1e30)
+        for value, cipher in zip(values, ciphers):
+            self.assertEqual(
+                cipher.exponent, public_key.encrypt(value, 1e30).exponent)
+            self.assertAlmostEqual(private_key.decrypt(cipher), value)
+
+        ciphers = public_key.encrypt_batch(values)
+        for value, cipher in zip(values, ciphers):
+            self.assertEqual(
+                cipher.exponent, public_key.encrypt(value).exponent)
+            self.assertAlmostEqual(private_key.decrypt(cipher), value)
+
+        obfuscator_pool = paillier.PaillierObfuscatorPool(
+            public_key, mp.Pool(2), chunk_size=2)
+        obfuscator_pool.refill(3)
+        self.assertEqual(len(obfuscator_pool), 3)
+        ciphers = public_key.encrypt_batch(
+            values, precision=1e30, obfuscator_pool=obfuscator_pool)
+        self.assertEqual(len(obfuscator_pool), 0)
+        self.assertEqual(len(set(i.ciphertext(False) for i in ciphers)), 5)
+        for value, cipher in zip(values, ciphers):
+            self.assertAlmostEqual(private_key.decrypt(cipher), value)
+
+        # background refill is bounded, get is not
+        obfuscator_pool = paillier.PaillierObfuscatorPool(
+            public_key, mp.Pool(2), chunk_size=2, max_size=4)
+        obfuscator_pool.refill(10)
+        self.assertEqual(len(obfuscator_pool), 4)
+        obfuscator_pool.refill(10)
+        self.assertEqual(len(obfuscator_pool), 4)
+        self.assertEqual(len(obfuscator_pool.get(6)), 6)
+        self.assertEqual(len(obfuscator_pool), 0)
+
+    def test_decrypt_batch(self):
+        public_key, private_key = paillier.PaillierKeypair.generate_keypair()
+        values = np.asarray([3.14159, -101.0, 0.0, 1e-5, -2.5e10])
+        ciphers = [public_key.encrypt(i) for i in values]
+
+        self.assertEqual(
+            private_key.raw_decrypt_batch(
+                [i.ciphertext(False) for i in ciphers]),
+            [private_key.raw_decrypt(i.ciphertext(False)) for i in ciphers])
+        decrypted = private_key.decrypt_batch(
+            [i.ciphertext(False) for i in ciphers],
+            [i.exponent for i in ciphers])
+        for value, cipher, plain in zip(values, ciphers, decrypted):
+            self.assertEqual(plain, private_key.decrypt(cipher))
+            self.assertAlmostEqual(plain, value)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,175 @@
+# Copyright 2020 The FedLearner Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing as mp
+import numpy as np
+
+from fedlearner.model.tree.tree import BoostingTreeEnsamble
+from fedlearner.model.tree import trainer
+from fedlearner.model.tree.trainer import read_data, read_data_dir, \
+    create_argument_parser, DataChunkReader, load_binned_features
+
+
+class TestTrainer(unittest.TestCase):
+    def setUp(self):
+        self._data_path = tempfile.mkdtemp()
+        self._cache_path = tempfile.mkdtemp()
+        np.random.seed(123)
+        self._features = np.random.normal(size=(30, 2)).astype(np.float32)
+        self._cat_features = np.random.randint(0, 5, size=(30, 1))
+        self._labels = np.random.randint(0, 2, size=30)
+        for i in range(3):
+            with open(os.path.join(
+                    self._data_path, 'part-%d.csv'%i), 'w') as fout:
+                fout.write('example_id,label,f1,f0,c0\n')
+                for j in range(i*10, (i+1)*10):
+                    fout.write('%d,%d,%r,%r,%d\n'%(
+                        j, self._labels[j], float(self._features[j, 1]),
+                        float(self._features[j, 0]), self._cat_features[j, 0]))
+
+    def tearDown(self):
+        shutil.rmtree(self._data_path)
+        shutil.rmtree(self._cache_path)
+
+    def check_data(self, data, begin, end):
+        features, cat_features, cont_columns, cat_columns, \
+            labels, example_ids, raw_ids = data
+        self.assertEqual(cont_columns, ['f0', 'f1'])
+        self.assertEqual(cat_columns, ['c0'])
+        self.assertEqual(features.dtype, np.float32)
+        self.assertEqual(cat_features.dtype, np.int32)
+        np.testing.assert_equal(features, self._features[begin:end])
+        np.testing.assert_equal(cat_features, self._cat_features[begin:end])
+        np.testing.assert_equal(labels, self._labels[begin:end])
+        self.assertEqual(example_ids, [str(i) for i in range(begin, end)])
+        self.assertIsNone(raw_ids)
+
+    def test_read_data(self):
+        self.check_data(
+            read_data('csv', os.path.join(self._data_path, 'part-1.csv'),
+                      True, True, '', 'c0'),
+            10, 20)
+
+        # files longer than a read chunk are parsed a chunk at a time
+        read_chunk_size = trainer.READ_CHUNK_SIZE
+        trainer.READ_CHUNK_SIZE = 3
+        try:
+            self.check_data(
+                read_data('csv', os.path.join(self._data_path, 'part-1.csv'),
+                          True, True, '', 'c0'),
+                10, 20)
+        finally:
+            trainer.READ_CHUNK_SIZE = read_chunk_size
+
+    def test_read_data_dir(self):
+        # a pool given by the booster is used instead of forking one
+        pool = mp.Pool(2)
+        for num_parallel, data_pool in [(1, None), (2, None), (2, pool)]:
+            data = read_data_dir(
+                '.csv', 'csv', self._data_path, True, True, '', 'c0',
+                num_parallel=num_parallel, pool=data_pool)
+            order = np.argsort(np.asarray(data[5], dtype=np.int64))
+            data = (data[0][order], data[1][order], data[2], data[3],
+                    data[4][order], [data[5][i] for i in order], data[6])
+            self.check_data(data, 0, 30)
+        pool.close()
+        pool.join()
+
+        data = read_data_dir(
+            '.csv', 'csv', self._data_path, True, True, '', 'c0',
+            cache_path=self._cache_path)
+        self.assertEqual(len(os.listdir(self._cache_path)), 1)
+        cached_data = read_data_dir(
+            '.csv', 'csv', self._data_path, True, True, '', 'c0',
+            cache_path=self._cache_path)
+        for value, cached_value in zip(data, cached_data):
+            np.testing.assert_equal(value, cached_value)
+
+        # modifying a file invalidates the cache
+        os.remove(os.path.join(self._data_path, 'part-2.csv'))
+        data = read_data_dir(
+            '.csv', 'csv', self._data_path, True, True, '', 'c0',
+            cache_path=self._cache_path)
+        self.assertEqual(len(data[5]), 20)
+        self.assertEqual(len(os.listdir(self._cache_path)), 2)
+
+    def test_load_binned_features(self):
+        binned = load_binned_features(
+            self._features, self._cat_features, 8, binning_method='sketch')
+        pool = mp.Pool(2)
+        cache_dir = os.path.join(self._cache_path, 'data')
+        for _ in range(2):
+            # binned with the given pool first, then loaded from cache
+            pool_binned = load_binned_features(
+                self._features, self._cat_features, 8, cache_dir,
+                binning_method='sketch', num_parallel=2, pool=pool)
+            np.testing.assert_equal(pool_binned.binned, binned.binned)
+        pool.close()
+        pool.join()
+
+    def test_predict_in_chunks(self):
+        filename = os.path.join(self._data_path, 'part-1.csv')
+        reader = DataChunkReader('csv', filename, True, True, '', 'c0')
+        chunks = [reader.read(4) for _ in range(4)]
+        self.assertEqual([len(i[0]) for i in chunks], [4, 4, 2, 0])
+        for i, chunk in enumerate(chunks[:3]):
+            self.check_data(chunk, 10 + i*4, min(10 + i*4 + 4, 20))
+
+        booster = BoostingTreeEnsamble(None, max_iters=2, max_depth=2)
+        booster.fit(self._features, self._labels,
+                    cat_features=self._cat_features)
+        args = create_argument_parser().parse_args(
+            ['local', '--cat-fields', 'c0', '--predict-chunk-size', '3'])
+        output_file = os.path.join(self._cache_path, 'part-1.output')
+        trainer.test_one_file(args, None, booster, filename, output_file)
+
+        with open(output_file) as fin:
+            lines = fin.read().splitlines()
+        self.assertEqual(lines[0], 'example_id,prediction')
+        self.assertEqual([i.split(',')[0] for i in lines[1:]],
+                         [str(i) for i in range(10, 20)])
+        np.testing.assert_almost_equal(
+            [float(i.split(',')[1]) for i in lines[1:]],
+            booster.batch_predict(self._features[10:20],
+                                  cat_features=self._cat_features[10:20]))
+
+        # leader must run out of rows together with the follower
+        class _FinishedBridge(object):
+            current_iter_id = 0
+            def new_iter_id(self):
+                return 0
+            def start(self, iter_id):
+                pass
+            def commit(self):
+                pass
+            def receive(self, iter_id, name):
+                if name == 'chunk_size':
+                    return np.asarray([0])
+                return np.asarray([], dtype=np.str_)
+
+        args = create_argument_parser().parse_args(
+            ['leader', '--cat-fields', 'c0'])
+        with self.assertRaises(AssertionError):
+            trainer.test_one_file(
+                args, _FinishedBridge(), booster, filename, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,12 +14,19 @@
 
 # coding: utf-8
 
+import os
+import shutil
+import tempfile
 import threading
 import unittest
 import numpy as np
 
 import fedlearner as fl
-from fedlearner.model.tree.tree import BoostingTreeEnsamble
+from fedlearner.model.tree import tree
+from fedlearner.model.tree.tree import BoostingTreeEnsamble, \
+    BinnedFeatures, HistogramBuilder, EncryptedHistogramBuilder
+from fedlearner.model.tree.sketch import QuantileSketch
+from fedlearner.model.crypto import paillier, gmpy_math
 from fedlearner.common import tree_model_pb2 as tree_pb2
 from sklearn.datasets import load_iris
 
@@ -53,20 +60,49 @@ class TestBoostingTree(unittest.TestCase):
             max_depth=2,
             num_parallel=2,
             loss_type=loss_type)
-        train_pred = booster.fit(X, y, cat_features=cat_X)
+        output_path = os.path.join(tempfile.mkdtemp(), 'log')
+        train_pred = booster.fit(
+            X, y, cat_features=cat_X, validation_features=X,
+            validation_cat_features=cat_X, validation_labels=y,
+            output_path=output_path)
         pred = booster.batch_predict(X, cat_features=cat_X)
+        booster.close()
         np.testing.assert_almost_equal(train_pred, pred)
+
+        # compiled ensemble is rebuilt from the saved model
+        model_path = os.path.join(tempfile.mkdtemp(), 'model')
+        booster.save_model(model_path)
+        loaded = BoostingTreeEnsamble(None, loss_type=loss_type)
+        loaded.load_saved_model(model_path)
+        shutil.rmtree(os.path.dirname(model_path))
+        np.testing.assert_equal(
+            loaded.batch_predict(X, cat_features=cat_X), pred)
+
+        # validation scores are accumulated tree by tree
+        with open(output_path) as fin:
+            lines = fin.read().splitlines()
+        shutil.rmtree(os.path.dirname(output_path))
+        self.assertEqual(lines[-3], 'val_2')
+        val_pred = np.asarray([float(i) for i in lines[-1].split(',')])
+        np.testing.assert_almost_equal(val_pred, pred)
         return pred
 
-    def leader_test_boosting_tree_helper(self, X, y, cat_X):
+    def leader_test_boosting_tree_helper(self, X, y, cat_X,
+                                         enable_packing=False,
+                                         num_parallel=1):
         bridge = fl.trainer.bridge.Bridge(
             'leader', 50051, 'localhost:50052', streaming_mode=False)
         booster = BoostingTreeEnsamble(
             bridge,
             max_iters=3,
-            max_depth=2)
-        train_pred = booster.fit(X, y, cat_features=cat_X)
+            max_depth=2,
+            enable_packing=enable_packing,
+            num_parallel=num_parallel)
+        train_pred = booster.fit(
+            X, y, cat_features=cat_X, validation_features=X,
+            validation_cat_features=cat_X, validation_labels=y)
         pred = booster.batch_predict(X, cat_features=cat_X)
+        booster.close()
         bridge.terminate()
         np.testing.assert_almost_equal(train_pred, pred)
         return pred
@@ -78,7 +114,9 @@ class TestBoostingTree(unittest.TestCase):
             bridge,
             max_iters=3,
             max_depth=2)
-        booster.fit(X, None, cat_features=cat_X)
+        booster.fit(
+            X, None, cat_features=cat_X, validation_features=X,
+            validation_cat_features=cat_X)
         pred = booster.batch_predict(X, cat_features=cat_X, get_raw_score=True)
         bridge.terminate()
         np.testing.assert_almost_equal(pred, 0)
@@ -108,6 +146,16 @@ class TestBoostingTree(unittest.TestCase):
         thread.join()
         np.testing.assert_almost_equal(local_pred, leader_pred)
 
+        # test two side with packed histograms
+        thread = threading.Thread(
+            target=self.follower_test_boosting_tree_helper,
+            args=(follower_X, follower_cat_X))
+        thread.start()
+        leader_pred = self.leader_test_boosting_tree_helper(
+            leader_X, y, leader_cat_X, enable_packing=True, num_parallel=2)
+        thread.join()
+        np.testing.assert_almost_equal(local_pred, leader_pred)
+
         # test one side
         thread = threading.Thread(
             target=self.follower_test_boosting_tree_helper,
@@ -118,6 +166,137 @@ class TestBoostingTree(unittest.TestCase):
         thread.join()
         np.testing.assert_almost_equal(local_pred, leader_pred)
 
+    def test_histogram_builder(self):
+        X, y = self.make_data()
+        cat_X = self.quantize_data(X[:, 2:])
+        binned = BinnedFeatures(X[:, :2], 33, cat_features=cat_X)
+        grad = np.random.normal(size=X.shape[0]).astype(np.float32)
+        hess = np.random.uniform(size=X.shape[0]).astype(np.float32)
+        sample_ids = np.random.choice(X.shape[0], 100, replace=False)
+
+        builder = HistogramBuilder(binned)
+        grad_hists, hess_hists = builder.compute_histograms(
+            [grad, hess], sample_ids)
+        self.assertEqual(len(grad_hists), binned.num_all_features)
+        bins = np.concatenate([binned.binned, binned.cat_features], axis=1)
+        for i in range(binned.num_all_features):
+            for hist, values in [(grad_hists[i], grad), (hess_hists[i], hess)]:
+                expected = np.zeros(hist.size, dtype=np.float64)
+                np.add.at(expected, bins[sample_ids, i], values[sample_ids])
+                np.testing.assert_almost_equal(hist, expected, decimal=5)
+
+        np.testing.assert_almost_equal(
+            builder.compute_histogram(grad, sample_ids)[0], grad_hists[0])
+
+        public_key, private_key = \
+            paillier.PaillierKeypair.generate_keypair(512)
+        enc_grad = np.asarray(public_key.encrypt_batch(grad, 1e38))
+        enc_hess = np.asarray(public_key.encrypt_batch(hess, 1e38))
+        enc_builder = EncryptedHistogramBuilder(binned, public_key)
+        enc_grad_hists, enc_hess_hists = enc_builder.compute_histograms(
+            [enc_grad, enc_hess], sample_ids)
+        for enc_hists, hists in [(enc_grad_hists, grad_hists),
+                                 (enc_hess_hists, hess_hists)]:
+            self.assertEqual(len(enc_hists), len(hists))
+            for enc_hist, hist in zip(enc_hists, hists):
+                np.testing.assert_almost_equal(
+                    [private_key.decrypt(i) for i in enc_hist], hist,
+                    decimal=5)
+
+        # every bin is re-randomized with its own r^n, with a shared one
+        # the leader could cancel it out and learn the bins of samples
+        values = enc_grad[sample_ids]
+        exponent = max(i.exponent for i in values)
+        expected = [1] * len(enc_grad_hists[0])
+        for b, value in zip(bins[sample_ids, 0], values):
+            expected[b] = expected[b] * \
+                value.increase_exponent_to(exponent).ciphertext(False) % \
+                public_key.nsquare
+        factors = [
+            i.ciphertext(False) * gmpy_math.invert(c, public_key.nsquare) %
+            public_key.nsquare
+            for i, c in zip(enc_grad_hists[0], expected)]
+        self.assertNotIn(1, factors)
+        self.assertEqual(len(set(factors)), len(factors))
+
+        # packed bins are re-randomized per packed ciphertext instead
+        enc_builder = EncryptedHistogramBuilder(
+            binned, public_key, obfuscate=False)
+        enc_grad_hist = enc_builder.compute_histogram(enc_grad, sample_ids)[0]
+        slot_bits = tree._get_packing_slot_bits(public_key, grad, hess)
+        num_slots = tree._get_num_slots(public_key, slot_bits)
+        args = ([gmpy_math.mpz(i.ciphertext(False)) for i in enc_grad_hist],
+                public_key, slot_bits, num_slots)
+        packed = tree._pack_ciphertexts_helper(args)
+        self.assertEqual(len(packed), -(-len(enc_grad_hist)//num_slots))
+        self.assertNotEqual(packed, tree._pack_ciphertexts_helper(args))
+        np.testing.assert_almost_equal(
+            tree._decrypt_packed_histogram_helper(
+                (private_key, packed, slot_bits, num_slots))[
+                    :len(enc_grad_hist)],
+            grad_hists[0], decimal=5)
+
+    def test_binned_features(self):
+        X, y = self.make_data()
+        cat_X = self.quantize_data(X[:, 2:])
+        binned = BinnedFeatures(X[:, :2], 33, cat_features=cat_X)
+
+        path = os.path.join(tempfile.mkdtemp(), 'binned')
+        binned.save(path)
+        loaded = BinnedFeatures.load(path)
+        shutil.rmtree(os.path.dirname(path))
+        self.assertIsNone(loaded.features)
+        self.assertTrue(loaded.binned.flags.f_contiguous)
+        np.testing.assert_equal(loaded.binned, binned.binned)
+        np.testing.assert_equal(loaded.cat_features, binned.cat_features)
+        self.assertEqual(loaded.binning_method, 'exact')
+        self.assertEqual(loaded.num_bins, binned.num_bins)
+        self.assertEqual(loaded.cat_num_bins, binned.cat_num_bins)
+        for a, b in zip(loaded.thresholds, binned.thresholds):
+            np.testing.assert_equal(a, b)
+
+        booster = BoostingTreeEnsamble(None, max_iters=3, max_depth=2)
+        pred = booster.fit(X[:, :2], y, cat_features=cat_X)
+        booster = BoostingTreeEnsamble(None, max_iters=3, max_depth=2)
+        loaded_pred = booster.fit(
+            X[:, :2], y, cat_features=cat_X, binned_features=loaded)
+        np.testing.assert_almost_equal(pred, loaded_pred)
+
+        # binned features must come from the configured binning method
+        booster = BoostingTreeEnsamble(
+            None, max_iters=3, max_depth=2, binning_method='sketch')
+        with self.assertRaises(AssertionError):
+            booster.fit(X[:, :2], y, cat_features=cat_X,
+                        binned_features=loaded)
+
+    def test_quantile_sketch(self):
+        np.random.seed(123)
+        x = np.random.normal(size=100000)
+        sketch = QuantileSketch(256)
+        for i in range(0, x.size, 10000):
+            other = QuantileSketch(256)
+            other.update(x[i:i+10000])
+            sketch.merge(other)
+        self.assertFalse(sketch.is_exact)
+        self.assertLessEqual(len(sketch), 256)
+        self.assertAlmostEqual(sketch.total_weight, x.size)
+        qs = np.linspace(0, 1, 11)[1:-1]
+        ranks = np.searchsorted(np.sort(x), sketch.quantiles(qs)) / x.size
+        np.testing.assert_allclose(ranks, qs, atol=0.02)
+
+        x = np.random.randint(0, 10, size=1000).astype(np.float64)
+        x[::3] = float('nan')
+        sketch = QuantileSketch(256)
+        sketch.update(x)
+        self.assertTrue(sketch.is_exact)
+        np.testing.assert_equal(
+            sketch.get_thresholds(33), np.arange(9) + 0.5)
+
+        X, y = self.make_data()
+        binned = BinnedFeatures(X, 33)
+        sketch_binned = BinnedFeatures(X, 33, binning_method='sketch')
+        np.testing.assert_equal(sketch_binned.binned, binned.binned)
+
     def test_boosting_tree(self):
         X, y = self.make_data()
 